@@ -1,6 +1,6 @@
 import numpy as np
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Dict, Iterator, List, Literal, Optional, Sequence, Tuple, Union
 from pydantic import BaseModel, Field
 from collections import defaultdict
 import matplotlib.pyplot as plt
@@ -8,7 +8,18 @@ import matplotlib.pyplot as plt
 from LOOM.src.data_classes.LoomAnalysis import LoomInputParams, LoomAnalysis
 from LOOM.src.data_classes.LoomTxtReader import LoomTxtReader
 from LOOM.src.data_classes.LoomTxtMultiReader import LoomTxtMultiReader
+from LOOM.src.data_classes.LoomBinaryRun import LoomBinaryRun
+from LOOM.src.data_classes.LoomDatasetStore import LoomDatasetStore
 from LOOM.src.data_classes.LoomSet import LoomSet
+from LOOM.src.data_classes.LoomRow import LOOM_ROW_FIELDS
+from LOOM.src.data_classes.LoomOutOfCoreGrouper import LoomOutOfCoreGrouper
+from LOOM.src.data_classes.LoomStreamingAggregator import LoomStreamingAggregator
+from LOOM.src.data_classes.LoomCube import LoomCube
+from LOOM.src.data_classes.LoomReferenceLibrary import LoomReferenceLibrary
+from LOOM.src.data_classes.LoomFigureCache import LoomFigureCache
+import LOOM.src.core.bootstrap as lcb
+import LOOM.src.core.profile_fitting as lcf
+import LOOM.src.core.sweep as lcs
 from LOOM.src.analysis.reflectivity import utils as ru
 
 class Analysis1(LoomAnalysis):
@@ -38,83 +49,939 @@ class Analysis1(LoomAnalysis):
                 default="output",
                 description="Path to the output folder"
             )
+            combine_repeats: Literal["sum", "mean", "weighted"] = Field(
+                default="weighted",
+                description="How repeated measurements at the same (revolver, "
+                "wavelength, PMT position) point are combined before "
+                "integrating: 'sum' adds every reading (legacy behaviour), "
+                "'mean' averages them and 'weighted' takes their "
+                "inverse-variance weighted mean"
+            )
+            outlier_rejection: Optional[Literal["sigma", "mad"]] = Field(
+                default=None,
+                description="If given, the clipping method used to reject "
+                "outlier currents among the repeated measurements of each "
+                "scan point, before combining them. Not available in the "
+                "streaming or out-of-core modes"
+            )
+            outlier_nsigma: float = Field(
+                default=3.5,
+                gt=0.,
+                description="Rejection threshold of the outlier clipping, in "
+                "units of the per-point scale. Points with few repeats get a "
+                "wider, Student's t threshold with the same false rejection "
+                "probability, and points with less than 5 repeats are never "
+                "clipped"
+            )
+            dark_current_window_s: Optional[float] = Field(
+                default=None,
+                gt=0.,
+                description="If given, the width, in seconds, of the time "
+                "windows over which the dark current of each file is "
+                "smoothed into a baseline, which is then subtracted instead "
+                "of the per-row dark current. Not available in the "
+                "streaming or out-of-core modes"
+            )
+            dark_current_method: Literal["median", "mean"] = Field(
+                default="median",
+                description="How the dark current of each time window is "
+                "reduced into the baseline"
+            )
+            environmental_correction: bool = Field(
+                default=False,
+                description="Whether to fit the relative response of the "
+                "current to temperature and humidity, per revolver position "
+                "and wavelength, and to refer every current to the mean "
+                "conditions before integrating. The fitted slopes are "
+                "written to 'environmental_response.csv' in the output "
+                "folder. Not available in the streaming or out-of-core modes"
+            )
+            reference_library: Optional[str] = Field(
+                default=None,
+                description="If given, the folder of a LoomReferenceLibrary. "
+                "The 'No sample' spectrum of every run which measures it is "
+                "stored there, and runs which do not measure it are "
+                "normalized to the closest stored one"
+            )
+            reference_setup: Optional[str] = Field(
+                default=None,
+                description="Setup tag of the reference spectra. If None, the "
+                "'Setup' entry of the metadata is used, or 'default' if there "
+                "is none"
+            )
+            storage_profile: str = Field(
+                default="full",
+                description="Storage profile for the loaded data. 'full' keeps "
+                "the LoomRow objects, while 'compact' converts them into compact "
+                "columns (see LoomSet.compact())"
+            )
+            wavelength_range: Optional[Tuple[float, float]] = Field(
+                default=None,
+                description="(lo, hi) range of the wavelengths, in nm, to be "
+                "analyzed. If None, every wavelength is analyzed. For LOOM "
+                "binary run inputs (.loomrun), the blocks out of the range "
+                "are never read"
+            )
+            time_range: Optional[Tuple[float, float]] = Field(
+                default=None,
+                description="(lo, hi) range of the unixtime of the rows to be "
+                "analyzed. If None, every row is analyzed. For LOOM binary "
+                "run inputs (.loomrun), the blocks out of the range are never "
+                "read"
+            )
+            columns: Optional[List[str]] = Field(
+                default=None,
+                description="LoomRow fields which are decoded when the input "
+                "is read. The rest are decoded together, in one more pass, on "
+                "first access to any of them or to the rejection mask, since "
+                "the rows with malformed fields are only found in that pass. "
+                "If None, every field is decoded when the input is read"
+            )
+            reader_processes: int = Field(
+                default=1,
+                ge=1,
+                description="Number of worker processes which parse each "
+                "input file, in parallel byte ranges. It only applies to "
+                "storage profiles other than 'full', which are read into "
+                "columns"
+            )
+            validation: Literal["lenient", "strict"] = Field(
+                default="lenient",
+                description="Handling of the malformed lines of .txt inputs. "
+                "'lenient' drops the lines with too few fields and rejects "
+                "the rows with unparsable values, listing both in "
+                "quarantine.csv, while 'strict' raises an exception at the "
+                "first chunk with a malformed line"
+            )
+            streaming: bool = Field(
+                default=False,
+                description="Whether to aggregate the rows in a single "
+                "streaming pass, into per scan point accumulators, instead "
+                "of loading them, so that the memory is proportional to the "
+                "number of scan points. Only the integrated-intensity "
+                "figures are produced."
+            )
+            out_of_core: bool = Field(
+                default=False,
+                description="Whether to stream the rows through a bounded "
+                "memory budget, spilling to disk, instead of loading them. "
+                "Only the integrated-intensity figures are produced."
+            )
+            memory_budget_mb: float = Field(
+                default=256.,
+                gt=0.,
+                description="Memory budget, in MB, for the out-of-core mode"
+            )
+            spill_dir: Optional[str] = Field(
+                default=None,
+                description="Folder where the out-of-core mode spills its "
+                "runs. If None, the system temporary folder is used."
+            )
+            bootstrap_resamples: int = Field(
+                default=0,
+                ge=0,
+                description="Number of bootstrap resamples used to draw the "
+                "error bars of the integrated intensities and of the "
+                "reflectivity ratios. Each resample redraws the repeated "
+                "measurements of every point, with replacement. If 0, no "
+                "error bars are drawn. Not "
+                "available in the streaming or out-of-core modes"
+            )
+            bootstrap_confidence: float = Field(
+                default=0.68,
+                gt=0.,
+                lt=1.,
+                description="Probability covered by the bootstrap error bars"
+            )
+            bootstrap_seed: int = Field(
+                default=0,
+                description="Seed of the bootstrap random streams"
+            )
+            bootstrap_processes: int = Field(
+                default=1,
+                ge=1,
+                description="Number of processes among which the bootstrap "
+                "resamples are spread"
+            )
+            profile_model: Optional[str] = Field(
+                default=None,
+                description="If given, the peak model (see "
+                "LOOM.src.core.profile_fitting.PEAK_MODELS) which is fitted "
+                "to the signal vs PMT position profile of every revolver "
+                "position and wavelength. The fitted parameters are written "
+                "to 'profile_fits.csv' in the output folder. Not available "
+                "in the streaming or out-of-core modes"
+            )
+            intensity_plot: Literal["lines", "heatmap"] = Field(
+                default="lines",
+                description="Rendering of the 'Intensity vs PMT Position per "
+                "Revolver' figure. 'lines' draws one errorbar line per "
+                "wavelength, while 'heatmap' draws each revolver position as "
+                "a single wavelength x PMT position image, whose rendering "
+                "time does not grow with the number of wavelengths"
+            )
+            heatmap_scale: Literal["linear", "log"] = Field(
+                default="linear",
+                description="Colour scale of the heatmap rendering"
+            )
+            heatmap_per_wavelength: bool = Field(
+                default=False,
+                description="Whether the heatmap rendering divides each "
+                "wavelength by its maximum, so that the shapes of the "
+                "profiles are comparable across the spectrum"
+            )
+            time_series_plot: bool = Field(
+                default=False,
+                description="Whether to draw the current, temperature and "
+                "humidity of every row against its unixtime, in an extra "
+                "figure, to spot drifts of the setup along the run. Not "
+                "available in the streaming or out-of-core modes"
+            )
+            time_series_downsampling: Optional[Literal["minmax", "lttb"]] = Field(
+                default="minmax",
+                description="How the time series are downsampled to the "
+                "pixel width of their axes, so that the drawing time does "
+                "not grow with the number of rows. 'minmax' keeps the "
+                "extremes of every pixel column, so that spikes are never "
+                "hidden, and 'lttb' keeps the visual shape of the curves. "
+                "If None, every row is drawn"
+            )
+            figure_cache: bool = Field(
+                default=False,
+                description="Whether to write the figures to the 'figures' "
+                "folder of the output, instead of showing them, rendering "
+                "only the ones whose plotted arrays or style options changed "
+                "since the previous run. Each revolver panel of the "
+                "'Intensity vs PMT Position per Revolver' figure is cached "
+                "on its own"
+            )
+            profile_warm_start: bool = Field(
+                default=True,
+                description="Whether each profile fit starts from the result "
+                "of the previous wavelength"
+            )
+            profile_processes: int = Field(
+                default=1,
+                ge=1,
+                description="Number of processes among which the profile "
+                "fits are spread"
+            )
         return InputParams
 
     def initialize(self, input_parameters: LoomInputParams) -> None:
         self.params = input_parameters
         self.LoomSet: Optional[LoomSet] = None
-        self.grouped_data = defaultdict(lambda: defaultdict(list))
+        # The dataset store of the input runs, if
+        # store_path is given
+        self.store: Optional[LoomDatasetStore] = None
+        # The reader of the .txt inputs, whose validation
+        # reports are written by write_output()
+        self.txt_reader: Optional[Union[LoomTxtReader, LoomTxtMultiReader]] = None
+        self.cube: Optional[LoomCube] = None
+        # {revpos: {wavelength: integrated_intensity}}
+        self.integrated_by_wavelength = {}
+        # Bootstrap confidence intervals, with the same
+        # nesting. Empty if bootstrap_resamples is 0.
+        self.integrated_interval = {}
+        self.ratio_interval = {}
+        # Output of lcf.fit_profiles() and its table,
+        # with one row per profile. Empty if no
+        # profile_model is given.
+        self.profile_fits = {}
+        self.profile_table = []
+        # Output of LoomSet.fit_environmental_response(),
+        # and its table. Empty if environmental_correction
+        # is False.
+        self.environmental_response = {}
+        self.environmental_table = []
+        # {wavelength: integrated_intensity} of the 'No sample'
+        # position, measured in the same run or taken from
+        # the reference library
+        self.reference_spectrum = {}
+        self.reference_source = None
 
     def read_input(self) -> bool:
         input_paths = getattr(self.params, 'input_path', None)
 
-        if not input_paths:
-            raise ValueError("'input_path' must be a non-empty list of file paths.")
+        if self.params.store_path is not None:
+            if not Path(self.params.store_path).is_dir():
+                raise ValueError(f"'store_path' must be an existing LOOM dataset store, but got '{self.params.store_path}'.")
+            self.store = LoomDatasetStore(self.params.store_path)
+            input_paths = []
+        else:
+            if not input_paths:
+                raise ValueError("'input_path' must be a non-empty list of file paths.")
+
+            if not isinstance(input_paths, list):
+                raise TypeError("'input_path' must be a list of strings.")
+
+        unknown = [name for name in self.params.columns or [] if name not in LOOM_ROW_FIELDS]
+        if unknown:
+            raise ValueError(f"'columns' must only hold LoomRow fields, but got {unknown}.")
 
-        if not isinstance(input_paths, list):
-            raise TypeError("'input_path' must be a list of strings.")
+        binary = [Path(path).suffix == LoomBinaryRun.suffix for path in input_paths]
+        if any(binary) and not all(binary):
+            raise ValueError("'input_path' cannot mix LOOM binary runs (.loomrun) with .txt files.")
 
-        if len(input_paths) == 1:
-            self.LoomSet = LoomTxtReader(input_paths[0]).read()
+        if self.__streams_rows():
+            # Only the metadata is read here. The
+            # rows are streamed later, in analyze().
+            if self.store is not None:
+                metadata = self.store.read_metadata(self.params.store_runs)
+                sources = {run_id: (0, 0) for run_id in metadata}
+            elif all(binary):
+                runs = [LoomBinaryRun(path) for path in input_paths]
+                metadata = runs[0].metadata if len(runs) == 1 \
+                    else {run.source: run.metadata for run in runs}
+                sources = {run.source: (0, 0) for run in runs}
+            elif len(input_paths) == 1:
+                metadata = LoomTxtReader(input_paths[0]).read_metadata()
+                sources = {Path(input_paths[0]).name: (0, 0)}
+            else:
+                metadata = LoomTxtMultiReader(input_paths).read_metadata()
+                sources = {name: (0, 0) for name in metadata}
+            self.LoomSet = LoomSet(metadata=metadata, data=[], sources=sources)
+            return True
+
+        # Non-full profiles never build the LoomRow objects
+        flyweight_rows = self.params.storage_profile != "full"
+        # The selection is pushed down to the
+        # readers of the binary runs
+        if self.store is not None:
+            self.LoomSet = self.store.read(
+                self.params.store_runs,
+                self.params.columns,
+                **self.__selection()
+            )
+        elif all(binary):
+            self.LoomSet = self.__read_binary_runs(input_paths)
+        elif len(input_paths) == 1:
+            self.txt_reader = LoomTxtReader(
+                input_paths[0],
+                flyweight_rows=flyweight_rows,
+                processes=self.params.reader_processes,
+                columns=self.params.columns,
+                validation=self.params.validation
+            )
+            self.LoomSet = self.txt_reader.read()
         else:
-            self.LoomSet = LoomTxtMultiReader(input_paths).read()
+            self.txt_reader = LoomTxtMultiReader(
+                input_paths,
+                flyweight_rows=flyweight_rows,
+                processes=self.params.reader_processes,
+                columns=self.params.columns,
+                validation=self.params.validation
+            )
+            self.LoomSet = self.txt_reader.read()
+
+        if self.params.storage_profile != "full":
+            report = self.LoomSet.compact(self.params.storage_profile)
+            refused = [name for name, column in report['columns'].items() if column['refused']]
+            print(f"✅ Compact storage: saved ~{report['bytes_saved'] / 2**20:.2f} MB.")
+            if refused:
+                print(f"Warning: Kept full precision for {refused}, since downcasting them would be lossy.")
+
+        if self.store is None and not all(binary) and self.__selection():
+            self.LoomSet = self.LoomSet.select(**self.__selection())
 
         return True
 
+    def __selection(self) -> Dict[str, Tuple[float, float]]:
+        """The LoomSet.select() criteria given by the
+        wavelength_range and time_range parameters."""
+        criteria = {
+            'wavelength': self.params.wavelength_range,
+            'unixtime': self.params.time_range
+        }
+        return {name: tuple(value) for name, value in criteria.items() if value is not None}
+
+    def __read_binary_runs(self, paths: List[str]) -> LoomSet:
+        runs = [LoomBinaryRun(path) for path in paths]
+        selection = self.__selection()
+
+        def read_columns(names: Sequence[str]) -> Dict[str, np.ndarray]:
+            parts = [run.read_columns(names, **selection) for run in runs]
+            return {name: np.concatenate([part[name] for part in parts]) for name in names}
+
+        metadata = {}
+        sources = {}
+        n_rows = 0
+        for run in runs:
+            n_run = run.count_rows(**selection)
+            metadata[run.source] = run.metadata
+            sources[run.source] = (n_rows, n_rows + n_run)
+            n_rows += n_run
+            n_read = len(run.select_blocks(**selection))
+            print(f"✅ Read {n_read} of {run.n_blocks} block(s) of '{run.source}'.")
+
+        return LoomSet.from_columns(
+            metadata=metadata if len(runs) > 1 else runs[0].metadata,
+            columns=read_columns(LOOM_ROW_FIELDS if self.params.columns is None else self.params.columns),
+            sources=sources,
+            loader=None if self.params.columns is None else read_columns,
+            n_rows=n_rows
+        )
+
+    def __iter_input_chunks(self, columns: Sequence[str]) -> Iterator[Dict[str, np.ndarray]]:
+        """Streams the given columns of the rows of every
+        input file, restricted to the selection."""
+        selection = self.__selection()
+
+        if self.store is not None:
+            for _, chunk in self.store.iter_chunks(self.params.store_runs, columns, **selection):
+                yield chunk
+            return
+
+        if Path(self.params.input_path[0]).suffix == LoomBinaryRun.suffix:
+            for path in self.params.input_path:
+                yield from LoomBinaryRun(path).iter_chunks(columns, **selection)
+            return
+
+        needed = tuple(dict.fromkeys(tuple(columns) + tuple(selection)))
+        self.txt_reader = LoomTxtMultiReader(self.params.input_path, validation=self.params.validation)
+        for _, chunk in self.txt_reader.iter_chunks(columns=needed):
+            if selection:
+                mask = LoomBinaryRun.row_mask(chunk, selection)
+                chunk = {name: values[mask] for name, values in chunk.items()}
+            yield {name: chunk[name] for name in columns}
+
+    def __streams_rows(self) -> bool:
+        return self.params.streaming or self.params.out_of_core
+
+    def get_shared_input(self) -> Optional[LoomSet]:
+        if self.__streams_rows():
+            return None
+        return self.LoomSet
+
+    @classmethod
+    def get_shared_input_key(cls, input_parameters: LoomInputParams) -> dict:
+        """The parameters which read_input() depends on."""
+        return {
+            name: getattr(input_parameters, name)
+            for name in (
+                'input_path', 'store_path', 'store_runs', 'columns',
+                'storage_profile', 'validation', 'reader_processes',
+                'wavelength_range', 'time_range', 'streaming', 'out_of_core'
+            )
+        }
+
+    def set_shared_input(self, shared_input: LoomSet) -> None:
+        # The rejections and corrections of analyze() go to
+        # private copies of the analysis columns, so that the
+        # shared LoomSet is left untouched
+        self.LoomSet = shared_input.private_view()
+
+    def get_summary(self) -> dict:
+        summary = {
+            'n_rows': len(self.LoomSet) if self.LoomSet is not None else 0,
+            'n_revolvers': len(self.integrated_by_wavelength)
+        }
+
+        for revpos, wavelength_to_intensity in sorted(self.integrated_by_wavelength.items()):
+            summary[f'integrated_intensity_rev{revpos}'] = sum(wavelength_to_intensity.values())
+
+        return summary
+
     def analyze(self) -> bool:
-        if not self.LoomSet:
+        if self.LoomSet is None:
             raise RuntimeError("No data. Execute first 'read_input()'.")
 
-        data = self.LoomSet.data
-    
-        for row in data:
-            self.grouped_data[row.revolverpos][row.wavelength].append(row)
+        if self.__streams_rows():
+            if self.params.bootstrap_resamples > 0:
+                print("Warning: The streaming and out-of-core modes do not support the bootstrap. Skipping the error bars.")
+            if self.params.profile_model is not None:
+                print("Warning: The streaming and out-of-core modes do not support profile fits. Skipping them.")
+            if self.params.dark_current_window_s is not None:
+                print("Warning: The streaming and out-of-core modes do not support the dark current baseline. Skipping it.")
+            if self.params.environmental_correction:
+                print("Warning: The streaming and out-of-core modes do not support the environmental correction. Skipping it.")
+            self.integrated_by_wavelength = self.__integrate_streamed()
+            self.__resolve_reference()
+            return True
+
+        if self.params.outlier_rejection is not None:
+            n_rejected = self.LoomSet.reject_outliers(
+                method=self.params.outlier_rejection,
+                nsigma=self.params.outlier_nsigma
+            )
+            print(f"✅ Rejected {n_rejected} outlier row(s) out of {len(self.LoomSet)}.")
+
+        if self.params.dark_current_window_s is not None:
+            knots = self.LoomSet.correct_dark_current(
+                window=self.params.dark_current_window_s,
+                method=self.params.dark_current_method
+            )
+            n_knots = sum(len(k['time']) for k in knots.values())
+            print(f"✅ Built the dark current baseline out of {n_knots} time window(s).")
+
+        if self.params.environmental_correction:
+            self.__correct_environment()
+
+        combine_repeats = self.params.combine_repeats
+        self.cube = LoomCube.from_loomset(
+            self.LoomSet,
+            combine="mean" if combine_repeats == "sum" else combine_repeats,
+            dark_current="dc" if self.params.dark_current_window_s is None else "dc_baseline",
+            current_column="current_env" if self.params.environmental_correction else "current"
+        )
+        self.integrated_by_wavelength = self.cube.as_nested_dict(
+            self.cube.integrated_intensity(
+                repeats="sum" if combine_repeats == "sum" else "mean"
+            )
+        )
+
+        if self.params.bootstrap_resamples > 0:
+            self.__bootstrap_intervals()
+
+        if self.params.profile_model is not None:
+            self.__fit_profiles()
+
+        self.__resolve_reference()
 
         return True
 
+    def __resolve_reference(self) -> None:
+        no_sample_revpos = self.__no_sample_revpos()
+        if no_sample_revpos is not None:
+            self.reference_spectrum = dict(self.integrated_by_wavelength.get(no_sample_revpos, {}))
+            self.reference_source = f"Revolver {no_sample_revpos}"
+
+        # The spectrum of this run is stored by write_output()
+        if self.params.reference_library is None or self.reference_spectrum:
+            return
+
+        library = LoomReferenceLibrary(self.params.reference_library)
+        date, setup = self.__reference_date_and_setup()
+
+        wavelengths = sorted({wl for spectrum in self.integrated_by_wavelength.values() for wl in spectrum})
+        reference = library.reference_for(setup, date, np.array(wavelengths), self.__reference_options())
+        if reference is None:
+            print(
+                f"Warning: The reference library has no spectrum for the setup '{setup}' "
+                "which was computed with the same processing options as this run."
+            )
+            return
+
+        self.reference_spectrum = {
+            wl: value for wl, value in zip(wavelengths, reference['spectrum'].tolist())
+            if not np.isnan(value)
+        }
+        self.reference_source = f"library entry {reference['key']}"
+        print(f"✅ Normalizing to the reference library entry '{reference['key']}'.")
+
+    def __reference_date_and_setup(self) -> Tuple[Optional[str], str]:
+        metadata = self.__run_metadata()
+        return (
+            metadata.get("Date"),
+            self.params.reference_setup or metadata.get("Setup", "default")
+        )
+
+    def __reference_options(self) -> dict:
+        """The parameters which the integrated 'No sample'
+        spectrum depends on, so that the reference library
+        never mixes spectra which are not comparable, p.e.
+        summed and averaged repeats."""
+        streams = self.__streams_rows()
+        return {
+            'combine_repeats': "mean" if streams and self.params.combine_repeats == "weighted"
+            else self.params.combine_repeats,
+            'outlier_rejection': None if streams else self.params.outlier_rejection,
+            'outlier_nsigma': None if streams or self.params.outlier_rejection is None
+            else self.params.outlier_nsigma,
+            'dark_current_window_s': None if streams else self.params.dark_current_window_s,
+            'dark_current_method': None if streams or self.params.dark_current_window_s is None
+            else self.params.dark_current_method,
+            'environmental_correction': not streams and self.params.environmental_correction,
+            'wavelength_range': self.params.wavelength_range,
+            'time_range': self.params.time_range
+        }
+
+    def __store_reference(self) -> None:
+        """Stores the 'No sample' spectrum of this run in the
+        reference library, if both are given."""
+        # Spectra taken from the library are not stored again
+        if self.params.reference_library is None or not self.reference_spectrum \
+            or self.__no_sample_revpos() is None:
+            return
+
+        library = LoomReferenceLibrary(self.params.reference_library)
+        date, setup = self.__reference_date_and_setup()
+        wavelengths = sorted(self.reference_spectrum)
+        key = library.store(
+            date if date is not None else "unknown",
+            setup,
+            np.array(wavelengths),
+            np.array([self.reference_spectrum[wl] for wl in wavelengths]),
+            options=self.__reference_options()
+        )
+        print(f"✅ Stored the 'No sample' spectrum in the reference library as '{key}'.")
+
+    def __run_metadata(self) -> dict:
+        # The metadata of the first file, for merged LoomSets
+        sources = list(self.LoomSet.sources)
+        if sources:
+            return self.LoomSet.source_metadata(sources[0])
+        return self.LoomSet.metadata
+
+    def __correct_environment(self) -> None:
+        response = self.LoomSet.fit_environmental_response()
+        self.LoomSet.correct_environment(response)
+        self.environmental_response = response
+
+        names = response['regressors']
+        self.environmental_table = []
+        for g, key in enumerate(zip(*(k.tolist() for k in response['keys']))):
+            row = dict(zip(response['group_by'], key))
+            for k, name in enumerate(names):
+                row[f'{name}_slope'] = response['slopes'][g, k]
+                row[f'{name}_slope_err'] = response['slopes_err'][g, k]
+            row['ndof'] = int(response['ndof'][g])
+            self.environmental_table.append(row)
+
+        reference = ", ".join(f"{name} = {value:.2f}" for name, value in zip(names, response['reference']))
+        print(f"✅ Corrected the currents to the mean environmental conditions ({reference}).")
+
+    def __fit_profiles(self) -> None:
+        self.profile_fits = lcf.fit_profiles(
+            self.cube.pmt_positions,
+            self.cube.signal,
+            self.cube.signal_err,
+            model=self.params.profile_model,
+            warm_start=self.params.profile_warm_start,
+            processes=self.params.profile_processes
+        )
+
+        names = self.profile_fits['param_names'].tolist()
+        self.profile_table = []
+        for r, revpos in enumerate(self.cube.revolver_positions.tolist()):
+            for w, wl in enumerate(self.cube.wavelengths.tolist()):
+                if self.profile_fits['ndof'][r, w] == 0:
+                    continue
+                params = self.profile_fits['params'][r, w]
+                covariance = self.profile_fits['covariance'][r, w]
+                row = {'revolverpos': revpos, 'wavelength': wl}
+                for i, name in enumerate(names):
+                    row[name] = params[i]
+                    row[f'{name}_err'] = np.sqrt(covariance[i, i])
+                for i, name_i in enumerate(names):
+                    for j in range(i + 1, len(names)):
+                        row[f'cov_{name_i}_{names[j]}'] = covariance[i, j]
+                row['chi2'] = self.profile_fits['chi2'][r, w]
+                row['ndof'] = int(self.profile_fits['ndof'][r, w])
+                row['converged'] = bool(self.profile_fits['converged'][r, w])
+                self.profile_table.append(row)
+
+        n_converged = sum(row['converged'] for row in self.profile_table)
+        print(f"✅ Fitted {len(self.profile_table)} profile(s), {n_converged} converged.")
+
+    def __bootstrap_intervals(self) -> None:
+        # The repeats of each cell are resampled out of the
+        # same rows, and current column, as the cube's
+        accepted = self.LoomSet.accepted()
+        current_column = "current_env" if self.params.environmental_correction else "current"
+
+        no_sample_revpos = self.__no_sample_revpos()
+        result = lcb.bootstrap_integrated(
+            self.cube.cell_index(accepted),
+            accepted.column(current_column),
+            accepted.column(f"{current_column}_std"),
+            self.cube.shape,
+            repeats=self.params.combine_repeats,
+            reference_index=None if no_sample_revpos is None
+            else self.cube.revolver_index(no_sample_revpos),
+            n_resamples=self.params.bootstrap_resamples,
+            confidence=self.params.bootstrap_confidence,
+            seed=self.params.bootstrap_seed,
+            processes=self.params.bootstrap_processes
+        )
+
+        self.integrated_interval = self.__nested_intervals(result, 'integrated')
+        if no_sample_revpos is not None:
+            self.ratio_interval = self.__nested_intervals(result, 'ratio')
+
+        print(f"✅ Bootstrapped {self.params.bootstrap_resamples} resamples.")
+
+    def __nested_intervals(self, result: dict, name: str) -> dict:
+        low = self.cube.as_nested_dict(result[f'{name}_low'])
+        high = self.cube.as_nested_dict(result[f'{name}_high'])
+        return {
+            revpos: {wl: (low[revpos][wl], high[revpos][wl]) for wl in low[revpos]}
+            for revpos in low
+        }
+
+    def __no_sample_revpos(self) -> Optional[int]:
+        no_sample_labels = {
+            self.LoomSet.label_categories[code]
+            for code in self.LoomSet.label_codes_matching("no sample")
+        }
+        return next(
+            (rp for rp, lbl in sorted(self.LoomSet.revolver_labels.items()) if lbl in no_sample_labels),
+            None
+        )
+
+    def __integrate_streamed(self) -> dict:
+        if self.params.combine_repeats == "weighted":
+            print("Warning: The streaming and out-of-core modes do not support weighted repeats. Averaging them instead.")
+
+        key_columns = ('revolverpos', 'wavelength', 'pmtpos')
+        if self.params.out_of_core:
+            reducer = LoomOutOfCoreGrouper(
+                key_columns=key_columns,
+                value_columns=('current',),
+                memory_budget_bytes=int(self.params.memory_budget_mb * 2**20),
+                spill_dir=self.params.spill_dir
+            )
+        else:
+            reducer = LoomStreamingAggregator(key_columns=key_columns, value_columns=('current',))
+
+        for chunk in self.__iter_input_chunks(key_columns + ('current',)):
+            reducer.add_chunk(chunk)
+
+        if self.params.out_of_core:
+            table = reducer.reduce()
+            print(
+                f"✅ Reduced {reducer.n_rows} rows out-of-core "
+                f"({reducer.n_spills} spill(s) to disk)."
+            )
+        else:
+            table = reducer.result()
+            print(
+                f"✅ Aggregated {reducer.n_rows} rows into {reducer.n_groups} "
+                f"scan points (~{reducer.nbytes / 2**10:.1f} kB of accumulators)."
+            )
+
+        # Integrate over the PMT positions
+        per_point = table['current_sum'] if self.params.combine_repeats == "sum" \
+            else table['current_mean']
+        integrated = defaultdict(lambda: defaultdict(float))
+        for revpos, wl, intensity in zip(
+            table['revolverpos'].tolist(),
+            table['wavelength'].tolist(),
+            per_point.tolist()
+        ):
+            integrated[revpos][wl] += intensity
+        return integrated
+
     def plot(self) -> None:
-        if not self.grouped_data:
+        if not self.integrated_by_wavelength:
             raise RuntimeError("No data for plotting. Execute 'analyze()' first.")
 
-        revolver_labels = ru.extract_revolver_labels(self.LoomSet.metadata)
+        if self.params.figure_cache:
+            self.__plot_cached()
+            return
+
+        revolver_labels = self.LoomSet.revolver_labels
 
         # ==================================================
         # 1. FIGURE: Intensity vs PMT position per revolver
         # ==================================================
 
-        # Adjust the subplot grid based on the number of revolvers
-        n_panels = len(self.grouped_data)
-        n_cols = 3
-        n_rows = -(-n_panels // n_cols)
+        if self.cube is not None:
+            # Adjust the subplot grid based on the number of revolvers
+            n_panels = len(self.cube.revolver_positions)
+            n_cols = 3
+            n_rows = -(-n_panels // n_cols)
 
-        fig1, axs = plt.subplots(n_rows, n_cols, figsize=(5 * n_cols, 4 * n_rows), squeeze=False)
+            fig1, axs = plt.subplots(n_rows, n_cols, figsize=(5 * n_cols, 4 * n_rows), squeeze=False)
 
-        for idx, (revolverpos, wavelength) in enumerate(sorted(self.grouped_data.items())):
-            ax = axs[idx // n_cols][idx % n_cols]
-            label = f"Revolver {revolverpos}: {revolver_labels.get(revolverpos, 'Unknown')}"
-            ru.plot_intensities_subplot(ax, wavelength, label)
+            # Repeated measurements are combined into one point
+            # per PMT position, as set by combine_repeats
+            for idx, revolverpos in enumerate(self.cube.revolver_positions.tolist()):
+                ax = axs[idx // n_cols][idx % n_cols]
+                label = f"Revolver {revolverpos}: {revolver_labels.get(revolverpos, 'Unknown')}"
+                self.__draw_intensity_panel(ax, idx, label)
 
-        for idx in range(n_panels, n_rows * n_cols):
-            axs[idx // n_cols][idx % n_cols].axis('off')
+            for idx in range(n_panels, n_rows * n_cols):
+                axs[idx // n_cols][idx % n_cols].axis('off')
 
-        fig1.suptitle("Intensity vs PMT Position per Revolver", fontsize=16)
-        fig1.tight_layout(rect=[0, 0, 1, 0.95])
-        plt.figure(fig1.number)
-        plt.show(block=False)
+            fig1.suptitle("Intensity vs PMT Position per Revolver", fontsize=16)
+            fig1.tight_layout(rect=[0, 0, 1, 0.95])
+            plt.figure(fig1.number)
+            plt.show(block=False)
+        else:
+            print("Streaming or out-of-core mode: skipping the 'Intensity vs PMT Position' figure, which needs the raw rows.")
 
         # ========================================================
         # 2. FIGURA: Intensidad integrada vs longitud de onda
         # ========================================================
-        integrated_by_wavelength = ru.compute_integrated_intensities(self.grouped_data)
+        fig2 = self.__integrated_figure()
+        plt.figure(fig2.number)
+        plt.show(block=False)
+
+        if self.params.time_series_plot:
+            if self.cube is not None:
+                fig4 = self.__time_series_figure()
+                plt.figure(fig4.number)
+                plt.show(block=False)
+            else:
+                print("Streaming or out-of-core mode: skipping the time series figure, which needs the raw rows.")
+
+        # ===================================================
+        # 3. FIGURA: Refelectivity: ratio muestra / no sample
+        # ===================================================
+        if not self.reference_spectrum:
+            print("Warning: No 'No sample' position found in metadata or in the reference library. Skipping reflectivity ratio plot.")
+            plt.show()
+            return
+
+        fig3 = self.__ratio_figure()
+        plt.figure(fig3.number)
+        plt.show(block=False)
 
+        plt.show()
+
+    def __plot_cached(self) -> None:
+        """Writes the figures to the 'figures' folder of the
+        output, rendering only the ones whose inputs changed
+        since the previous run (see LoomFigureCache). Each
+        revolver panel of the first figure is cached on its
+        own, and the figure is assembled from their images."""
+        cache = LoomFigureCache(Path(self.params.output_path) / "figures")
+        revolver_labels = self.LoomSet.revolver_labels
+
+        if self.cube is not None:
+            panel_names = []
+            for idx, revolverpos in enumerate(self.cube.revolver_positions.tolist()):
+                label = f"Revolver {revolverpos}: {revolver_labels.get(revolverpos, 'Unknown')}"
+                name = f"intensity_vs_pmt/revolver_{revolverpos}"
+                cache.render(
+                    name,
+                    lambda idx=idx, label=label: self.__panel_figure(idx, label),
+                    *self.__panel_inputs(idx),
+                    label=label,
+                    intensity_plot=self.params.intensity_plot,
+                    heatmap_scale=self.params.heatmap_scale,
+                    heatmap_per_wavelength=self.params.heatmap_per_wavelength
+                )
+                panel_names.append(name)
+
+            cache.render(
+                "intensity_vs_pmt",
+                lambda: self.__composed_figure(
+                    [cache.file_path(name) for name in panel_names],
+                    "Intensity vs PMT Position per Revolver"
+                ),
+                [cache.key(name) for name in panel_names]
+            )
+        else:
+            print("Streaming or out-of-core mode: skipping the 'Intensity vs PMT Position' figure, which needs the raw rows.")
+
+        cache.render(
+            "integrated_intensity",
+            self.__integrated_figure,
+            self.integrated_by_wavelength,
+            self.integrated_interval,
+            revolver_labels
+        )
+
+        if self.params.time_series_plot:
+            if self.cube is not None:
+                cache.render(
+                    "time_series",
+                    self.__time_series_figure,
+                    *(self.LoomSet.column(name) for name in self.time_series_columns),
+                    downsampling=self.params.time_series_downsampling
+                )
+            else:
+                print("Streaming or out-of-core mode: skipping the time series figure, which needs the raw rows.")
+
+        if self.reference_spectrum:
+            cache.render(
+                "reflectivity_ratio",
+                self.__ratio_figure,
+                self.integrated_by_wavelength,
+                self.reference_spectrum,
+                self.ratio_interval,
+                revolver_labels,
+                self.__no_sample_revpos(),
+                self.reference_source
+            )
+        else:
+            print("Warning: No 'No sample' position found in metadata or in the reference library. Skipping reflectivity ratio plot.")
+
+        print(
+            f"✅ Figures written to '{cache.path}' ({len(cache.rendered)} rendered, "
+            f"{len(cache.reused)} reused since their inputs did not change)."
+        )
+
+    def __panel_inputs(self, idx: int) -> tuple:
+        """The arrays which the panel of the revolver
+        position of the given cube index is drawn from."""
+        inputs = (
+            self.cube.pmt_positions,
+            self.cube.wavelengths,
+            self.cube.signal[idx],
+            self.cube.signal_err[idx],
+            self.cube.count[idx]
+        )
+        if self.profile_fits:
+            inputs += (
+                self.profile_fits['model'],
+                self.profile_fits['params'][idx],
+                self.profile_fits['converged'][idx]
+            )
+        return inputs
+
+    def __draw_intensity_panel(self, ax, idx: int, label: str) -> None:
+        if self.params.intensity_plot == "heatmap":
+            has_data = self.cube.count[idx] > 0
+            pmt_grid, wavelength_grid = np.meshgrid(self.cube.pmt_positions, self.cube.wavelengths)
+            ru.plot_intensity_heatmap_subplot(
+                ax,
+                pmt_grid[has_data],
+                wavelength_grid[has_data],
+                self.cube.signal[idx][has_data],
+                label,
+                scale=self.params.heatmap_scale,
+                per_wavelength=self.params.heatmap_per_wavelength
+            )
+        else:
+            ru.plot_cube_intensities_subplot(ax, self.cube, idx, label, self.profile_fits)
+
+    def __panel_figure(self, idx: int, label: str):
+        fig, ax = plt.subplots(figsize=(5, 4))
+        self.__draw_intensity_panel(ax, idx, label)
+        fig.tight_layout()
+        return fig
+
+    @staticmethod
+    def __composed_figure(panel_paths: List[Path], title: str):
+        """Figure which lays out the given panel images in
+        the grid of the first figure, without drawing any
+        of their data again."""
+        n_cols = 3
+        n_rows = -(-len(panel_paths) // n_cols)
+        fig, axs = plt.subplots(n_rows, n_cols, figsize=(5 * n_cols, 4 * n_rows), squeeze=False)
+        for idx in range(n_rows * n_cols):
+            ax = axs[idx // n_cols][idx % n_cols]
+            ax.axis('off')
+            if idx < len(panel_paths):
+                ax.imshow(plt.imread(panel_paths[idx]))
+        fig.suptitle(title, fontsize=16)
+        fig.tight_layout(rect=[0, 0, 1, 0.95])
+        return fig
+
+    def __integrated_figure(self):
+        revolver_labels = self.LoomSet.revolver_labels
         fig2, ax2 = plt.subplots(figsize=(10, 6))
 
         # integrated_by_wavelength: {revpos: {wavelength: integrated_intensity}}
-        for revpos, wavelength_to_intensity in sorted(integrated_by_wavelength.items()):
+        for revpos, wavelength_to_intensity in sorted(self.integrated_by_wavelength.items()):
             wavelengths = sorted(wavelength_to_intensity.keys())
             integrated_intensities = [wavelength_to_intensity[wl] for wl in wavelengths]
             label = f"Revolver {revpos}: {revolver_labels.get(revpos, 'Unknown')}"
-            ax2.plot(wavelengths, integrated_intensities, marker='o', label=label)
+            ax2.errorbar(
+                wavelengths,
+                integrated_intensities,
+                yerr=ru.interval_to_yerr(
+                    integrated_intensities,
+                    self.integrated_interval.get(revpos),
+                    wavelengths
+                ),
+                marker='o',
+                capsize=3,
+                label=label
+            )
 
         ax2.set_title("Integrated Intensity vs Wavelength")
         ax2.set_xlabel("Wavelength (nm)")
@@ -122,41 +989,114 @@ class Analysis1(LoomAnalysis):
         ax2.legend()
         ax2.grid(True)
         fig2.tight_layout()
-        plt.figure(fig2.number)
-        plt.show(block=False)
+        return fig2
 
-        # ===================================================
-        # 3. FIGURA: Refelectivity: ratio muestra / no sample
-        # ===================================================
-        no_sample_revpos = next((rp for rp, lbl in revolver_labels.items() if "no sample" in lbl.lower()), None)
-        if no_sample_revpos is None:
-            print("Warning: No 'No sample' position found in metadata. Skipping reflectivity ratio plot.")
-            return
+    # Columns of the time series figure, with the
+    # y axis label of each, drawn against unixtime
+    time_series_columns = {
+        'unixtime': None,
+        'current': "Current (A)",
+        'temperature': "Temperature (ºC)",
+        'humidity': "Humidity (%)"
+    }
+
+    def __time_series_figure(self):
+        """Figure with the current, temperature and humidity
+        of every row against its unixtime, one panel each,
+        downsampled to the resolution of the axes (see
+        ru.plot_time_series_subplot())."""
+        names = [name for name, label in self.time_series_columns.items() if label is not None]
+        fig4, axs = plt.subplots(len(names), 1, figsize=(10, 2.5 * len(names)), sharex=True)
+        unixtime = self.LoomSet.column('unixtime')
+
+        for ax, name in zip(axs, names):
+            values = self.LoomSet.column(name)
+            if np.isnan(values).all():
+                ax.text(0.5, 0.5, "Not measured", ha='center', va='center', transform=ax.transAxes)
+            else:
+                ru.plot_time_series_subplot(
+                    ax,
+                    unixtime,
+                    values,
+                    method=self.params.time_series_downsampling,
+                    linewidth=0.8
+                )
+            ax.set_ylabel(self.time_series_columns[name])
+            ax.grid(True)
+
+        axs[0].set_title("Time Series of the Run")
+        axs[-1].set_xlabel("Unix Time (s)")
+        fig4.tight_layout()
+        return fig4
+
+    def __ratio_figure(self):
+        revolver_labels = self.LoomSet.revolver_labels
+        no_sample_revpos = self.__no_sample_revpos()
+        reference = self.reference_spectrum
 
         fig3, ax3 = plt.subplots(figsize=(10, 6))
-        for revpos, wl_data in sorted(integrated_by_wavelength.items()):
+        for revpos, wl_data in sorted(self.integrated_by_wavelength.items()):
             if revpos == no_sample_revpos:
                 continue  # Skip "no sample"
 
-            common_wavelengths = sorted(set(wl_data) & set(integrated_by_wavelength[no_sample_revpos]))
+            common_wavelengths = sorted(set(wl_data) & set(reference))
             ratios = [
-                wl_data[wl] / integrated_by_wavelength[no_sample_revpos][wl]
-                if integrated_by_wavelength[no_sample_revpos][wl] != 0 else 0
+                wl_data[wl] / reference[wl] if reference[wl] != 0 else 0
                 for wl in common_wavelengths
             ]
             label = f"Revolver {revpos}: {revolver_labels.get(revpos, 'Unknown')}"
-            ax3.plot(common_wavelengths, ratios, marker='o', label=label)
+            ax3.errorbar(
+                common_wavelengths,
+                ratios,
+                yerr=ru.interval_to_yerr(
+                    ratios,
+                    self.ratio_interval.get(revpos),
+                    common_wavelengths
+                ),
+                marker='o',
+                capsize=3,
+                label=label
+            )
 
-        ax3.set_title("Reflectivity Ratio (Sample / No Sample) vs Wavelength")
+        ax3.set_title(f"Reflectivity Ratio (Sample / No Sample) vs Wavelength\nReference: {self.reference_source}")
         ax3.set_xlabel("Wavelength (nm)")
         ax3.set_ylabel("Ratio")
         ax3.legend()
         ax3.grid(True)
         fig3.tight_layout()
-        plt.figure(fig3.number)
-        plt.show(block=False)
-
-        plt.show()
+        return fig3
 
     def write_output(self) -> bool:
+        self.__store_reference()
+        if self.environmental_table:
+            output_path = Path(self.params.output_path)
+            output_path.mkdir(parents=True, exist_ok=True)
+            lcs.write_summary_table(self.environmental_table, output_path / "environmental_response.csv")
+            print(f"✅ Wrote the environmental response to '{output_path / 'environmental_response.csv'}'.")
+        if self.profile_table:
+            output_path = Path(self.params.output_path)
+            output_path.mkdir(parents=True, exist_ok=True)
+            lcs.write_summary_table(self.profile_table, output_path / "profile_fits.csv")
+            print(f"✅ Wrote the profile fits to '{output_path / 'profile_fits.csv'}'.")
+        quarantine = self.__quarantine_table()
+        if quarantine:
+            output_path = Path(self.params.output_path)
+            output_path.mkdir(parents=True, exist_ok=True)
+            lcs.write_summary_table(quarantine, output_path / "quarantine.csv")
+            print(f"✅ Wrote {len(quarantine)} quarantined line(s) to '{output_path / 'quarantine.csv'}'.")
         return True
+
+    def __quarantine_table(self) -> List[dict]:
+        """One row per malformed line of the .txt inputs,
+        with its file, line number, reason and text."""
+        if self.txt_reader is None:
+            return []
+        if isinstance(self.txt_reader, LoomTxtMultiReader):
+            reports = list(self.txt_reader.validation_reports.values())
+        else:
+            reports = [self.txt_reader.validation_report]
+        return [
+            {'file': report['file'], **entry}
+            for report in reports
+            for entry in report['quarantine']
+        ]
@@ -0,0 +1,323 @@
+import os
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterator, List, Literal, Optional
+from pydantic import Field
+import matplotlib.pyplot as plt
+
+from LOOM.src.data_classes.LoomAnalysis import LoomInputParams, LoomAnalysis
+from LOOM.src.data_classes.LoomTxtReader import LoomTxtReader
+from LOOM.src.data_classes.LoomSet import LoomSet
+from LOOM.src.data_classes.LoomDatasetStore import LoomDatasetStore
+from LOOM.src.data_classes.LoomOutOfCoreGrouper import LoomOutOfCoreGrouper
+from LOOM.src.data_classes.LoomTrendMatrix import LoomTrendMatrix
+from LOOM.src.data_classes.LoomReferenceLibrary import LoomReferenceLibrary
+import LOOM.src.core.grouping as lcg
+import LOOM.src.core.sweep as lcs
+
+class StabilityTrend(LoomAnalysis):
+    """Tracks the drift of a reference sample across many runs.
+    Each run (one input file, or one run of a dataset store) is
+    reduced to its integrated intensity by wavelength,
+    optionally divided by the one of the 'No sample' revolver
+    position of the same run, through a header scan plus a
+    streaming reduction, so that no run is ever fully loaded.
+    The results are stacked into a LoomTrendMatrix, which is
+    persisted in the output folder, so that subsequent
+    executions only reduce the new (or modified) runs. The
+    matrix is rebuilt from scratch if the processing options
+    changed since it was persisted. Input
+    files are identified by their absolute path, so that runs
+    with the same file name in different folders are kept
+    apart."""
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def get_input_params_model(
+        cls
+    ) -> type:
+        """Implements the LoomAnalysis.get_input_params_model()
+        abstract method. Returns the InputParams class, which is a
+        Pydantic model class that defines the input parameters for
+        this analysis.
+        Returns
+        -------
+        type
+            The InputParams class, which is a Pydantic model class
+        """
+        class InputParams(LoomInputParams):
+            input_path: List[str] = Field(
+                default_factory=list,
+                description="List of input .txt file paths, one per run. "
+                "Ignored if store_path is given"
+            )
+            output_path: str = Field(
+                default="output",
+                description="Path to the output folder"
+            )
+            sample_label: str = Field(
+                default="sample",
+                description="Pattern which identifies the reference sample "
+                "among the revolver labels of each run, case-insensitively. "
+                "Labels which match 'no sample' are never taken."
+            )
+            normalize_to_no_sample: bool = Field(
+                default=True,
+                description="Whether to divide the integrated intensity of "
+                "the sample by the one of the 'No sample' revolver position "
+                "of the same run. Runs with no such position are skipped."
+            )
+            combine_repeats: Literal["sum", "mean"] = Field(
+                default="mean",
+                description="How repeated measurements at the same scan point "
+                "are combined before integrating over the PMT positions"
+            )
+            trend_file: str = Field(
+                default="stability_trend.npz",
+                description="Name of the file, within the output folder, "
+                "where the runs x wavelength matrix is persisted"
+            )
+            rolling_window: int = Field(
+                default=5,
+                ge=1,
+                description="Number of runs of the rolling drift statistics"
+            )
+            memory_budget_mb: float = Field(
+                default=64.,
+                gt=0.,
+                description="Memory budget, in MB, of the streaming reduction "
+                "of each run"
+            )
+        return InputParams
+
+    def initialize(self, input_parameters: LoomInputParams) -> None:
+        self.params = input_parameters
+        self.trend: Optional[LoomTrendMatrix] = None
+        self.statistics = {}
+        # The dataset store of the runs, if store_path is given
+        self.store: Optional[LoomDatasetStore] = None
+        # Runs which need to be reduced, as (path, fingerprint),
+        # or as (run_id, fingerprint) if they come from the store
+        self.pending_runs = []
+
+    def read_input(self) -> bool:
+        input_paths = getattr(self.params, 'input_path', None)
+
+        if self.params.store_path is not None:
+            if not Path(self.params.store_path).is_dir():
+                raise ValueError(f"'store_path' must be an existing LOOM dataset store, but got '{self.params.store_path}'.")
+            self.store = LoomDatasetStore(self.params.store_path)
+        elif not input_paths:
+            raise ValueError("'input_path' must be a non-empty list of file paths.")
+
+        options_hash = LoomReferenceLibrary.options_hash(self.__processing_options())
+        self.trend = LoomTrendMatrix.load(self.__trend_path())
+        if len(self.trend) > 0 and self.trend.options_hash != options_hash:
+            print(
+                "Warning: The runs of the trend file were reduced with other "
+                "processing options. Reducing every run again."
+            )
+            self.trend = LoomTrendMatrix()
+        self.trend.options_hash = options_hash
+
+        # Only the new or modified runs are reduced
+        self.pending_runs = []
+        if self.store is not None:
+            for run_id in self.store.run_ids(self.params.store_runs):
+                fingerprint = self.store.fingerprint(run_id)
+                if not self.trend.has_run(run_id, fingerprint):
+                    self.pending_runs.append((run_id, fingerprint))
+        else:
+            for path in input_paths:
+                stat = os.stat(path)
+                fingerprint = f"{stat.st_size}:{int(stat.st_mtime)}"
+                if not self.trend.has_run(self.__run_id(path), fingerprint):
+                    self.pending_runs.append((path, fingerprint))
+
+        print(
+            f"✅ Loaded {len(self.trend)} run(s) from the trend file. "
+            f"{len(self.pending_runs)} run(s) to be reduced."
+        )
+        return True
+
+    def analyze(self) -> bool:
+        if self.trend is None:
+            raise RuntimeError("No data. Execute first 'read_input()'.")
+
+        columns = ('unixtime', 'revolverpos', 'wavelength', 'pmtpos', 'current')
+        for run, fingerprint in self.pending_runs:
+            if self.store is not None:
+                run_id = run
+                metadata = self.store.run(run_id).metadata
+                chunks = self.store.run(run_id).iter_chunks(columns)
+            else:
+                run_id = self.__run_id(run)
+                reader = LoomTxtReader(run)
+                metadata = reader.read_metadata()
+                chunks = reader.iter_chunks(columns=columns)
+
+            reduced = self.__reduce_run(run_id, metadata, chunks)
+            if reduced is None:
+                continue
+            time, wavelengths, values = reduced
+            self.trend.add_run(run_id, time, wavelengths, values, fingerprint)
+
+        if len(self.trend) > 0:
+            self.statistics = self.trend.rolling_statistics(self.params.rolling_window)
+
+        return True
+
+    def __reduce_run(
+        self,
+        run_id: str,
+        metadata: dict,
+        chunks: Iterator[Dict[str, np.ndarray]]
+    ) -> Optional[tuple]:
+        labels = LoomSet.parse_revolver_labels(metadata)
+
+        pattern = self.params.sample_label.lower()
+        sample_revpos = next(
+            (rp for rp, lbl in sorted(labels.items())
+             if pattern in lbl.lower() and "no sample" not in lbl.lower()),
+            None
+        )
+        no_sample_revpos = next(
+            (rp for rp, lbl in sorted(labels.items()) if "no sample" in lbl.lower()),
+            None
+        )
+
+        if sample_revpos is None or (self.params.normalize_to_no_sample and no_sample_revpos is None):
+            print(f"Warning: Skipping '{run_id}', whose ScanInfo lacks the sample or the 'No sample' position.")
+            return None
+
+        wanted = [sample_revpos] if not self.params.normalize_to_no_sample \
+            else [sample_revpos, no_sample_revpos]
+
+        grouper = LoomOutOfCoreGrouper(
+            key_columns=('revolverpos', 'wavelength', 'pmtpos'),
+            value_columns=('current',),
+            memory_budget_bytes=int(self.params.memory_budget_mb * 2**20)
+        )
+        start_time = np.inf
+        for chunk in chunks:
+            start_time = min(start_time, np.nanmin(chunk['unixtime'], initial=np.inf))
+            selected = np.isin(chunk['revolverpos'], wanted)
+            grouper.add_chunk({name: values[selected] for name, values in chunk.items()})
+
+        table = grouper.reduce()
+        per_point = table['current_sum'] if self.params.combine_repeats == "sum" \
+            else table['current_mean']
+
+        # Integrate over the PMT positions
+        keys, codes = lcg.factorize([table['revolverpos'], table['wavelength']])
+        integrated = np.bincount(codes, weights=per_point, minlength=len(keys[0]))
+
+        wavelengths = np.unique(keys[1])
+        def spectrum(revpos: int) -> np.ndarray:
+            values = np.full(len(wavelengths), np.nan)
+            of_revpos = keys[0] == revpos
+            values[np.searchsorted(wavelengths, keys[1][of_revpos])] = integrated[of_revpos]
+            return values
+
+        values = spectrum(sample_revpos)
+        if self.params.normalize_to_no_sample:
+            reference = spectrum(no_sample_revpos)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = np.where(reference != 0, values / reference, np.nan)
+
+        print(f"✅ Reduced '{run_id}' ({grouper.n_rows} rows).")
+        return start_time, wavelengths, values
+
+    def plot(self) -> None:
+        if not self.statistics:
+            raise RuntimeError("No data for plotting. Execute 'analyze()' first.")
+
+        trend = self.trend
+        days = (trend.times - trend.times.min()) / 86400.
+        quantity = "Reflectivity ratio" if self.params.normalize_to_no_sample \
+            else "Integrated Intensity (A)"
+
+        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 6))
+
+        for j, wl in enumerate(trend.wavelengths.tolist()):
+            has_value = ~np.isnan(trend.values[:, j])
+            ax1.plot(days[has_value], trend.values[has_value, j], marker='o', label=f"{wl:.0f} nm")
+        ax1.set_title("Stability Trend")
+        ax1.set_xlabel("Days since the first run")
+        ax1.set_ylabel(quantity)
+        ax1.legend(fontsize='x-small', loc='best')
+        ax1.grid(True)
+
+        drift = 100. * self.statistics['drift']
+        limit = np.nanmax(np.abs(drift)) if np.isfinite(drift).any() else 1.
+        image = ax2.imshow(
+            drift.T,
+            aspect='auto',
+            origin='lower',
+            cmap='coolwarm',
+            vmin=-limit,
+            vmax=limit,
+            extent=(-0.5, len(trend) - 0.5, -0.5, len(trend.wavelengths) - 0.5)
+        )
+        ax2.set_yticks(range(len(trend.wavelengths)))
+        ax2.set_yticklabels([f"{wl:.0f}" for wl in trend.wavelengths.tolist()])
+        ax2.set_title(f"Drift from the previous {self.params.rolling_window} run(s)")
+        ax2.set_xlabel("Run")
+        ax2.set_ylabel("Wavelength (nm)")
+        fig.colorbar(image, ax=ax2, label="Drift (%)")
+
+        fig.tight_layout()
+        plt.figure(fig.number)
+        plt.show()
+
+    def write_output(self) -> bool:
+        if self.trend is None or len(self.trend) == 0:
+            return True
+
+        output_path = Path(self.params.output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+        self.trend.save(self.__trend_path())
+
+        table = []
+        for i, run_id in enumerate(self.trend.run_ids):
+            for j, wl in enumerate(self.trend.wavelengths.tolist()):
+                table.append({
+                    'run': run_id,
+                    'unixtime': self.trend.times[i],
+                    'wavelength': wl,
+                    'value': self.trend.values[i, j],
+                    'rolling_mean': self.statistics['mean'][i, j],
+                    'rolling_std': self.statistics['std'][i, j],
+                    'drift': self.statistics['drift'][i, j]
+                })
+        lcs.write_summary_table(table, output_path / "stability_trend.csv")
+
+        print(f"✅ Wrote the trend of {len(self.trend)} run(s) to '{output_path}'.")
+        return True
+
+    def get_summary(self) -> dict:
+        if not self.statistics:
+            return {}
+        slopes = self.statistics['slope_per_day']
+        return {
+            'n_runs': len(self.trend),
+            'max_abs_slope_per_day': float(np.nanmax(np.abs(slopes))) if np.isfinite(slopes).any() else np.nan
+        }
+
+    def __processing_options(self) -> dict:
+        """The parameters which change the reduced values
+        of a run."""
+        return {
+            'sample_label': self.params.sample_label,
+            'normalize_to_no_sample': self.params.normalize_to_no_sample,
+            'combine_repeats': self.params.combine_repeats
+        }
+
+    @staticmethod
+    def __run_id(path: str) -> str:
+        return str(Path(path).resolve())
+
+    def __trend_path(self) -> Path:
+        return Path(self.params.output_path) / self.params.trend_file
@@ -1,20 +1,26 @@
+import numpy as np
+from LOOM.src.data_classes.LoomSet import LoomSet
+import LOOM.src.core.profile_fitting as lcf
+
 def extract_revolver_labels(metadata: dict) -> dict:
     """
     Returns a dictionary mapping each revolver position (revpos) to its corresponding label.
     If multiple labels exist for the same revpos, only the first occurrence is kept.
+    Metadata of merged LoomSets, which is nested per filename, is also accepted. In that
+    case, the ScanInfo of every file is honoured, in order.
+
+    Note that LoomSet.revolver_labels caches this result per LoomSet, and should be
+    preferred when a LoomSet is available.
     """
-    labels = {}
+    if "ScanInfo" in metadata:
+        return LoomSet.parse_revolver_labels(metadata)
 
-    scan_info = metadata.get("ScanInfo", [])
-    for entry in scan_info:
-        if not isinstance(entry, dict):
+    labels = {}
+    for file_metadata in metadata.values():
+        if not isinstance(file_metadata, dict):
             continue
-        revpos = entry.get("Rev.Pos")
-        label = entry.get("Label")
-        if revpos is not None and label is not None:
-            revpos_int = int(revpos)
-            if revpos_int not in labels:
-                labels[revpos_int] = label.strip()
+        for revpos, label in LoomSet.parse_revolver_labels(file_metadata).items():
+            labels.setdefault(revpos, label)
 
     return labels
 
@@ -34,6 +40,267 @@ def plot_intensities_subplot(ax, wavelength_groups, rev_label):
     if len(set(x)) > 6:
         ax.tick_params(axis='x', rotation=45)
 
+def plot_cube_intensities_subplot(ax, cube, revolver_index, rev_label, profile_fits=None):
+    """
+    Same as plot_intensities_subplot(), but it takes the points from a LoomCube, so that
+    repeated measurements are drawn as one combined point per PMT position, with the
+    propagated uncertainty of the dark-current-subtracted signal as error bar. If the
+    output of LOOM.src.core.profile_fitting.fit_profiles() is given, the fitted peak of
+    each wavelength is drawn as a dashed line.
+    """
+    x = cube.pmt_positions
+    y = cube.signal[revolver_index]
+    y_err = cube.signal_err[revolver_index]
+    has_data = cube.count[revolver_index] > 0
+
+    for i, wl in enumerate(cube.wavelengths):
+        mask = has_data[i]
+        if not mask.any():
+            continue
+        points = ax.errorbar(x[mask], y[i][mask], yerr=y_err[i][mask], fmt='o-', label=f"{wl:.0f} nm")
+
+        if profile_fits and profile_fits['converged'][revolver_index, i]:
+            model = lcf.PEAK_MODELS[profile_fits['model']][1]
+            x_fine = np.linspace(x.min(), x.max(), 200)
+            fitted, _ = model(x_fine, profile_fits['params'][revolver_index, i])
+            ax.plot(x_fine, fitted, '--', color=points[0].get_color())
+
+    ax.set_title(f"{rev_label}")
+    ax.set_xlabel("PMT Position (º)")
+    ax.set_ylabel("Intensity (A)")
+    ax.grid(True)
+    ax.legend(fontsize='x-small', loc='best')
+    if len(x) > 6:
+        ax.tick_params(axis='x', rotation=45)
+
+def bin_intensity_image(pmtpos, wavelength, values, pmt_bins=None, wavelength_bins=None):
+    """
+    Bins scattered (pmtpos, wavelength, value) points into a dense wavelength x PMT
+    position image, whose pixels hold the mean of the values which fall in them, with
+    histogram2d() instead of a loop over the points. Pixels with no point are NaN.
+
+    Args:
+        pmtpos, wavelength, values: 1D arrays of the same length. Non-finite values
+            are ignored.
+        pmt_bins, wavelength_bins: The number of equal-width bins of each axis. If None,
+            each distinct position (or wavelength) gets its own bin, whose edges lie
+            halfway to its neighbours, so that a regular scan maps one point per pixel.
+
+    Returns:
+        (image, pmt_edges, wavelength_edges), where image has shape
+        (len(wavelength_edges) - 1, len(pmt_edges) - 1).
+    """
+    pmtpos = np.asarray(pmtpos, dtype=float).ravel()
+    wavelength = np.asarray(wavelength, dtype=float).ravel()
+    values = np.asarray(values, dtype=float).ravel()
+    valid = np.isfinite(pmtpos) & np.isfinite(wavelength) & np.isfinite(values)
+    pmtpos, wavelength, values = pmtpos[valid], wavelength[valid], values[valid]
+
+    pmt_edges = _bin_edges(pmtpos, pmt_bins)
+    wavelength_edges = _bin_edges(wavelength, wavelength_bins)
+
+    sums, _, _ = np.histogram2d(wavelength, pmtpos, bins=(wavelength_edges, pmt_edges), weights=values)
+    counts, _, _ = np.histogram2d(wavelength, pmtpos, bins=(wavelength_edges, pmt_edges))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        image = np.where(counts > 0, sums / counts, np.nan)
+    return image, pmt_edges, wavelength_edges
+
+def _bin_edges(values, n_bins=None):
+    """Edges of the bins of bin_intensity_image() along one axis."""
+    if len(values) == 0:
+        return np.array([0., 1.])
+    if n_bins is not None:
+        low, high = values.min(), values.max()
+        if low == high:
+            low, high = low - 0.5, high + 0.5
+        return np.linspace(low, high, n_bins + 1)
+
+    centers = np.unique(values)
+    if len(centers) == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    middles = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate((
+        [centers[0] - (middles[0] - centers[0])],
+        middles,
+        [centers[-1] + (centers[-1] - middles[-1])]
+    ))
+
+def plot_intensity_heatmap_subplot(ax, pmtpos, wavelength, values, rev_label, scale='linear',
+                                   per_wavelength=False, pmt_bins=None, wavelength_bins=None):
+    """
+    Alternative to plot_intensities_subplot() for dense scans: the points of one revolver
+    position are binned into a wavelength x PMT position image (see bin_intensity_image())
+    and drawn as a single pcolormesh artist with a colour bar, so that the rendering time
+    does not grow with the number of wavelengths.
+
+    Args:
+        ax: The matplotlib axes.
+        pmtpos, wavelength, values: 1D arrays of the points of the revolver position.
+        rev_label: The title of the panel.
+        scale: 'linear' or 'log' colour scale. The log scale only shows positive values.
+        per_wavelength: Whether each wavelength is divided by its maximum, so that the
+            shape of the profiles is comparable across the spectrum.
+        pmt_bins, wavelength_bins: See bin_intensity_image().
+
+    Returns:
+        The QuadMesh artist.
+    """
+    import matplotlib.colors as mcolors
+
+    image, pmt_edges, wavelength_edges = bin_intensity_image(
+        pmtpos, wavelength, values, pmt_bins, wavelength_bins
+    )
+    label = "Intensity (A)"
+    if per_wavelength:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            peak = np.nanmax(np.where(np.isnan(image), -np.inf, image), axis=1, keepdims=True)
+            image = np.where(peak > 0, image / peak, np.nan)
+        label = "Intensity / wavelength maximum"
+
+    norm = None
+    if scale == 'log':
+        positive = image[image > 0]
+        image = np.where(image > 0, image, np.nan)
+        if positive.size:
+            norm = mcolors.LogNorm(vmin=positive.min(), vmax=positive.max())
+
+    mesh = ax.pcolormesh(pmt_edges, wavelength_edges, np.ma.masked_invalid(image), norm=norm, shading='flat')
+    ax.figure.colorbar(mesh, ax=ax, label=label)
+
+    ax.set_title(f"{rev_label}")
+    ax.set_xlabel("PMT Position (º)")
+    ax.set_ylabel("Wavelength (nm)")
+    if len(pmt_edges) > 7:
+        ax.tick_params(axis='x', rotation=45)
+    return mesh
+
+def axes_pixel_width(ax) -> int:
+    """
+    Returns the width, in pixels, of the given matplotlib axes, as set by the figure
+    size, its dpi and the position of the axes. It is the resolution which the
+    downsampling functions pick by default, since more points per pixel are not visible.
+    """
+    return max(int(np.ceil(ax.get_window_extent().width)), 1)
+
+def _sorted_finite(x, y):
+    """Drops the non-finite points, and sorts the rest by x if needed."""
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.all():
+        x, y = x[finite], y[finite]
+    if len(x) > 1 and (np.diff(x) < 0).any():
+        order = np.argsort(x, kind='stable')
+        x, y = x[order], y[order]
+    return x, y
+
+def downsample_minmax(x, y, n_buckets):
+    """
+    Min/max-per-pixel downsampling: the x range is split into n_buckets buckets of equal
+    width (one per pixel column), and the points with the minimum and the maximum y of
+    each bucket are kept, in x order. Spikes and the envelope of the signal are kept
+    exactly, and the output has, at most, 2 * n_buckets points. Vectorized: the cost is
+    linear in the number of points.
+
+    Args:
+        x, y: 1D arrays. Non-finite points are dropped, and unsorted x is sorted.
+        n_buckets: The number of buckets, p.e. axes_pixel_width(ax).
+
+    Returns:
+        (x, y) of the kept points.
+    """
+    x, y = _sorted_finite(x, y)
+    if len(x) <= 2 * n_buckets:
+        return x, y
+
+    span = x[-1] - x[0]
+    buckets = np.minimum(((x - x[0]) / span * n_buckets).astype(np.int64), n_buckets - 1) \
+        if span > 0 else np.zeros(len(x), dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    bucket_index = np.cumsum(np.r_[False, buckets[1:] != buckets[:-1]])
+
+    # First point which reaches the extreme of its bucket
+    kept = []
+    for reduce in (np.minimum, np.maximum):
+        extreme = reduce.reduceat(y, starts)
+        hits = np.flatnonzero(y == extreme[bucket_index])
+        _, first = np.unique(bucket_index[hits], return_index=True)
+        kept.append(hits[first])
+
+    kept = np.unique(np.concatenate(kept))
+    return x[kept], y[kept]
+
+def downsample_lttb(x, y, n_out):
+    """
+    Largest-triangle-three-buckets downsampling: the first and last points are kept, and
+    the rest are split into n_out - 2 buckets of equal count, from each of which the point
+    forming the largest triangle with the previously kept point and the mean of the next
+    bucket is kept. It preserves the visual shape of the curve with exactly n_out points.
+    The choice of each bucket depends on the previous one, so the loop runs over the
+    buckets, while the areas within each bucket are vectorized.
+
+    Args:
+        x, y: 1D arrays. Non-finite points are dropped, and unsorted x is sorted.
+        n_out: The number of output points, p.e. axes_pixel_width(ax). At least 3.
+
+    Returns:
+        (x, y) of the kept points.
+    """
+    x, y = _sorted_finite(x, y)
+    n_out = max(int(n_out), 3)
+    if len(x) <= n_out:
+        return x, y
+
+    edges = np.linspace(1, len(x) - 1, n_out - 1).astype(np.int64)
+    # Mean of every bucket, and of the last point as the bucket after the last one
+    counts = np.diff(edges)
+    mean_x = np.r_[np.add.reduceat(x[1:-1], edges[:-1] - 1) / counts, x[-1]]
+    mean_y = np.r_[np.add.reduceat(y[1:-1], edges[:-1] - 1) / counts, y[-1]]
+
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, len(x) - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        areas = np.abs(
+            (x[previous] - mean_x[i + 1]) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (mean_y[i + 1] - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        kept[i + 1] = previous
+
+    return x[kept], y[kept]
+
+def plot_time_series_subplot(ax, x, y, method='minmax', resolution=None, **kwargs):
+    """
+    Plots y against x (p.e. the raw current, temperature or humidity of a LoomSet against
+    its unixtime) with ax.plot(), after downsampling them to the resolution of the axes,
+    so that any number of points is drawn in bounded time.
+
+    Args:
+        ax: The matplotlib axes, whose figure size and position are already set.
+        x, y: 1D arrays, p.e. loom_set.column('unixtime') and loom_set.column('current').
+        method: 'minmax' (see downsample_minmax()), 'lttb' (see downsample_lttb()) or
+            None, to plot every point.
+        resolution: The number of buckets (for 'minmax') or points (for 'lttb'). If None,
+            the pixel width of the axes (see axes_pixel_width()).
+        **kwargs: Given to ax.plot().
+
+    Returns:
+        The Line2D artists returned by ax.plot().
+    """
+    if resolution is None:
+        resolution = axes_pixel_width(ax)
+
+    if method == 'minmax':
+        x, y = downsample_minmax(x, y, resolution)
+    elif method == 'lttb':
+        x, y = downsample_lttb(x, y, resolution)
+    elif method is not None:
+        raise ValueError(f"Unknown downsampling method '{method}'. It must be 'minmax', 'lttb' or None.")
+
+    return ax.plot(x, y, **kwargs)
+
 def compute_integrated_intensities(grouped_data) -> dict:
     """
     Computes the integrated intensity for each wavelength in the grouped data.
@@ -47,4 +314,30 @@ def compute_integrated_intensities(grouped_data) -> dict:
     for revpos, wavelengths in grouped_data.items():
         for wl, rows in wavelengths.items():
             integrated[revpos][wl] = sum(r.current for r in rows)
-    return integrated
\ No newline at end of file
+    return integrated
+
+
+def interval_to_yerr(values, intervals, x):
+    """
+    Converts the confidence intervals of the given values into the
+    asymmetric yerr argument of matplotlib's errorbar().
+
+    Args:
+        values: The plotted values, one per entry of x.
+        intervals: {x: (low, high)}, or None if there are no intervals.
+        x: The plotted abscissae.
+
+    Returns:
+        None if intervals is None, otherwise a (2, len(x)) list of the
+        lower and upper error bar lengths. Abscissae with no interval get
+        no error bar.
+    """
+    if intervals is None:
+        return None
+
+    lower, upper = [], []
+    for value, xi in zip(values, x):
+        low, high = intervals.get(xi, (value, value))
+        lower.append(max(value - low, 0.))
+        upper.append(max(high - value, 0.))
+    return [lower, upper]
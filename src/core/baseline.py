@@ -0,0 +1,127 @@
+# src/core/baseline.py
+
+import numpy as np
+from typing import Dict, Optional
+
+import LOOM.src.exceptions as le
+import LOOM.src.core.grouping as lcg
+
+def binned_baseline(
+    time: np.ndarray,
+    values: np.ndarray,
+    errors: Optional[np.ndarray] = None,
+    window: float = 60.,
+    method: str = 'median'
+) -> Dict[str, np.ndarray]:
+    """This function smooths the given values as a function of
+    time, by splitting the time axis into consecutive windows
+    of the given width and reducing the values of each window
+    into one knot. Every window is reduced at once, through
+    one sort of the time column, so that the cost is
+    O(n log n). The resulting knots are meant to be linearly
+    interpolated by interpolate_baseline().
+
+    Parameters
+    ----------
+    time: np.ndarray
+        The time of each value, p.e. the unixtime column
+    values: np.ndarray
+        The values to be smoothed, p.e. the dc column. NaN
+        values are left out.
+    errors: None or np.ndarray
+        The standard deviation of each value. It is only used
+        by the 'mean' method. If None, the values are weighted
+        uniformly.
+    window: float
+        The width of each time window, in the units of time
+    method: str
+        Either 'median', which is robust against spikes, or
+        'mean', which takes the inverse-variance weighted mean
+        of each window
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        A dictionary which maps 'time' to the mean time of the
+        values of each knot, sorted increasingly, 'value' to
+        the knot values, 'err' to their uncertainties and
+        'count' to the number of values of each knot. Windows
+        with no value give no knot.
+    """
+
+    if method not in ('median', 'mean') or not window > 0:
+        raise le.IncompatibleInput(
+            le.GenerateExceptionMessage(
+                1,
+                'binned_baseline()',
+                reason=f"The method must be either 'median' or 'mean', "
+                f"and the window must be positive, but got '{method}' "
+                f"and {window}."
+            )
+        )
+
+    time = np.asarray(time, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    errors = np.ones_like(values) if errors is None \
+        else np.asarray(errors, dtype=np.float64)
+
+    valid = ~np.isnan(values) & ~np.isnan(time)
+    time, values, errors = time[valid], values[valid], errors[valid]
+
+    if len(time) == 0:
+        empty = np.zeros(0)
+        return {'time': empty, 'value': empty, 'err': empty, 'count': np.zeros(0, dtype=np.int64)}
+
+    window_index = np.floor((time - time.min()) / window).astype(np.int64)
+    _, codes = lcg.factorize([window_index])
+    n_knots = int(codes.max()) + 1
+
+    count = np.bincount(codes, minlength=n_knots)
+    knot_time = np.bincount(codes, weights=time, minlength=n_knots) / count
+    weighted = lcg.weighted_group_means(codes, n_knots, values, errors)
+
+    if method == 'mean':
+        value, err = weighted['mean'], weighted['err']
+    else:
+        value = lcg.group_medians(codes, n_knots, values)
+        # Asymptotic efficiency of the median for
+        # normally distributed values
+        err = np.sqrt(np.pi / 2.) * weighted['err']
+
+    return {'time': knot_time, 'value': value, 'err': err, 'count': count}
+
+def interpolate_baseline(
+    time: np.ndarray,
+    knots: Dict[str, np.ndarray]
+) -> Dict[str, np.ndarray]:
+    """This function evaluates the given baseline knots, as
+    returned by binned_baseline(), at the given times, by
+    linear interpolation over the whole time column at once.
+    Times outside the range of the knots take the value of
+    the closest knot.
+
+    Parameters
+    ----------
+    time: np.ndarray
+        The times at which the baseline is evaluated
+    knots: Dict[str, np.ndarray]
+        The output of binned_baseline()
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        A dictionary which maps 'value' and 'err' to the
+        interpolated baseline and uncertainty at each time.
+        They are NaN if there are no knots.
+    """
+
+    time = np.asarray(time, dtype=np.float64)
+
+    if len(knots['time']) == 0:
+        missing = np.full(len(time), np.nan)
+        return {'value': missing, 'err': missing.copy()}
+
+    return {
+        'value': np.interp(time, knots['time'], knots['value']),
+        'err': np.interp(time, knots['time'], knots['err'])
+    }
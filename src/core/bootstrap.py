@@ -0,0 +1,283 @@
+# src/core/bootstrap.py
+
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import LOOM.src.exceptions as le
+import LOOM.src.core.grouping as lcg
+
+# Number of drawn rows which are reduced at once
+__BLOCK_ELEMENTS = 2 ** 16
+
+def bootstrap_integrated(
+    cells: np.ndarray,
+    values: np.ndarray,
+    errors: np.ndarray,
+    shape: Tuple[int, int, int],
+    repeats: str = 'mean',
+    reference_index: Optional[int] = None,
+    n_resamples: int = 1000,
+    confidence: float = 0.68,
+    seed: int = 0,
+    batch_size: int = 250,
+    processes: int = 1
+) -> Dict[str, np.ndarray]:
+    """This function estimates the uncertainty of the integrated
+    intensities of a scan, and of their ratios to a reference
+    revolver position, by resampling the repeated measurements
+    of every (revolver, wavelength, PMT position) cell. Each
+    resample draws, with replacement, as many rows as the cell
+    has out of its own rows, for every cell at once, combines
+    them as the nominal integral does (see repeats), and
+    integrates the cells over the PMT positions. Cells with a
+    single measurement can not be resampled, so their value is
+    drawn from a normal distribution with its error as standard
+    deviation instead.
+
+    The resamples are split into batches of batch_size, and
+    each batch draws from its own random stream, spawned from
+    the given seed. Therefore, the result only depends on seed,
+    n_resamples and batch_size, and not on the number of
+    processes among which the batches are spread.
+
+    Parameters
+    ----------
+    cells: np.ndarray
+        The flat index, within the (R, W, P) cube, of the
+        cell of each row, p.e. the output of
+        LoomCube.cell_index(). Rows with a negative index
+        are left out.
+    values: np.ndarray
+        The value of each row, p.e. its current
+    errors: np.ndarray
+        The standard deviation of each value. It weights the
+        'weighted' combination, and it is the spread of the
+        cells with a single measurement. Non-finite errors
+        are taken as 0 for the latter.
+    shape: Tuple[int, int, int]
+        The (R, W, P) shape of the cube
+    repeats: str
+        How the rows of each cell are combined before being
+        integrated: 'sum' adds every row, 'mean' averages
+        them and 'weighted' takes their inverse-variance
+        weighted mean, as the combine_repeats parameter of
+        the reflectivity analysis does.
+    reference_index: None or int
+        If given, the index, along the first axis, of the
+        revolver position which the ratios are computed to
+        (p.e. the 'No sample' one)
+    n_resamples: int
+        The number of bootstrap resamples
+    confidence: float
+        The probability covered by the confidence intervals,
+        which are the central percentiles of the resamples
+    seed: int
+        The seed of the random streams
+    batch_size: int
+        The number of resamples per batch. The resamples of a
+        batch are drawn at once, so the memory is proportional
+        to batch_size times the number of rows plus R*W*P.
+    processes: int
+        The number of worker processes among which the batches
+        are spread. If it is 1, they are run in this process.
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        A dictionary which maps 'integrated' to the (R, W)
+        array of nominal integrated intensities, and
+        'integrated_low', 'integrated_high' and 'integrated_std'
+        to the bounds of their confidence intervals and to
+        their bootstrap standard deviations. If reference_index
+        is given, it also contains the same four entries for
+        the 'ratio' to the reference revolver position. Entries
+        with no measurement at all are NaN.
+    """
+
+    cells = np.asarray(cells, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    errors = np.asarray(errors, dtype=np.float64)
+
+    if len(shape) != 3 or cells.shape != values.shape or values.shape != errors.shape:
+        raise le.IncompatibleInput(
+            le.GenerateExceptionMessage(
+                1,
+                'bootstrap_integrated()',
+                reason="The cells, values and errors must be arrays of the "
+                f"same length, and shape must be (R, W, P), but got "
+                f"{cells.shape}, {values.shape}, {errors.shape} and {shape}."
+            )
+        )
+
+    if n_resamples < 1 or batch_size < 1 or processes < 1 \
+        or not 0. < confidence < 1. or repeats not in ('sum', 'mean', 'weighted'):
+
+        raise le.IncompatibleInput(
+            le.GenerateExceptionMessage(
+                2,
+                'bootstrap_integrated()',
+                reason="n_resamples, batch_size and processes must be "
+                ">= 1, confidence must lie within (0, 1), and repeats "
+                "must be 'sum', 'mean' or 'weighted'."
+            )
+        )
+
+    # Rows sorted by cell, so that the rows of each
+    # cell are the range [start, start + count)
+    used = (cells >= 0) & ~np.isnan(values)
+    order = np.argsort(cells[used], kind='stable')
+    rows = {
+        'cells': cells[used][order],
+        'values': values[used][order],
+        'errors': errors[used][order],
+        'shape': tuple(shape),
+        'repeats': repeats
+    }
+    n_cells = int(np.prod(shape))
+    count = np.bincount(rows['cells'], minlength=n_cells)
+    rows['count'] = count[rows['cells']]
+    rows['start'] = (np.cumsum(count) - count)[rows['cells']]
+    rows['weights'] = 1. / np.square(
+        lcg.fill_invalid_errors(rows['cells'], n_cells, rows['errors'])
+    )
+
+    empty = count.reshape(shape).sum(axis=2) == 0
+    nominal = __integrate(rows, rows['values'], rows['weights'])
+
+    n_batches = -(-n_resamples // batch_size)
+    streams = np.random.SeedSequence(seed).spawn(n_batches)
+    tasks = [
+        (rows, min(batch_size, n_resamples - i * batch_size), stream)
+        for i, stream in enumerate(streams)
+    ]
+
+    processes = min(processes, n_batches)
+    if processes == 1:
+        batches = [__draw_integrated_batch(*task) for task in tasks]
+    else:
+        context = multiprocessing.get_context(
+            'fork' if 'fork' in multiprocessing.get_all_start_methods()
+            else None
+        )
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+            batches = list(executor.map(__draw_integrated_batch_unpacked, tasks))
+
+    # (n_resamples, R, W)
+    samples = np.concatenate(batches)
+    samples[:, empty] = np.nan
+    nominal[empty] = np.nan
+
+    result = {'integrated': nominal}
+    result.update(__summarize('integrated', samples, confidence))
+
+    if reference_index is not None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            nominal_ratio = np.where(
+                nominal[reference_index] != 0,
+                nominal / nominal[reference_index],
+                np.nan
+            )
+            sample_ratios = samples / samples[:, reference_index][:, np.newaxis]
+        sample_ratios[~np.isfinite(sample_ratios)] = np.nan
+
+        result['ratio'] = nominal_ratio
+        result.update(__summarize('ratio', sample_ratios, confidence))
+
+    return result
+
+def __summarize(
+    name: str,
+    samples: np.ndarray,
+    confidence: float
+) -> Dict[str, np.ndarray]:
+    """Central confidence interval and standard deviation
+    of the given (n_resamples, ...) samples, along the
+    first axis. Entries with no finite sample are NaN."""
+
+    tail = 50. * (1. - confidence)
+    no_samples = np.isnan(samples).all(axis=0)
+    # Keep nanpercentile and nanstd away from all-NaN slices
+    filled = np.where(no_samples, 0., samples)
+
+    # The NaN-aware reductions are much slower, so they
+    # are only used if some samples are actually missing
+    if np.isnan(filled).any():
+        low, high = np.nanpercentile(filled, [tail, 100. - tail], axis=0)
+        std = np.nanstd(filled, axis=0)
+    else:
+        low, high = np.percentile(filled, [tail, 100. - tail], axis=0)
+        std = filled.std(axis=0)
+
+    for array in (low, high, std):
+        array[no_samples] = np.nan
+
+    return {f'{name}_low': low, f'{name}_high': high, f'{name}_std': std}
+
+def __integrate(
+    rows: Dict[str, np.ndarray],
+    values: np.ndarray,
+    weights: np.ndarray
+) -> np.ndarray:
+    """Combines the given values of the rows of each cell, as
+    set by rows['repeats'], and integrates them over the PMT
+    positions, into an (R, W) array. If values and weights
+    are (n, rows) arrays of n resamples, they are reduced
+    together, over (resample, cell) keys, into an (n, R, W)
+    array."""
+
+    shape = rows['shape']
+    n_cells = int(np.prod(shape))
+    stacked = values.ndim == 2
+    n = len(values) if stacked else 1
+    keys = (np.arange(n)[:, np.newaxis] * n_cells + rows['cells']).ravel()
+    values = values.ravel()
+    weights = weights.ravel()
+
+    if rows['repeats'] == 'sum':
+        combined = np.bincount(keys, weights=values, minlength=n * n_cells)
+    elif rows['repeats'] == 'mean':
+        combined = np.bincount(keys, weights=values, minlength=n * n_cells) \
+            / np.maximum(np.bincount(keys, minlength=n * n_cells), 1)
+    else:
+        weight_sum = np.bincount(keys, weights=weights, minlength=n * n_cells)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            combined = np.bincount(keys, weights=weights * values, minlength=n * n_cells) / weight_sum
+        combined[weight_sum == 0] = 0.
+
+    integrated = combined.reshape((n,) + shape).sum(axis=3)
+    return integrated if stacked else integrated[0]
+
+def __draw_integrated_batch_unpacked(task: tuple) -> np.ndarray:
+    return __draw_integrated_batch(*task)
+
+def __draw_integrated_batch(
+    rows: Dict[str, np.ndarray],
+    n: int,
+    stream: np.random.SeedSequence
+) -> np.ndarray:
+    """Draws n resamples of every (R, W) integral, from the
+    given random stream. The rows of every cell are redrawn
+    for all the resamples as one (n, rows) index matrix,
+    which is taken from the stream, and reduced, in blocks
+    of resamples, so that its temporaries fit in cache."""
+
+    rng = np.random.default_rng(stream)
+    single = rows['count'] == 1
+    spread = np.where(np.isfinite(rows['errors']), rows['errors'], 0.)[single]
+    # Drawn before the index matrix, so that its blocks
+    # are the same numbers as a single draw would be
+    noise = spread * rng.standard_normal((n, int(single.sum())))
+
+    n_rows = len(rows['cells'])
+    block = max(1, min(n, __BLOCK_ELEMENTS // max(n_rows, 1)))
+    samples = np.empty((n,) + rows['shape'][:2])
+    for first in range(0, n, block):
+        size = min(block, n - first)
+        drawn = (rng.random((size, n_rows)) * rows['count']).astype(np.int64)
+        drawn += rows['start']
+        values = rows['values'][drawn]
+        values[:, single] += noise[first:first + size]
+        samples[first:first + size] = __integrate(rows, values, rows['weights'][drawn])
+    return samples
@@ -0,0 +1,725 @@
+# src/core/grouping.py
+
+import math
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import LOOM.src.exceptions as le
+
+def factorize(
+    keys: Sequence[np.ndarray]
+) -> Tuple[List[np.ndarray], np.ndarray]:
+    """This function gets one or more key columns of the same
+    length and assigns an integer group code to each row, so
+    that two rows share a code if, and only if, they share the
+    value of every key column. The groups are sorted
+    lexicographically, with the first key column being the
+    most significant one.
+
+    Parameters
+    ----------
+    keys: Sequence[np.ndarray]
+        The key columns
+
+    Returns
+    ----------
+    unique_keys: List[np.ndarray]
+        The key values of each group, one array per key
+        column. The length of each array is the number
+        of groups.
+    codes: np.ndarray
+        The group code of each row
+    """
+
+    keys = [np.asarray(k) for k in keys]
+    n = len(keys[0])
+
+    if n == 0:
+        return [k[:0] for k in keys], np.zeros(0, dtype=np.intp)
+
+    # np.lexsort sorts by the last key first
+    order = np.lexsort(keys[::-1])
+
+    new_group = np.zeros(n, dtype=bool)
+    new_group[0] = True
+    for k in keys:
+        sorted_k = k[order]
+        new_group[1:] |= sorted_k[1:] != sorted_k[:-1]
+
+    sorted_codes = np.cumsum(new_group) - 1
+    codes = np.empty(n, dtype=np.intp)
+    codes[order] = sorted_codes
+
+    starts = order[new_group]
+    return [k[starts] for k in keys], codes
+
+def segment_bounds(
+    codes: np.ndarray,
+    n_groups: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """This function returns the permutation which sorts
+    the rows by group code (stably), and the position, within
+    the sorted rows, at which each group starts. Both can be
+    used with np.ufunc.reduceat() to run reductions for every
+    group at once. Every group is assumed to be non-empty.
+
+    Parameters
+    ----------
+    codes: np.ndarray
+        The group code of each row, as returned by factorize()
+    n_groups: int
+        The number of groups
+
+    Returns
+    ----------
+    order: np.ndarray
+    starts: np.ndarray
+    """
+
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return order, starts
+
+def group_moments(
+    codes: np.ndarray,
+    n_groups: int,
+    values: np.ndarray
+) -> Dict[str, np.ndarray]:
+    """This function computes, for every group at once, the
+    count, sum, sum of squared deviations from the mean (m2),
+    minimum and maximum of the given values. These moments
+    can be merged across partial results by
+    combine_moments().
+
+    Parameters
+    ----------
+    codes: np.ndarray
+        The group code of each row, as returned by factorize()
+    n_groups: int
+        The number of groups
+    values: np.ndarray
+        The value of each row
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        A dictionary with the 'count', 'sum', 'm2', 'min'
+        and 'max' keys, each one mapping to an array with
+        one entry per group
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    count = np.bincount(codes, minlength=n_groups)
+    total = np.bincount(codes, weights=values, minlength=n_groups)
+    mean = total / np.maximum(count, 1)
+    m2 = np.bincount(
+        codes,
+        weights=(values - mean[codes]) ** 2,
+        minlength=n_groups
+    )
+
+    if len(values) == 0:
+        empty = np.zeros(n_groups)
+        return {'count': count, 'sum': total, 'm2': m2, 'min': empty, 'max': empty}
+
+    order, starts = segment_bounds(codes, n_groups)
+    sorted_values = values[order]
+
+    return {
+        'count': count,
+        'sum': total,
+        'm2': m2,
+        'min': np.minimum.reduceat(sorted_values, starts),
+        'max': np.maximum.reduceat(sorted_values, starts)
+    }
+
+def combine_moments(
+    codes: np.ndarray,
+    n_groups: int,
+    count: np.ndarray,
+    total: np.ndarray,
+    m2: np.ndarray,
+    minimum: np.ndarray,
+    maximum: np.ndarray
+) -> Dict[str, np.ndarray]:
+    """This function merges partial moments, as returned by
+    group_moments(), which were computed over disjoint subsets
+    of the rows. Each entry of the input arrays is a partial
+    result, and codes gives the group into which it must be
+    merged. The m2 values are combined with the pairwise
+    formula by Chan et al., which avoids the cancellation
+    that a plain sum of squares would suffer.
+
+    Parameters
+    ----------
+    codes: np.ndarray
+        The output group of each partial result
+    n_groups: int
+        The number of output groups
+    count, total, m2, minimum, maximum: np.ndarray
+        The partial moments
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        The merged moments, with the same keys as the
+        output of group_moments()
+    """
+
+    merged_count = np.bincount(codes, weights=count, minlength=n_groups)
+    merged_total = np.bincount(codes, weights=total, minlength=n_groups)
+    merged_mean = merged_total / np.maximum(merged_count, 1)
+    partial_mean = total / np.maximum(count, 1)
+    merged_m2 = np.bincount(
+        codes,
+        weights=m2 + count * (partial_mean - merged_mean[codes]) ** 2,
+        minlength=n_groups
+    )
+
+    order, starts = segment_bounds(codes, n_groups)
+
+    return {
+        'count': merged_count.astype(np.int64),
+        'sum': merged_total,
+        'm2': merged_m2,
+        'min': np.minimum.reduceat(np.asarray(minimum)[order], starts),
+        'max': np.maximum.reduceat(np.asarray(maximum)[order], starts)
+    }
+
+def group_moment_table(
+    columns: Dict[str, np.ndarray],
+    key_columns: Sequence[str],
+    value_columns: Sequence[str]
+) -> Dict[str, np.ndarray]:
+    """This function reduces the given rows into a table of
+    per-group moments, which is the partial result which the
+    streaming and out-of-core reductions keep and merge.
+
+    Parameters
+    ----------
+    columns: Dict[str, np.ndarray]
+        The key and value columns of the rows
+    key_columns: Sequence[str]
+        The columns which define the groups
+    value_columns: Sequence[str]
+        The columns whose moments are computed
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        A table which maps each key column, 'count' (int64),
+        and, for each value column v, 'v_sum', 'v_m2', 'v_min'
+        and 'v_max' (see group_moments()), to an array with
+        one entry per group. Groups are sorted by key.
+    """
+
+    unique_keys, codes = factorize([columns[name] for name in key_columns])
+    n_groups = len(unique_keys[0])
+
+    table = dict(zip(key_columns, unique_keys))
+    table['count'] = np.bincount(codes, minlength=n_groups).astype(np.int64)
+    for name in value_columns:
+        moments = group_moments(codes, n_groups, columns[name])
+        del moments['count']
+        for moment, values in moments.items():
+            table[f'{name}_{moment}'] = values
+
+    return table
+
+def merge_moment_tables(
+    tables: Sequence[Dict[str, np.ndarray]],
+    key_columns: Sequence[str],
+    value_columns: Sequence[str]
+) -> Dict[str, np.ndarray]:
+    """This function merges the given tables of partial
+    moments, as returned by group_moment_table(), into one,
+    through combine_moments(). Groups which appear in several
+    tables are combined, and the rest are kept as they are.
+
+    Parameters
+    ----------
+    tables: Sequence[Dict[str, np.ndarray]]
+        The tables to be merged
+    key_columns, value_columns: Sequence[str]
+        See group_moment_table()
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        The merged table, in the same format
+    """
+
+    merged_input = {k: np.concatenate([t[k] for t in tables]) for k in tables[0]}
+    unique_keys, codes = factorize([merged_input[name] for name in key_columns])
+    n_groups = len(unique_keys[0])
+
+    table = dict(zip(key_columns, unique_keys))
+    for name in value_columns:
+        moments = combine_moments(
+            codes,
+            n_groups,
+            merged_input['count'],
+            merged_input[f'{name}_sum'],
+            merged_input[f'{name}_m2'],
+            merged_input[f'{name}_min'],
+            merged_input[f'{name}_max']
+        )
+        # Counts are merged as bincount weights, so they
+        # are cast back to integers
+        table['count'] = moments.pop('count').astype(np.int64, copy=False)
+        for moment, values in moments.items():
+            table[f'{name}_{moment}'] = values
+
+    return table
+
+def finalize_moment_table(
+    table: Optional[Dict[str, np.ndarray]],
+    key_columns: Sequence[str],
+    value_columns: Sequence[str]
+) -> Dict[str, np.ndarray]:
+    """This function turns a table of partial moments, as
+    returned by group_moment_table(), into the reduced table
+    of the streaming and out-of-core reductions: the 'v_m2'
+    columns are replaced by 'v_mean' and 'v_var' (the unbiased
+    variance, NaN for groups with less than 2 values). If
+    table is None, an empty reduced table is returned. The
+    given table is not modified."""
+
+    if table is None:
+        table = {name: np.zeros(0) for name in key_columns}
+        table['count'] = np.zeros(0, dtype=np.int64)
+        for name in value_columns:
+            for moment in ('sum', 'm2', 'min', 'max'):
+                table[f'{name}_{moment}'] = np.zeros(0)
+
+    reduced = {k: v for k, v in table.items() if not k.endswith('_m2')}
+    count = table['count']
+    for name in value_columns:
+        reduced[f'{name}_mean'] = table[f'{name}_sum'] / np.maximum(count, 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            reduced[f'{name}_var'] = np.where(count > 1, table[f'{name}_m2'] / (count - 1), np.nan)
+    return reduced
+
+def weighted_group_means(
+    codes: np.ndarray,
+    n_groups: int,
+    values: np.ndarray,
+    errors: np.ndarray
+) -> Dict[str, np.ndarray]:
+    """This function combines the values of each group into
+    their inverse-variance weighted mean, for every group at
+    once. Values whose error is not positive and finite (p.e.
+    a missing or 0 standard deviation) are given the largest
+    valid error of their group (see fill_invalid_errors()),
+    so that they neither dominate nor get discarded.
+
+    Parameters
+    ----------
+    codes: np.ndarray
+        The group code of each row. Empty groups are allowed.
+    n_groups: int
+        The number of groups
+    values: np.ndarray
+        The value of each row
+    errors: np.ndarray
+        The standard deviation of each value
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        A dictionary with the following keys, each one mapping
+        to an array with one entry per group:
+            - 'mean': the weighted mean. NaN for empty groups.
+            - 'err': the uncertainty of the weighted mean,
+            1/sqrt(sum of weights). NaN for empty groups.
+            - 'count': the number of values
+            - 'chi2': the chi-squared of the values with
+            respect to the weighted mean, whose number of
+            degrees of freedom is count - 1. NaN for empty
+            groups.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    errors = np.asarray(errors, dtype=np.float64)
+
+    weights = 1. / np.square(fill_invalid_errors(codes, n_groups, errors))
+
+    count = np.bincount(codes, minlength=n_groups)
+    weight_sum = np.bincount(codes, weights=weights, minlength=n_groups)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(codes, weights=weights * values, minlength=n_groups) / weight_sum
+        err = 1. / np.sqrt(weight_sum)
+        chi2 = np.bincount(
+            codes,
+            weights=weights * np.square(values - mean[codes]),
+            minlength=n_groups
+        )
+
+    empty = count == 0
+    mean[empty] = np.nan
+    err[empty] = np.nan
+    chi2 = np.where(empty, np.nan, chi2)
+
+    return {'mean': mean, 'err': err, 'count': count, 'chi2': chi2}
+
+def fill_invalid_errors(
+    codes: np.ndarray,
+    n_groups: int,
+    errors: np.ndarray
+) -> np.ndarray:
+    """Replaces the errors which are not positive and finite
+    by the largest valid error of their group, or of the whole
+    input for groups with no valid error, or by 1 if there is
+    no valid error at all. The largest error gives the least
+    weight among the valid ones, so that the values with an
+    unknown error never dominate their group."""
+
+    valid = np.isfinite(errors) & (errors > 0)
+    if valid.all():
+        return errors
+
+    fallback = errors[valid].max() if valid.any() else 1.
+    group_max = np.full(n_groups, -np.inf)
+    np.maximum.at(group_max, codes[valid], errors[valid])
+    group_max[~np.isfinite(group_max)] = fallback
+
+    return np.where(valid, errors, group_max[codes])
+
+def clip_outliers(
+    codes: np.ndarray,
+    n_groups: int,
+    values: np.ndarray,
+    method: str = 'mad',
+    nsigma: float = 3.5,
+    max_iters: int = 5,
+    min_count: int = 5
+) -> np.ndarray:
+    """This function runs an iterative outlier rejection within
+    every group at once. At each iteration, the center and the
+    scale of the values which are still accepted are computed
+    per group, and the values which lie too far from the center,
+    in units of the scale, are rejected. Iterations stop when
+    no new value is rejected, or after max_iters.
+
+    The scale of a small group is itself uncertain, so a flat
+    nsigma threshold would reject a large fraction of clean
+    values. Instead, the threshold of each group is the critical
+    value of a Student's t distribution with the same two-sided
+    tail probability as nsigma has for a normal distribution
+    (see student_t_critical()). It tends to nsigma for large
+    groups.
+
+    Parameters
+    ----------
+    codes: np.ndarray
+        The group code of each row. Empty groups are allowed.
+    n_groups: int
+        The number of groups
+    values: np.ndarray
+        The value of each row. NaN values are always rejected.
+    method: str
+        Either 'sigma', for which the center and scale of each
+        value are the mean and the standard deviation of the
+        rest of the accepted values of its group (leave-one-out,
+        since a value which takes part in its own statistics
+        can never lie further than (n - 1) / sqrt(n) standard
+        deviations from their mean), or 'mad', for which they
+        are the median and the median absolute deviation
+        (scaled by 1.4826, so that it matches the standard
+        deviation of normally distributed values). 'mad' is
+        robust to the very outliers it is meant to reject.
+        The 'sigma' threshold has count - 2 degrees of freedom,
+        and the 'mad' one (count - 1) // 2, since the median
+        absolute deviation of normally distributed values is
+        about half as efficient as their standard deviation.
+        Values whose scale is 0 (p.e. a median absolute
+        deviation of 0, when most values of a group are
+        equal) are never rejected, since any deviation would
+        lie infinitely far away.
+    nsigma: float
+        The rejection threshold for large groups, in units of
+        the scale
+    max_iters: int
+        The maximum number of iterations
+    min_count: int
+        Groups with less accepted values than this are left
+        untouched, since their scale is too uncertain for any
+        value to stand out. It is at least 3 for the 'sigma'
+        method, so that the rest of the values of the group
+        have a standard deviation.
+
+    Returns
+    ----------
+    rejected: np.ndarray
+        Boolean array which is True for the rejected rows
+    """
+
+    if method not in ('sigma', 'mad'):
+        raise le.IncompatibleInput(
+            le.GenerateExceptionMessage(
+                1,
+                'clip_outliers()',
+                reason=f"Unknown clipping method '{method}'. It must "
+                "be either 'sigma' or 'mad'."
+            )
+        )
+
+    values = np.asarray(values, dtype=np.float64)
+    rejected = np.isnan(values)
+
+    for _ in range(max_iters):
+        accepted = ~rejected
+        count = np.bincount(codes, weights=accepted, minlength=n_groups)
+
+        if method == 'sigma':
+            kept_values = np.where(accepted, values, 0.)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.bincount(codes, weights=kept_values, minlength=n_groups) / count
+                deviation = np.where(accepted, values - mean[codes], 0.)
+                squares = np.bincount(codes, weights=deviation ** 2, minlength=n_groups)
+                # Statistics of the rest of the group of each
+                # value, from the ones of the whole group
+                n = count[codes]
+                distance = np.abs(deviation) * n / (n - 1)
+                # The distance to the mean of the rest of the group
+                # also carries the uncertainty of that mean
+                scale = np.sqrt(
+                    np.maximum(squares[codes] - deviation ** 2 * n / (n - 1), 0.)
+                    / (n - 2) * n / (n - 1)
+                )
+            clippable = (count >= max(min_count, 3))[codes] & accepted
+            dof = np.maximum(count - 2, 1)
+        else:
+            center = _group_medians(codes, n_groups, values, accepted, count)
+            distance = np.abs(values - center[codes])
+            scale = 1.4826 * _group_medians(codes, n_groups, distance, accepted, count)[codes]
+            clippable = (count >= max(min_count, 2))[codes] & accepted
+            dof = np.maximum((count - 1) // 2, 1)
+
+        threshold = student_t_critical(nsigma, dof.astype(np.int64))[codes]
+        with np.errstate(invalid='ignore'):
+            outliers = clippable & (scale > 0) & (distance > threshold * scale)
+
+        if not outliers.any():
+            break
+        rejected |= outliers
+
+    return rejected
+
+def student_t_critical(nsigma: float, dof: np.ndarray) -> np.ndarray:
+    """This function computes the critical values of Student's t
+    distributions with the given (integer) degrees of freedom,
+    which have the same two-sided tail probability as nsigma has
+    for a normal distribution. They are found by bisection on
+    the closed form of the distribution function for integer
+    degrees of freedom, once per distinct value of dof.
+
+    Parameters
+    ----------
+    nsigma: float
+        The threshold of the normal distribution
+    dof: np.ndarray
+        The degrees of freedom, which must be >= 1
+
+    Returns
+    ----------
+    np.ndarray
+        The critical value for each entry of dof
+    """
+
+    dof = np.asarray(dof, dtype=np.int64)
+    tail = math.erfc(nsigma / math.sqrt(2.))
+    critical = np.empty(dof.shape)
+
+    for value in np.unique(dof).tolist():
+        low, high = 0., max(nsigma, 1.)
+        while _student_t_tail(high, value) > tail:
+            high *= 2.
+        for _ in range(100):
+            middle = 0.5 * (low + high)
+            if _student_t_tail(middle, value) > tail:
+                low = middle
+            else:
+                high = middle
+        critical[dof == value] = high
+
+    return critical
+
+def _student_t_tail(t: float, dof: int) -> float:
+    """Two-sided tail probability, P(|T| > t), of a Student's t
+    distribution with integer degrees of freedom, through the
+    finite series of Abramowitz & Stegun 26.7.3 and 26.7.4."""
+
+    theta = math.atan(t / math.sqrt(dof))
+    cos2 = math.cos(theta) ** 2
+    # Ratios of consecutive terms of the series
+    if dof % 2 == 1:
+        k = np.arange(3, dof - 1, 2)
+        terms = math.cos(theta) * np.cumprod(cos2 * (k - 1) / k) if dof > 1 else np.zeros(0)
+        series = (math.cos(theta) if dof > 1 else 0.) + terms.sum()
+        inside = 2. / math.pi * (theta + math.sin(theta) * series)
+    else:
+        k = np.arange(2, dof - 1, 2)
+        inside = math.sin(theta) * (1. + np.cumprod(cos2 * (k - 1) / k).sum())
+    return 1. - inside
+
+def group_medians(
+    codes: np.ndarray,
+    n_groups: int,
+    values: np.ndarray
+) -> np.ndarray:
+    """This function computes the median of the values of every
+    group at once, through one lexicographic sort. NaN values
+    are left out.
+
+    Parameters
+    ----------
+    codes: np.ndarray
+        The group code of each row. Empty groups are allowed.
+    n_groups: int
+        The number of groups
+    values: np.ndarray
+        The value of each row
+
+    Returns
+    ----------
+    np.ndarray
+        The median of each group. NaN for groups with no
+        (non-NaN) value.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    accepted = ~np.isnan(values)
+    count = np.bincount(codes, weights=accepted, minlength=n_groups)
+    return _group_medians(codes, n_groups, values, accepted, count)
+
+def _group_medians(
+    codes: np.ndarray,
+    n_groups: int,
+    values: np.ndarray,
+    accepted: np.ndarray,
+    count: np.ndarray
+) -> np.ndarray:
+    """Median of the accepted values of every group at once,
+    through one lexicographic sort. NaN for groups with no
+    accepted value."""
+
+    # Rejected values are sorted to the end of their group
+    order = np.lexsort((np.where(accepted, values, np.inf), codes))
+    sorted_values = values[order]
+
+    group_starts = np.concatenate(
+        ([0], np.cumsum(np.bincount(codes, minlength=n_groups))[:-1])
+    )
+    k = count.astype(np.int64)
+    has_values = k > 0
+
+    low = group_starts + np.maximum(k - 1, 0) // 2
+    high = group_starts + k // 2
+    low = np.minimum(low, len(values) - 1)
+    high = np.minimum(high, len(values) - 1)
+
+    medians = np.full(n_groups, np.nan)
+    if len(values) > 0:
+        medians[has_values] = 0.5 * (
+            sorted_values[low[has_values]] + sorted_values[high[has_values]]
+        )
+    return medians
+
+def grouped_linear_fit(
+    codes: np.ndarray,
+    n_groups: int,
+    y: np.ndarray,
+    X: np.ndarray,
+    errors: Optional[np.ndarray] = None
+) -> Dict[str, np.ndarray]:
+    """This function fits the linear model y = X @ beta, by
+    weighted least squares, within every group at once. The
+    normal equations of every group are accumulated with one
+    bincount per entry, and solved as one stack of small
+    matrices. Rank-deficient groups (p.e. a regressor which
+    is constant within the group, once centered) get the
+    minimum-norm solution, through a pseudo-inverse.
+
+    Parameters
+    ----------
+    codes: np.ndarray
+        The group code of each row. Empty groups are allowed.
+    n_groups: int
+        The number of groups
+    y: np.ndarray
+        The (n,) response. Rows with a NaN response are
+        left out.
+    X: np.ndarray or np.ma.MaskedArray
+        The (n, p) design matrix. Rows with any masked or
+        NaN entry are left out.
+    errors: None or np.ndarray
+        The standard deviation of each response. If None,
+        every row is weighted uniformly. Errors which are not
+        positive and finite are given the largest valid error
+        of their group, among the rows which enter the fit.
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        A dictionary with the following keys:
+            - 'coefficients': the (n_groups, p) fitted beta
+            - 'covariance': the (n_groups, p, p) covariance of
+            beta, scaled by the reduced chi-squared of each
+            group, so that it does not rely on the scale of
+            the given errors
+            - 'chi2', 'ndof', 'count': the weighted chi-squared,
+            the number of degrees of freedom and the number of
+            rows which entered each fit
+        Groups with no more rows than coefficients get NaN
+        coefficients and covariance.
+    """
+
+    y = np.asarray(y, dtype=np.float64)
+    mask = np.ma.getmaskarray(X).any(axis=1) if np.ma.isMaskedArray(X) \
+        else np.zeros(len(y), dtype=bool)
+    X = np.ma.getdata(X).astype(np.float64)
+    p = X.shape[1]
+
+    used = ~mask & ~np.isnan(y) & ~np.isnan(X).any(axis=1)
+    codes, y, X = codes[used], y[used], X[used]
+
+    if errors is None:
+        weights = np.ones_like(y)
+    else:
+        errors = np.asarray(errors, dtype=np.float64)[used]
+        weights = 1. / np.square(fill_invalid_errors(codes, n_groups, errors))
+
+    count = np.bincount(codes, minlength=n_groups)
+    xtx = np.empty((n_groups, p, p))
+    xty = np.empty((n_groups, p))
+    for i in range(p):
+        xty[:, i] = np.bincount(codes, weights=weights * X[:, i] * y, minlength=n_groups)
+        for j in range(i, p):
+            xtx[:, i, j] = np.bincount(codes, weights=weights * X[:, i] * X[:, j], minlength=n_groups)
+            xtx[:, j, i] = xtx[:, i, j]
+
+    inverse = np.linalg.pinv(xtx)
+    coefficients = np.einsum('gij,gj->gi', inverse, xty)
+
+    residuals = y - np.einsum('ni,ni->n', X, coefficients[codes])
+    chi2 = np.bincount(codes, weights=weights * residuals ** 2, minlength=n_groups)
+    ndof = count - p
+
+    fitted = ndof > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = inverse * (chi2 / ndof)[:, np.newaxis, np.newaxis]
+
+    coefficients[~fitted] = np.nan
+    covariance[~fitted] = np.nan
+    chi2 = np.where(fitted, chi2, np.nan)
+
+    return {
+        'coefficients': coefficients,
+        'covariance': covariance,
+        'chi2': chi2,
+        'ndof': np.maximum(ndof, 0),
+        'count': count
+    }
@@ -3,6 +3,7 @@
 import pathlib
 import argparse # To handle command line arguments
 import LOOM.src.core.utils as lcu
+import LOOM.src.core.sweep as lcs
 import LOOM.src.exceptions as le
 
 def main():
@@ -15,7 +16,11 @@ def main():
     - Parses command-line arguments (global and analysis-specific).
     - Dynamically imports and instantiates analysis classes.
     - Validates input parameters via each analysis’s parameter model.
-    - Executes analyses sequentially.
+    - Executes analyses sequentially. Analysis stages with a
+    'sweep' sub-key in the steering file are expanded into
+    one independent run per sweep point, which are executed
+    in a process pool, and whose results are collated into
+    the 'output/sweep_summary_<stage>.csv' table.
 
     Exceptions are raised if these conditions are not met.
     
@@ -103,6 +108,17 @@ def main():
             verbose = args.verbose
         )
 
+        if 'sweep' in analyses[i]:
+            lcs.run_sweep(
+                locals()[analyses[i]['name']],
+                parameters_to_deliver,
+                analyses[i]['sweep'],
+                # Relative to the output folder of the sweep
+                summary_path = pathlib.Path(f"sweep_summary_{i+1}.csv"),
+                verbose = args.verbose
+            )
+            continue
+
         # This ensures all required parameters are present and correctly typed.
         validated_parameters = \
             locals()[analyses[i]['name']].get_input_params_model()(
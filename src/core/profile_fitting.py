@@ -0,0 +1,362 @@
+# src/core/profile_fitting.py
+
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Tuple
+
+import LOOM.src.exceptions as le
+import LOOM.src.core.grouping as lcg
+
+def __gaussian(x: np.ndarray, p: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    amplitude, center, sigma, _ = p
+    u = (x - center) / sigma
+    e = np.exp(-0.5 * u ** 2)
+    jacobian = np.stack((e, amplitude * e * u / sigma, amplitude * e * u ** 2 / sigma, np.ones_like(x)), axis=1)
+    return amplitude * e + p[3], jacobian
+
+def __lorentzian(x: np.ndarray, p: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    amplitude, center, gamma, _ = p
+    u = (x - center) / gamma
+    lorentz = 1. / (1. + u ** 2)
+    jacobian = np.stack((
+        lorentz,
+        2. * amplitude * lorentz ** 2 * u / gamma,
+        2. * amplitude * lorentz ** 2 * u ** 2 / gamma,
+        np.ones_like(x)
+    ), axis=1)
+    return amplitude * lorentz + p[3], jacobian
+
+# Peak models which can be fitted by fit_profiles(). Each
+# one maps its name to its parameter names and to a function
+# which takes the abscissae and the parameters, and returns
+# the model values and their (n_points, n_parameters)
+# jacobian. Every model shares the (amplitude, center, width,
+# offset) layout, so that they can be initialized from the
+# same moments. Further models can be registered here.
+PEAK_MODELS: Dict[str, Tuple[Tuple[str, ...], Callable]] = {
+    'gaussian': (('amplitude', 'center', 'sigma', 'offset'), __gaussian),
+    'lorentzian': (('amplitude', 'center', 'gamma', 'offset'), __lorentzian)
+}
+
+def moment_guesses(
+    x: np.ndarray,
+    y: np.ndarray
+) -> np.ndarray:
+    """This function computes initial guesses for a peak fit to
+    every profile at once, out of the moments of each profile.
+    The offset is the minimum of the profile, the amplitude is
+    its peak-to-peak range, and the center and width are the
+    mean and standard deviation of the abscissae, weighted by
+    the profile above its offset.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        The (P,) abscissae, shared by every profile
+    y: np.ndarray
+        The (..., P) profiles. NaN values are missing points.
+
+    Returns
+    ----------
+    np.ndarray
+        The (..., 4) array of the (amplitude, center, width,
+        offset) guesses of each profile. Profiles with no
+        valid point get NaN.
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~np.isnan(y)
+    has_points = valid.any(axis=-1)
+
+    # Keep the NaN-aware reductions away from empty profiles
+    filled = np.where(has_points[..., np.newaxis], y, 0.)
+    offset = np.nanmin(filled, axis=-1)
+    amplitude = np.nanmax(filled, axis=-1) - offset
+
+    weights = np.where(valid, y - offset[..., np.newaxis], 0.)
+    weight_sum = weights.sum(axis=-1)
+    # Flat profiles are weighted uniformly
+    flat = weight_sum <= 0
+    weights = np.where(flat[..., np.newaxis], valid.astype(np.float64), weights)
+    weight_sum = np.where(flat, valid.sum(axis=-1), weight_sum)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        center = (weights * x).sum(axis=-1) / weight_sum
+        width = np.sqrt((weights * (x - center[..., np.newaxis]) ** 2).sum(axis=-1) / weight_sum)
+
+    spacing = np.diff(np.unique(x)).min() if len(np.unique(x)) > 1 else 1.
+    width = np.maximum(width, spacing)
+
+    guesses = np.stack((amplitude, center, width, offset), axis=-1)
+    guesses[~has_points] = np.nan
+    return guesses
+
+def fit_profiles(
+    x: np.ndarray,
+    y: np.ndarray,
+    y_err: np.ndarray,
+    model: str = 'gaussian',
+    warm_start: bool = True,
+    processes: int = 1,
+    max_iterations: int = 100
+) -> Dict[str, np.ndarray]:
+    """This function fits the given peak model to every profile
+    of a (R, W, P) array, p.e. the signal of a LoomCube, which
+    holds one profile over the P abscissae per revolver
+    position and wavelength. The fits are weighted
+    Levenberg-Marquardt least squares.
+
+    Initial guesses are computed for every profile at once by
+    moment_guesses(). If warm_start is True, the wavelengths of
+    each revolver position are fitted in order, and the center
+    and width of each fit start from the result of the previous
+    wavelength, if it converged, while its amplitude and offset
+    still start from its own moments. Each revolver position is
+    one independent task, so the tasks can be spread across a
+    process pool.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        The (P,) abscissae, p.e. the PMT positions
+    y: np.ndarray
+        The (R, W, P) profiles. NaN values are missing points.
+    y_err: np.ndarray
+        The (R, W, P) standard deviations of the profiles.
+        Values which are not positive and finite are given
+        the largest valid error of their profile, so that
+        they get the least weight (see
+        LOOM.src.core.grouping.fill_invalid_errors()).
+    model: str
+        The name of the peak model, which must be a key of
+        PEAK_MODELS
+    warm_start: bool
+        Whether to start each fit from the previous wavelength
+    processes: int
+        The number of worker processes. If it is 1, every
+        fit is run in this process.
+    max_iterations: int
+        The maximum number of iterations per fit
+
+    Returns
+    ----------
+    Dict[str, np.ndarray]
+        A dictionary with the following keys:
+            - 'model': the name of the peak model
+            - 'param_names': the parameter names of the model
+            - 'params': the (R, W, k) best-fit parameters
+            - 'covariance': the (R, W, k, k) covariance matrices
+            of the parameters, taking the given errors as
+            absolute. They can be scaled by the reduced
+            chi-squared if the errors are not trusted.
+            - 'chi2', 'ndof': the (R, W) chi-squared and number
+            of degrees of freedom of each fit
+            - 'converged': the (R, W) boolean array of the fits
+            which converged
+        Profiles with less valid points than parameters are not
+        fitted, and get NaN parameters and False converged.
+    """
+
+    if model not in PEAK_MODELS:
+        raise le.IncompatibleInput(
+            le.GenerateExceptionMessage(
+                1,
+                'fit_profiles()',
+                reason=f"Unknown peak model '{model}'. It must be one "
+                f"of {list(PEAK_MODELS)}."
+            )
+        )
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    y_err = np.asarray(y_err, dtype=np.float64)
+
+    if y.ndim != 3 or y.shape != y_err.shape or y.shape[2] != len(x):
+        raise le.IncompatibleInput(
+            le.GenerateExceptionMessage(
+                2,
+                'fit_profiles()',
+                reason="The profiles and their errors must be (R, W, P) "
+                "arrays of the same shape, with P the number of "
+                f"abscissae, but got {y.shape}, {y_err.shape} and "
+                f"{x.shape}."
+            )
+        )
+
+    guesses = moment_guesses(x, y)
+    tasks = [
+        (x, y[r], y_err[r], guesses[r], model, warm_start, max_iterations)
+        for r in range(y.shape[0])
+    ]
+
+    processes = min(processes, max(len(tasks), 1))
+    if processes <= 1:
+        chains = [__fit_chain(*task) for task in tasks]
+    else:
+        context = multiprocessing.get_context(
+            'fork' if 'fork' in multiprocessing.get_all_start_methods()
+            else None
+        )
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+            chains = list(executor.map(__fit_chain_unpacked, tasks))
+
+    names = PEAK_MODELS[model][0]
+    k = len(names)
+    R, W = y.shape[:2]
+
+    result = {
+        'model': model,
+        'param_names': np.array(names),
+        'params': np.full((R, W, k), np.nan),
+        'covariance': np.full((R, W, k, k), np.nan),
+        'chi2': np.full((R, W), np.nan),
+        'ndof': np.zeros((R, W), dtype=np.int64),
+        'converged': np.zeros((R, W), dtype=bool)
+    }
+    for r, chain in enumerate(chains):
+        for key, values in chain.items():
+            result[key][r] = values
+
+    return result
+
+def __fit_chain_unpacked(task: tuple) -> Dict[str, np.ndarray]:
+    return __fit_chain(*task)
+
+def __fit_chain(
+    x: np.ndarray,
+    y: np.ndarray,
+    y_err: np.ndarray,
+    guesses: np.ndarray,
+    model: str,
+    warm_start: bool,
+    max_iterations: int
+) -> Dict[str, np.ndarray]:
+    """Fits the (W, P) profiles of one revolver position, in
+    order of wavelength."""
+
+    function = PEAK_MODELS[model][1]
+    W, k = guesses.shape
+
+    chain = {
+        'params': np.full((W, k), np.nan),
+        'covariance': np.full((W, k, k), np.nan),
+        'chi2': np.full(W, np.nan),
+        'ndof': np.zeros(W, dtype=np.int64),
+        'converged': np.zeros(W, dtype=bool)
+    }
+
+    previous = None
+    for w in range(W):
+        valid = ~np.isnan(y[w])
+        if valid.sum() <= k:
+            continue
+
+        p0 = guesses[w].copy()
+        if warm_start and previous is not None:
+            # Shape parameters only: the amplitude
+            # changes with the source spectrum
+            p0[1:3] = previous[1:3]
+
+        # The profile is a single group
+        errors = lcg.fill_invalid_errors(
+            np.zeros(int(valid.sum()), dtype=np.int64),
+            1,
+            y_err[w][valid]
+        )
+
+        params, covariance, chi2, converged = __levenberg_marquardt(
+            function,
+            x[valid],
+            y[w][valid],
+            1. / errors,
+            p0,
+            max_iterations
+        )
+        # The widths enter the models squared
+        params[2] = abs(params[2])
+
+        chain['params'][w] = params
+        chain['covariance'][w] = covariance
+        chain['chi2'][w] = chi2
+        chain['ndof'][w] = valid.sum() - k
+        chain['converged'][w] = converged
+        previous = params if converged else None
+
+    return chain
+
+def __levenberg_marquardt(
+    function: Callable,
+    x: np.ndarray,
+    y: np.ndarray,
+    weights: np.ndarray,
+    p0: np.ndarray,
+    max_iterations: int,
+    tolerance: float = 1e-10
+) -> Tuple[np.ndarray, np.ndarray, float, bool]:
+    """Minimizes the weighted chi-squared of the given model,
+    starting from p0. Returns the best-fit parameters, their
+    covariance, the chi-squared and whether it converged, i.e.
+    whether an accepted step lowered the chi-squared by less
+    than the relative tolerance."""
+
+    p = p0.copy()
+    damping = 1e-3
+
+    model, jacobian = function(x, p)
+    residuals = (y - model) * weights
+    chi2 = residuals @ residuals
+    converged = False
+
+    for _ in range(max_iterations):
+        J = jacobian * weights[:, np.newaxis]
+        alpha = J.T @ J
+        beta = J.T @ residuals
+        # Floor the diagonal, so that the damped matrix is
+        # regular even if some parameter has no effect
+        diagonal = np.maximum(np.diag(alpha), 1e-15 * np.diag(alpha).max())
+
+        improved = False
+        while damping < 1e12:
+            scaled = alpha + damping * np.diag(diagonal)
+            try:
+                step = np.linalg.solve(scaled, beta)
+            except np.linalg.LinAlgError:
+                damping *= 10.
+                continue
+
+            candidate = p + step
+            candidate_model, candidate_jacobian = function(x, candidate)
+            candidate_residuals = (y - candidate_model) * weights
+            candidate_chi2 = candidate_residuals @ candidate_residuals
+
+            if np.isfinite(candidate_chi2) and candidate_chi2 <= chi2:
+                improved = True
+                damping = max(damping / 10., 1e-12)
+                break
+            damping *= 10.
+
+        if not improved:
+            # The damping saturated without any step lowering
+            # the chi-squared, so the fit is stuck rather than
+            # converged
+            break
+
+        decrease = chi2 - candidate_chi2
+        p, jacobian, residuals, chi2 = candidate, candidate_jacobian, candidate_residuals, candidate_chi2
+
+        if decrease <= tolerance * max(chi2, 1e-300):
+            converged = True
+            break
+
+    # The parameters span many orders of magnitude (p.e.
+    # amplitudes in A and centers in degrees), so the
+    # curvature matrix is normalized before inverting it
+    J = jacobian * weights[:, np.newaxis]
+    alpha = J.T @ J
+    scale = np.sqrt(np.diag(alpha))
+    scale[scale == 0] = 1.
+    covariance = np.linalg.pinv(alpha / np.outer(scale, scale)) / np.outer(scale, scale)
+
+    return p, covariance, float(chi2), bool(converged)
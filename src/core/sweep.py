@@ -0,0 +1,404 @@
+# src/core/sweep.py
+
+import csv
+import time
+import itertools
+import pathlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional
+
+import LOOM.src.exceptions as le
+
+# Input data shared by every sweep point run by a worker
+# process. It is set once per worker by __initialize_worker().
+_shared_input = None
+
+def sweep_spec_meets_requirements(
+    sweep_spec: Any,
+    key: Any = None
+) -> None:
+    """This function checks that the given sweep specification,
+    which is the value of the optional 'sweep' sub-key of an
+    analysis stage in the steering file, abides by the
+    following structure:
+
+        - It is a dictionary which contains exactly one of
+        the 'grid' or 'list' keys, and optionally the
+        'processes' key.
+        - The value of 'grid' is a non-empty dictionary
+        whose values are non-empty lists. Every combination
+        of these values gives one sweep point.
+        - The value of 'list' is a non-empty list of
+        dictionaries. Each dictionary gives one sweep point.
+        - The value of 'processes', if given, is an
+        integer >= 1.
+
+    If any of these conditions is not met, a
+    LOOM.src.exceptions.IllFormedSteeringFile exception is
+    raised. Otherwise, this function ends execution normally.
+
+    Parameters
+    ----------
+    sweep_spec: Any
+        The sweep specification to be checked
+    key: Any
+        The key of the analysis stage in the steering file.
+        It is only used to build the exception messages.
+
+    Returns
+    ----------
+    None
+    """
+
+    if not isinstance(sweep_spec, dict) or \
+        len({'grid', 'list'} & set(sweep_spec.keys())) != 1:
+
+        raise le.IllFormedSteeringFile(
+            le.GenerateExceptionMessage(
+                1,
+                'sweep_spec_meets_requirements()',
+                reason=f"The 'sweep' sub-key of the key {key} must be a "
+                "dictionary which contains either a 'grid' or a 'list' "
+                "key (but not both)."
+            )
+        )
+
+    unknown_keys = set(sweep_spec.keys()) - {'grid', 'list', 'processes'}
+    if len(unknown_keys) > 0:
+        raise le.IllFormedSteeringFile(
+            le.GenerateExceptionMessage(
+                2,
+                'sweep_spec_meets_requirements()',
+                reason=f"The 'sweep' sub-key of the key {key} contains "
+                f"unknown keys: {sorted(unknown_keys)}."
+            )
+        )
+
+    if 'grid' in sweep_spec:
+        grid = sweep_spec['grid']
+        if not isinstance(grid, dict) or len(grid) == 0 or \
+            not all(
+                isinstance(values, list) and len(values) > 0
+                for values in grid.values()
+            ):
+
+            raise le.IllFormedSteeringFile(
+                le.GenerateExceptionMessage(
+                    3,
+                    'sweep_spec_meets_requirements()',
+                    reason=f"The 'grid' of the key {key} must be a "
+                    "non-empty dictionary whose values are non-empty "
+                    "lists."
+                )
+            )
+    else:
+        points = sweep_spec['list']
+        if not isinstance(points, list) or len(points) == 0 or \
+            not all(isinstance(point, dict) for point in points):
+
+            raise le.IllFormedSteeringFile(
+                le.GenerateExceptionMessage(
+                    4,
+                    'sweep_spec_meets_requirements()',
+                    reason=f"The 'list' of the key {key} must be a "
+                    "non-empty list of dictionaries."
+                )
+            )
+
+    processes = sweep_spec.get('processes', 1)
+    if isinstance(processes, bool) or not isinstance(processes, int) \
+        or processes < 1:
+
+        raise le.IllFormedSteeringFile(
+            le.GenerateExceptionMessage(
+                5,
+                'sweep_spec_meets_requirements()',
+                reason=f"The 'processes' value of the key {key} must "
+                "be an integer >= 1."
+            )
+        )
+
+    return
+
+def expand_sweep(
+    sweep_spec: dict
+) -> List[dict]:
+    """This function gets a sweep specification, which is
+    assumed to meet the requirements checked by
+    sweep_spec_meets_requirements(), and returns the list
+    of parameter overrides, one per sweep point. For a
+    'grid' specification, the points are the cartesian
+    product of the given values, where the last parameter
+    varies the fastest. For a 'list' specification, the
+    points are the given dictionaries, in order.
+
+    Parameters
+    ----------
+    sweep_spec: dict
+        The sweep specification
+
+    Returns
+    ----------
+    List[dict]
+        The parameter overrides for each sweep point
+    """
+
+    if 'list' in sweep_spec:
+        return [dict(point) for point in sweep_spec['list']]
+
+    names = list(sweep_spec['grid'].keys())
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(
+            *(sweep_spec['grid'][name] for name in names)
+        )
+    ]
+
+def run_sweep(
+    analysis_class: type,
+    base_parameters: dict,
+    sweep_spec: dict,
+    summary_path: Optional[pathlib.Path] = None,
+    verbose: bool = False
+) -> List[dict]:
+    """This function runs one independent execution of the
+    given analysis class per sweep point, and collates the
+    summaries of every execution into one table.
+
+    The parameters of each sweep point are the given base
+    parameters, overwritten by the overrides of that point.
+    All of them are validated before any execution starts.
+    Unless a point overrides its output_path, it writes its
+    output to the 'point_<index>' subfolder of the base one,
+    so that the outputs of the points never overwrite each
+    other. Every point plots to a non-interactive matplotlib
+    backend, so that no point blocks on its figures.
+
+    If the get_shared_input_key() of every sweep point is
+    the same, i.e. every parameter which the reading of the
+    input depends on is the same, the input data is read
+    once, by this process, and shared read-only with every
+    execution (see the get_shared_input() and
+    set_shared_input() methods of LoomAnalysis). Where the
+    'fork' start method is available, the worker processes
+    inherit it without copying. Otherwise, each point reads
+    its own input data.
+
+    Parameters
+    ----------
+    analysis_class: type
+        The analysis class, which must inherit from
+        LoomAnalysis
+    base_parameters: dict
+        The parameters which are common to every sweep point,
+        p.e. the output of build_parameters_dictionary()
+    sweep_spec: dict
+        The sweep specification. Its 'processes' value (1 by
+        default) sets the size of the process pool. If it is
+        1, the sweep points are run sequentially in this
+        process.
+    summary_path: None or pathlib.Path
+        If given, the summary table is written to this path
+        as a CSV file. A relative path is taken relative to
+        the output_path of the base parameters (or its
+        default), if the analysis has one, so that the
+        summary lies next to the outputs of the points.
+    verbose: bool
+        Whether to run with verbosity
+
+    Returns
+    ----------
+    List[dict]
+        The summary table, with one row per sweep point. Each
+        row contains the 'point' index, the overridden
+        parameters, the 'status' ('ok' or the caught exception
+        message), the 'elapsed_s' wall time, and the entries
+        of the get_summary() output of the analysis.
+    """
+
+    overrides = expand_sweep(sweep_spec)
+    points = [{**base_parameters, **override} for override in overrides]
+
+    # Fail early, before any data is read, if any sweep
+    # point does not define valid input parameters
+    model = analysis_class.get_input_params_model()
+    validated = [model(**point) for point in points]
+
+    for i, (point, override, parameters) in enumerate(zip(points, overrides, validated)):
+        if 'output_path' not in override:
+            point['output_path'] = str(pathlib.Path(parameters.output_path) / f"point_{i}")
+
+    shared_input = None
+    keys = [analysis_class.get_shared_input_key(p) for p in validated]
+    if all(key == keys[0] for key in keys):
+
+        if verbose:
+            print(
+                "In function run_sweep(): Reading the input data "
+                f"once for the {len(points)} sweep points"
+            )
+
+        reader = analysis_class()
+        reader.initialize(validated[0])
+        reader.read_input()
+        shared_input = reader.get_shared_input()
+
+    processes = min(sweep_spec.get('processes', 1), len(points))
+
+    if verbose:
+        print(
+            f"In function run_sweep(): Running {len(points)} sweep "
+            f"points with {processes} process(es)"
+        )
+
+    tasks = [
+        (analysis_class, i, point, override)
+        for i, (point, override) in enumerate(zip(points, overrides))
+    ]
+
+    if processes == 1:
+        backend = __initialize_worker(shared_input)
+        try:
+            summary = [__run_sweep_point(*task) for task in tasks]
+        finally:
+            if backend is not None:
+                import matplotlib.pyplot as plt
+                plt.switch_backend(backend)
+    else:
+        context = multiprocessing.get_context(
+            'fork' if 'fork' in multiprocessing.get_all_start_methods()
+            else None
+        )
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=context,
+            initializer=__initialize_worker,
+            initargs=(shared_input,)
+        ) as executor:
+            summary = list(
+                executor.map(
+                    __run_sweep_point_unpacked,
+                    tasks
+                )
+            )
+
+    if summary_path is not None:
+        summary_path = pathlib.Path(summary_path)
+        output_field = model.model_fields.get('output_path')
+        base_output_path = base_parameters.get(
+            'output_path',
+            None if output_field is None else output_field.default
+        )
+        if not summary_path.is_absolute() and base_output_path is not None:
+            summary_path = pathlib.Path(base_output_path) / summary_path
+
+        write_summary_table(summary, summary_path)
+
+        if verbose:
+            print(
+                "In function run_sweep(): Wrote the summary "
+                f"table to '{summary_path}'"
+            )
+
+    return summary
+
+def write_summary_table(
+    summary: List[dict],
+    path: pathlib.Path
+) -> None:
+    """This function writes the given summary table, as
+    returned by run_sweep(), to the given path, as a CSV
+    file. The columns are the union of the keys of every
+    row, in order of first appearance. The parent folder is
+    created if it does not exist.
+
+    Parameters
+    ----------
+    summary: List[dict]
+        The rows of the table
+    path: pathlib.Path
+        The path to the output CSV file
+
+    Returns
+    ----------
+    None
+    """
+
+    columns = []
+    for row in summary:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(summary)
+
+    return
+
+def __initialize_worker(
+    shared_input: Any
+) -> Optional[str]:
+    """Stores the shared input data for the sweep points
+    which are run by this process, and switches it to a
+    non-interactive matplotlib backend, so that plotting
+    never blocks. Returns the previous backend, so that
+    the sweeping process can restore it, or None if
+    matplotlib is not available."""
+
+    global _shared_input
+    _shared_input = shared_input
+
+    try:
+        import matplotlib
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return None
+
+    backend = matplotlib.get_backend()
+    plt.switch_backend('Agg')
+    return backend
+
+def __run_sweep_point_unpacked(task: tuple) -> dict:
+    return __run_sweep_point(*task)
+
+def __run_sweep_point(
+    analysis_class: type,
+    point_index: int,
+    parameters: dict,
+    override: dict
+) -> dict:
+    """Runs one sweep point and returns its row of the
+    summary table. Exceptions are caught and recorded
+    in the 'status' column, so that one failing sweep
+    point does not abort the rest of them."""
+
+    row = {'point': point_index, **override}
+    start = time.perf_counter()
+
+    try:
+        analysis = analysis_class()
+        analysis.execute(
+            analysis_class.get_input_params_model()(**parameters),
+            shared_input=_shared_input
+        )
+        row['status'] = 'ok'
+        summary = analysis.get_summary()
+    except Exception as e:
+        row['status'] = f"{type(e).__name__}: {e}"
+        summary = {}
+
+    row['elapsed_s'] = round(time.perf_counter() - start, 3)
+    row.update(summary)
+
+    try:
+        import matplotlib.pyplot as plt
+        plt.close('all')
+    except ImportError:
+        pass
+
+    return row
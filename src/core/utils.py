@@ -4,6 +4,7 @@ import yaml
 from typing import Optional, List
 
 import LOOM.src.exceptions as le
+import LOOM.src.core.sweep as lcs
 
 def add_arguments_to_parser(
         parser: argparse.ArgumentParser 
@@ -824,6 +825,12 @@ def steering_file_meets_requirements(
         from the parameters file, if any. If this value
         is an empty string, then no parameters are
         overwritten.
+        - Optionally, each key may also contain a 'sweep'
+        sub-key, which turns the analysis stage into a
+        parameter sweep. Its value must meet the
+        requirements described in the
+        LOOM.src.core.sweep.sweep_spec_meets_requirements()
+        function docstring.
 
     If any of these conditions is not met, a
     waffles.Exceptions.IllFormedSteeringFile exception
@@ -939,6 +946,12 @@ def steering_file_meets_requirements(
                     )
                 )
             
+        if 'sweep' in content[key].keys():
+            lcs.sweep_spec_meets_requirements(
+                content[key]['sweep'],
+                key
+            )
+
         check_analysis_class(
             content[key]['name'],
             steering_file_path.parent
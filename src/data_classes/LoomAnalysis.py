@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 from pydantic import BaseModel, Field
 from LOOM.src.data_classes.LoomSet import LoomSet
 
@@ -16,6 +16,19 @@ class LoomInputParams(BaseModel):
         description="Path to the output file or folder"
     )
 
+    store_path: Optional[str] = Field(
+        default=None,
+        description="Path to a LOOM dataset store (see LoomDatasetStore). "
+        "If given, the runs are read from the store instead of the "
+        "input_path files"
+    )
+
+    store_runs: Optional[List[str]] = Field(
+        default=None,
+        description="Ids, or glob patterns, of the runs of the store to be "
+        "read. If None, every run of the store is read"
+    )
+
 class LoomAnalysis(ABC):
     """This abstract class implements a Loom Analysis.
     It fixes a common interface and workflow for all
@@ -48,6 +61,20 @@ class LoomAnalysis(ABC):
         Abstract method which is responsible for writing
         the output of the analysis. For more information,
         refer to its docstring.
+    get_shared_input(), set_shared_input(shared_input):
+        Optional methods which allow the input data read
+        by read_input() to be reused by several executions
+        of the analysis, p.e. across the points of a
+        parameter sweep. For more information, refer to
+        their docstrings.
+    get_shared_input_key(input_parameters):
+        Optional class method which tells which executions
+        read the same input data, and so can share it. For
+        more information, refer to its docstring.
+    get_summary():
+        Optional method which returns a flat summary of
+        the analysis results, p.e. to be collated into
+        the summary table of a parameter sweep.
     """
 
     def __init__(self):
@@ -139,15 +166,58 @@ class LoomAnalysis(ABC):
         """
         pass
 
+    def get_shared_input(self) -> Any:
+        """This method may be overriden by derived analysis
+        classes. It must return the input data which was
+        read by read_input(), in a form which can be given
+        to set_shared_input() in another instance of the same
+        class. The returned object must be treated as
+        read-only by the analysis. By default, it returns
+        None, meaning that the input data is not shareable."""
+        return None
+
+    @classmethod
+    def get_shared_input_key(cls, input_parameters: LoomInputParams) -> Any:
+        """This class method may be overriden by derived
+        analysis classes. It must return a key, comparable
+        with ==, of the input parameters which determine
+        the input data read by read_input(), so that
+        executions whose keys are equal can share it (see
+        get_shared_input()). By default, it returns every
+        input parameter, so that the input data is only
+        shared among executions with identical parameters."""
+        return input_parameters.model_dump()
+
+    def set_shared_input(self, shared_input: Any) -> None:
+        """This method may be overriden by derived analysis
+        classes. It takes the output of get_shared_input()
+        and sets it as the input data of this analysis, in
+        place of calling read_input(). It is called after
+        initialize()."""
+        pass
+
+    def get_summary(self) -> Dict[str, Any]:
+        """This method may be overriden by derived analysis
+        classes. It must return a flat dictionary of scalar
+        results, which is meant to be called after execute().
+        By default, it returns an empty dictionary."""
+        return {}
+
     def execute(
             self,
-            input_parameters: LoomInputParams) -> None:
+            input_parameters: LoomInputParams,
+            shared_input: Any = None) -> None:
         
         """Main execution method that runs the full LOOM 
-        analysis pipeline."""
+        analysis pipeline. If shared_input is given, it is
+        passed to set_shared_input() instead of calling
+        read_input()."""
 
         self.initialize(input_parameters)
-        self.read_input()
+        if shared_input is not None:
+            self.set_shared_input(shared_input)
+        else:
+            self.read_input()
         self.analyze()
         self.plot()
         self.write_output()
@@ -0,0 +1,469 @@
+# LOOM/src/data_classes/LoomBinaryRun.py
+
+import os
+import json
+import struct
+import numpy as np
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import LOOM.src.exceptions as le
+from LOOM.src.data_classes.LoomSet import LoomSet
+from LOOM.src.data_classes.LoomRow import LOOM_ROW_FIELDS
+from LOOM.src.data_classes.LoomTxtReader import LoomTxtReader
+
+class LoomBinaryRun:
+    """Binary, columnar storage of one LOOM run, which allows
+    reading a range of it (p.e. one wavelength range, or one
+    hour of a long run) without touching the rest of the file.
+
+    The rows are stored in blocks of, at most, block_rows rows,
+    and each block stores each LoomRow field as one contiguous
+    page of raw values. The footer of the file holds the
+    metadata of the run, the byte offset of every page and,
+    for every block, the minimum and maximum of each of the
+    zone_columns (its zone map). A query which restricts any
+    of these columns only reads the blocks whose zone map
+    overlaps it, and, within them, only the pages of the
+    requested columns.
+
+    Optionally, the unixtime column is delta-encoded: it is
+    quantized to time_resolution seconds, and each block
+    stores its first tick in the footer plus the difference
+    between consecutive ticks, in the smallest integer dtype
+    which holds them. Since runs are sampled at a roughly
+    constant rate, this usually takes 1 or 2 bytes per row
+    instead of 8.
+
+    The layout of the file is:
+
+        MAGIC | pages of block 0 | pages of block 1 | ...
+        | JSON footer | footer length (uint64) | MAGIC
+
+    Example:
+        LoomBinaryRun.from_txt("run.txt", "run.loomrun", delta_time=True)
+        run = LoomBinaryRun("run.loomrun")
+        loom_set = run.read(wavelength=(300, 400), unixtime=(t0, t0 + 3600))
+    """
+
+    suffix = '.loomrun'
+    magic = b'LOOMRUN1'
+    version = 1
+
+    # Columns whose per-block minimum and
+    # maximum are stored in the footer
+    zone_columns = ('unixtime', 'wavelength', 'revolverpos', 'pmtpos')
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            head = f.read(len(self.magic))
+            f.seek(-(len(self.magic) + 8), os.SEEK_END)
+            footer_length, = struct.unpack('<Q', f.read(8))
+            tail = f.read(len(self.magic))
+
+            if head != self.magic or tail != self.magic:
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        1,
+                        'LoomBinaryRun.__init__()',
+                        reason=f"'{path}' is not a LOOM binary run file "
+                        "(or it was not completely written)."
+                    )
+                )
+
+            f.seek(-(len(self.magic) + 8 + footer_length), os.SEEK_END)
+            self._footer: Dict[str, Any] = json.loads(f.read(footer_length).decode())
+
+    @property
+    def metadata(self) -> dict:
+        return self._footer['metadata']
+
+    @property
+    def source(self) -> str:
+        """The source name of the run. See write()."""
+        return self._footer['source']
+
+    @property
+    def n_rows(self) -> int:
+        return sum(block['n_rows'] for block in self._footer['blocks'])
+
+    @property
+    def n_blocks(self) -> int:
+        return len(self._footer['blocks'])
+
+    @property
+    def delta_time(self) -> bool:
+        return self._footer['delta_time']
+
+    def read_metadata(self) -> dict:
+        """Same as the metadata property. It mirrors
+        LoomTxtReader.read_metadata()."""
+        return self.metadata
+
+    def zone_maps(self) -> Dict[str, np.ndarray]:
+        """Returns, for each of the zone_columns, the (B, 2)
+        array of the minimum and maximum of each block. Blocks
+        with no valid value get NaN."""
+        return {
+            name: np.array(
+                [
+                    [np.nan if v is None else v for v in block['zones'][name]]
+                    for block in self._footer['blocks']
+                ],
+                dtype=np.float64
+            ).reshape(-1, 2)
+            for name in self.zone_columns
+        }
+
+    def select_blocks(self, **criteria) -> List[int]:
+        """Returns the indices of the blocks which may hold
+        rows that match every one of the given criteria,
+        according to their zone maps. The criteria follow the
+        format of LoomSet.select(). Criteria on columns which
+        have no zone map never discard a block."""
+        criteria = LoomBinaryRun.__normalize_criteria(criteria)
+        selected = []
+
+        for i, block in enumerate(self._footer['blocks']):
+            overlaps = True
+            for name, value in criteria.items():
+                if name not in self.zone_columns:
+                    continue
+                lo, hi = block['zones'][name]
+                if lo is None:
+                    # Every value of the block is NaN,
+                    # which matches no criterion
+                    overlaps = False
+                elif isinstance(value, tuple):
+                    overlaps = (value[0] is None or hi >= value[0]) and \
+                        (value[1] is None or lo <= value[1])
+                elif isinstance(value, (list, set, frozenset, np.ndarray)):
+                    values = np.asarray(list(value), dtype=np.float64)
+                    overlaps = bool(((values >= lo) & (values <= hi)).any())
+                else:
+                    overlaps = lo <= value <= hi
+                if not overlaps:
+                    break
+            if overlaps:
+                selected.append(i)
+
+        return selected
+
+    def iter_chunks(
+        self,
+        columns: Optional[Sequence[str]] = None,
+        **criteria
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """Streams the rows which match every one of the given
+        criteria, yielding one chunk per block whose zone map
+        overlaps them. Only the pages of the requested columns,
+        plus the ones of the criteria, are read from disk.
+
+        Parameters
+        ----------
+        columns: None or Sequence[str]
+            The LoomRow fields to be yielded. If None,
+            every field is yielded.
+        **criteria
+            The criteria of the rows, in the format of
+            LoomSet.select(), p.e. wavelength=(300, 400)
+
+        Returns
+        ----------
+        Iterator[Dict[str, np.ndarray]]
+            Chunks in the same format as the ones of
+            LoomTxtReader.iter_chunks()
+        """
+        columns = tuple(LOOM_ROW_FIELDS if columns is None else columns)
+        criteria = LoomBinaryRun.__normalize_criteria(criteria)
+        needed = tuple(dict.fromkeys(columns + tuple(criteria)))
+
+        with open(self.path, 'rb') as f:
+            for i in self.select_blocks(**criteria):
+                block = self._footer['blocks'][i]
+                chunk = {name: self.__read_page(f, block, name) for name in needed}
+
+                if criteria:
+                    mask = LoomBinaryRun.row_mask(chunk, criteria)
+                    if not mask.any():
+                        continue
+                    if not mask.all():
+                        chunk = {name: values[mask] for name, values in chunk.items()}
+
+                yield {name: chunk[name] for name in columns}
+
+    def read_columns(
+        self,
+        columns: Optional[Sequence[str]] = None,
+        **criteria
+    ) -> Dict[str, np.ndarray]:
+        """Reads the rows which match every one of the given
+        criteria into one numpy array per requested LoomRow
+        field. See iter_chunks()."""
+        columns = tuple(LOOM_ROW_FIELDS if columns is None else columns)
+        chunks = list(self.iter_chunks(columns, **criteria))
+        return {
+            name: np.concatenate([chunk[name] for chunk in chunks]) if chunks
+            else np.zeros(0, dtype=np.dtype(self._footer['dtypes'][name]))
+            for name in columns
+        }
+
+    def count_rows(self, **criteria) -> int:
+        """Counts the rows which match every one of the given
+        criteria, only reading the pages of their columns."""
+        criteria = LoomBinaryRun.__normalize_criteria(criteria)
+        if not criteria:
+            return self.n_rows
+
+        n_rows = 0
+        with open(self.path, 'rb') as f:
+            for i in self.select_blocks(**criteria):
+                block = self._footer['blocks'][i]
+                chunk = {name: self.__read_page(f, block, name) for name in criteria}
+                n_rows += int(LoomBinaryRun.row_mask(chunk, criteria).sum())
+        return n_rows
+
+    def read(self, columns: Optional[Sequence[str]] = None, **criteria) -> LoomSet:
+        """Reads the rows which match every one of the given
+        criteria into a columnar LoomSet (see
+        LoomSet.from_columns()). If columns is given, only
+        those fields are read now, and the rest are read, for
+        the same rows, on first access."""
+        criteria = LoomBinaryRun.__normalize_criteria(criteria)
+        read_now = LOOM_ROW_FIELDS if columns is None else tuple(columns)
+        values = self.read_columns(read_now, **criteria)
+        n_rows = len(values[read_now[0]]) if read_now else self.count_rows(**criteria)
+        return LoomSet.from_columns(
+            metadata=self.metadata,
+            columns=values,
+            sources={self.source: (0, n_rows)},
+            loader=None if columns is None else lambda names: self.read_columns(names, **criteria),
+            n_rows=n_rows
+        )
+
+    @staticmethod
+    def row_mask(chunk: Dict[str, np.ndarray], criteria: Dict[str, Any]) -> np.ndarray:
+        """Returns the boolean mask of the rows of the given
+        chunk which match every one of the given criteria, in
+        the format of LoomSet.select()."""
+        criteria = LoomBinaryRun.__normalize_criteria(criteria)
+        n_rows = len(next(iter(chunk.values()))) if chunk else 0
+        mask = np.ones(n_rows, dtype=bool)
+
+        for name, value in criteria.items():
+            values = chunk[name]
+            if isinstance(value, tuple):
+                lo, hi = value
+                if lo is not None:
+                    mask &= values >= lo
+                if hi is not None:
+                    mask &= values <= hi
+            elif isinstance(value, (list, set, frozenset, np.ndarray)):
+                mask &= np.isin(values, list(value))
+            else:
+                mask &= values == value
+
+        return mask
+
+    @classmethod
+    def write(
+        cls,
+        path: str,
+        metadata: dict,
+        chunks: Iterable[Dict[str, np.ndarray]],
+        source: Optional[str] = None,
+        block_rows: int = 65_536,
+        delta_time: bool = False,
+        time_resolution: float = 1e-6
+    ) -> 'LoomBinaryRun':
+        """Writes the given chunks of rows, in order, to a
+        LOOM binary run file, and returns it opened. Only one
+        block is held in memory at a time, so the chunks may
+        come from a streaming reader.
+
+        Parameters
+        ----------
+        path: str
+            The path of the output file
+        metadata: dict
+            The metadata of the run. It must be serializable
+            to JSON, as the one given by the LOOM readers.
+        chunks: Iterable[Dict[str, np.ndarray]]
+            Chunks which map every LoomRow field to an array,
+            p.e. the ones of LoomTxtReader.iter_chunks(). The
+            dtype of each column is kept.
+        source: None or str
+            The source name of the run, which is given to the
+            LoomSets which are read from the file. If None,
+            the name of the output file, without its suffix.
+        block_rows: int
+            The maximum number of rows per block. Smaller
+            blocks skip more precisely, at the cost of a
+            larger footer.
+        delta_time: bool
+            Whether to delta-encode the unixtime column
+        time_resolution: float
+            The resolution, in seconds, to which unixtime is
+            quantized if delta_time is True
+        """
+        if block_rows < 1 or time_resolution <= 0:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    2,
+                    'LoomBinaryRun.write()',
+                    reason="block_rows and time_resolution must be positive, "
+                    f"but got {block_rows} and {time_resolution}."
+                )
+            )
+
+        footer = {
+            'version': cls.version,
+            'source': source if source is not None
+                else os.path.splitext(os.path.basename(path))[0],
+            'metadata': metadata,
+            'delta_time': delta_time,
+            'time_resolution': time_resolution,
+            'dtypes': {},
+            'blocks': []
+        }
+
+        with open(path, 'wb') as f:
+            f.write(cls.magic)
+
+            pending: Dict[str, List[np.ndarray]] = {name: [] for name in LOOM_ROW_FIELDS}
+            n_pending = 0
+            for chunk in chunks:
+                missing = [name for name in LOOM_ROW_FIELDS if name not in chunk]
+                if missing:
+                    raise le.IncompatibleInput(
+                        le.GenerateExceptionMessage(
+                            3,
+                            'LoomBinaryRun.write()',
+                            reason=f"Every chunk must hold every LoomRow field, but "
+                            f"{missing} are missing."
+                        )
+                    )
+                for name in LOOM_ROW_FIELDS:
+                    pending[name].append(np.asarray(chunk[name]))
+                    footer['dtypes'].setdefault(name, pending[name][-1].dtype.str)
+                n_pending += len(pending['unixtime'][-1])
+
+                while n_pending >= block_rows:
+                    merged = {name: np.concatenate(arrays) for name, arrays in pending.items()}
+                    cls.__write_block(f, footer, {name: a[:block_rows] for name, a in merged.items()})
+                    pending = {name: [a[block_rows:]] for name, a in merged.items()}
+                    n_pending -= block_rows
+
+            if n_pending > 0:
+                cls.__write_block(f, footer, {name: np.concatenate(a) for name, a in pending.items()})
+
+            for name in LOOM_ROW_FIELDS:
+                footer['dtypes'].setdefault(
+                    name,
+                    np.dtype(np.int64 if name == 'revolverpos' else np.float64).str
+                )
+
+            encoded = json.dumps(footer).encode()
+            f.write(encoded)
+            f.write(struct.pack('<Q', len(encoded)))
+            f.write(cls.magic)
+
+        return cls(path)
+
+    @classmethod
+    def from_txt(
+        cls,
+        txt_path: str,
+        path: Optional[str] = None,
+        **kwargs
+    ) -> 'LoomBinaryRun':
+        """Converts a LOOM .txt file into a LOOM binary run
+        file, streaming its rows, and returns the latter. If
+        path is None, the .txt suffix is replaced by the
+        suffix of this class. The keyword arguments are given
+        to write()."""
+        if path is None:
+            path = os.path.splitext(txt_path)[0] + cls.suffix
+
+        reader = LoomTxtReader(txt_path)
+        kwargs.setdefault('source', os.path.basename(txt_path))
+        run = cls.write(path, reader.read_metadata(), reader.iter_chunks(), **kwargs)
+        print(f"✅ Converted '{os.path.basename(txt_path)}' into {run.n_blocks} block(s).")
+        return run
+
+    @classmethod
+    def __write_block(cls, f, footer: dict, columns: Dict[str, np.ndarray]) -> None:
+        n_rows = len(columns['unixtime'])
+        block = {'n_rows': n_rows, 'pages': {}, 'zones': {}, 'time_base': None}
+
+        time = columns['unixtime']
+        if footer['delta_time']:
+            ticks = np.round(time / footer['time_resolution'])
+            if np.isfinite(ticks).all() and np.abs(ticks).max(initial=0.) < 2 ** 62:
+                ticks = ticks.astype(np.int64)
+                block['time_base'] = int(ticks[0]) if n_rows else 0
+                deltas = np.diff(ticks, prepend=block['time_base'])
+                columns = dict(columns, unixtime=deltas.astype(cls.__smallest_int_dtype(deltas)))
+                # The zone map must bound the decoded values
+                time = ticks * footer['time_resolution']
+
+        for name in cls.zone_columns:
+            values = time if name == 'unixtime' else columns[name]
+            valid = values[~np.isnan(values)] if values.dtype.kind == 'f' else values
+            block['zones'][name] = [valid.min().item(), valid.max().item()] if len(valid) \
+                else [None, None]
+
+        for name in LOOM_ROW_FIELDS:
+            page = np.ascontiguousarray(columns[name])
+            block['pages'][name] = [f.tell(), page.dtype.str]
+            f.write(page.tobytes())
+
+        footer['blocks'].append(block)
+
+    def __read_page(self, f, block: dict, name: str) -> np.ndarray:
+        offset, dtype = block['pages'][name]
+        f.seek(offset)
+        values = np.fromfile(f, dtype=np.dtype(dtype), count=block['n_rows'])
+
+        if name == 'unixtime' and block['time_base'] is not None:
+            ticks = block['time_base'] + np.cumsum(values, dtype=np.int64)
+            values = ticks * self._footer['time_resolution']
+        return values
+
+    @staticmethod
+    def __smallest_int_dtype(values: np.ndarray) -> np.dtype:
+        for dtype in (np.int8, np.int16, np.int32):
+            info = np.iinfo(dtype)
+            if values.min(initial=0) >= info.min and values.max(initial=0) <= info.max:
+                return np.dtype(dtype)
+        return np.dtype(np.int64)
+
+    @staticmethod
+    def __normalize_criteria(criteria: Dict[str, Any]) -> Dict[str, Any]:
+        """Resolves the aliases of LoomSet.column_aliases,
+        drops the None criteria and checks the rest."""
+        normalized = {}
+        for name, value in criteria.items():
+            if value is None:
+                continue
+            name = LoomSet.column_aliases.get(name, name)
+            if name not in LOOM_ROW_FIELDS:
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        4,
+                        'LoomBinaryRun.select_blocks()',
+                        reason=f"'{name}' is not a LoomRow field."
+                    )
+                )
+            if isinstance(value, tuple) and len(value) != 2:
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        5,
+                        'LoomBinaryRun.select_blocks()',
+                        reason=f"The range given for '{name}' must be "
+                        f"a (lo, hi) tuple, but got {value}."
+                    )
+                )
+            normalized[name] = value
+        return normalized
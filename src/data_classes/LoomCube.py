@@ -0,0 +1,360 @@
+# LOOM/src/data_classes/LoomCube.py
+
+import numpy as np
+from typing import Dict, Optional
+
+import LOOM.src.exceptions as le
+import LOOM.src.core.grouping as lcg
+from LOOM.src.data_classes.LoomSet import LoomSet
+
+class LoomCube:
+    """Dense representation of a reflectivity scan, which is
+    a regular grid of revolver positions x wavelengths x PMT
+    positions, possibly with repeated measurements per cell.
+
+    Every array attribute has shape (R, W, P), where R, W
+    and P are the number of distinct revolver positions,
+    wavelengths and PMT positions, whose values are given,
+    sorted, by the revolver_positions, wavelengths and
+    pmt_positions attributes. Cells with no measurement have
+    count 0 and NaN in every float array.
+
+    Attributes
+    ----------
+    count: np.ndarray
+        Number of measurements in each cell
+    combine: str
+        How repeated measurements were combined into each
+        cell: 'mean' (plain average) or 'weighted'
+        (inverse-variance weighted average)
+    current, dc: np.ndarray
+        Combined current and dark current of each cell. The
+        dark current is either the per-row reading or its
+        smoothed baseline (see from_loomset()).
+    current_err, dc_err: np.ndarray
+        Uncertainty of the combined values, propagated from
+        the per-measurement current_std (resp. dc_std)
+    current_chi2, dc_chi2: np.ndarray
+        Chi-squared of the repeated measurements of each
+        cell with respect to their weighted mean, with
+        count - 1 degrees of freedom. They are only
+        computed if combine is 'weighted', and are None
+        otherwise.
+    current_sum: np.ndarray
+        Sum of the currents of each cell. It is 0 for
+        empty cells.
+    revolver_labels: Dict[int, str]
+        The revolver labels of the source LoomSet
+    """
+
+    def __init__(
+        self,
+        revolver_positions: np.ndarray,
+        wavelengths: np.ndarray,
+        pmt_positions: np.ndarray,
+        count: np.ndarray,
+        current: np.ndarray,
+        current_err: np.ndarray,
+        dc: np.ndarray,
+        dc_err: np.ndarray,
+        current_sum: np.ndarray,
+        revolver_labels: Optional[Dict[int, str]] = None,
+        combine: str = 'mean',
+        current_chi2: Optional[np.ndarray] = None,
+        dc_chi2: Optional[np.ndarray] = None
+    ):
+        self.revolver_positions = revolver_positions
+        self.wavelengths = wavelengths
+        self.pmt_positions = pmt_positions
+        self.count = count
+        self.current = current
+        self.current_err = current_err
+        self.dc = dc
+        self.dc_err = dc_err
+        self.current_sum = current_sum
+        self.revolver_labels = revolver_labels if revolver_labels is not None else {}
+        self.combine = combine
+        self.current_chi2 = current_chi2
+        self.dc_chi2 = dc_chi2
+
+    @classmethod
+    def from_loomset(
+        cls,
+        loom_set: LoomSet,
+        combine: str = 'mean',
+        honour_rejections: bool = True,
+        dark_current: str = 'dc',
+        current_column: str = 'current'
+    ) -> 'LoomCube':
+        """Builds a LoomCube out of the rows of the given
+        LoomSet (or view), in one pass over its columns.
+
+        Parameters
+        ----------
+        loom_set: LoomSet
+            The LoomSet (or view) to be binned
+        combine: str
+            If 'mean', repeated measurements are averaged.
+            If 'weighted', they are combined into their
+            inverse-variance weighted mean, using current_std
+            and dc_std, and the chi-squared of each cell is
+            also computed.
+        honour_rejections: bool
+            Whether to leave out the rows which are marked
+            as rejected in the given LoomSet (see
+            LoomSet.reject_outliers())
+        dark_current: str
+            The column which the dark current of each row is
+            taken from: either 'dc', for the per-row reading,
+            or 'dc_baseline', for the smoothed baseline which
+            is built by LoomSet.correct_dark_current()
+        current_column: str
+            The column which the current of each row is taken
+            from: either 'current', for the raw reading, or
+            'current_env', for the environmentally corrected
+            current (see LoomSet.correct_environment())
+
+        Returns
+        ----------
+        LoomCube
+        """
+        if combine not in ('mean', 'weighted'):
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomCube.from_loomset()',
+                    reason=f"Unknown combine mode '{combine}'. It must "
+                    "be either 'mean' or 'weighted'."
+                )
+            )
+
+        if dark_current not in ('dc', 'dc_baseline'):
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    2,
+                    'LoomCube.from_loomset()',
+                    reason=f"Unknown dark current column '{dark_current}'. "
+                    "It must be either 'dc' or 'dc_baseline'."
+                )
+            )
+
+        if current_column not in ('current', 'current_env'):
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    4,
+                    'LoomCube.from_loomset()',
+                    reason=f"Unknown current column '{current_column}'. "
+                    "It must be either 'current' or 'current_env'."
+                )
+            )
+
+        if honour_rejections:
+            loom_set = loom_set.accepted()
+
+        if dark_current == 'dc_baseline' and len(loom_set) > 0 \
+            and np.isnan(loom_set.column('dc_baseline')).all():
+
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    3,
+                    'LoomCube.from_loomset()',
+                    reason="The dark current baseline has not been built. "
+                    "Call LoomSet.correct_dark_current() first."
+                )
+            )
+
+        if current_column == 'current_env' and len(loom_set) > 0 \
+            and np.isnan(loom_set.column('current_env')).all():
+
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    5,
+                    'LoomCube.from_loomset()',
+                    reason="The environmental correction has not been "
+                    "applied. Call LoomSet.correct_environment() first."
+                )
+            )
+
+        rev_axis, rev_idx = np.unique(loom_set.column('revolverpos'), return_inverse=True)
+        wl_axis, wl_idx = np.unique(loom_set.column('wavelength'), return_inverse=True)
+        pmt_axis, pmt_idx = np.unique(loom_set.column('pmtpos'), return_inverse=True)
+
+        shape = (len(rev_axis), len(wl_axis), len(pmt_axis))
+        cell = np.ravel_multi_index((rev_idx, wl_idx, pmt_idx), shape) if len(loom_set) > 0 \
+            else np.zeros(0, dtype=np.intp)
+        n_cells = int(np.prod(shape))
+
+        def cell_sum(values: np.ndarray) -> np.ndarray:
+            return np.bincount(
+                cell,
+                weights=np.asarray(values, dtype=np.float64),
+                minlength=n_cells
+            ).reshape(shape)
+
+        count = np.bincount(cell, minlength=n_cells).reshape(shape)
+
+        current_sum = cell_sum(loom_set.column(current_column))
+        current_chi2, dc_chi2 = None, None
+
+        if combine == 'weighted':
+            weighted = {
+                name: lcg.weighted_group_means(
+                    cell,
+                    n_cells,
+                    loom_set.column(column),
+                    loom_set.column(f'{column}_std')
+                )
+                for name, column in (('current', current_column), ('dc', dark_current))
+            }
+            current = weighted['current']['mean'].reshape(shape)
+            current_err = weighted['current']['err'].reshape(shape)
+            current_chi2 = weighted['current']['chi2'].reshape(shape)
+            dc = weighted['dc']['mean'].reshape(shape)
+            dc_err = weighted['dc']['err'].reshape(shape)
+            dc_chi2 = weighted['dc']['chi2'].reshape(shape)
+        else:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                n = np.where(count == 0, np.nan, count)
+                current = current_sum / n
+                current_err = np.sqrt(cell_sum(np.square(loom_set.column(f'{current_column}_std')))) / n
+                dc = cell_sum(loom_set.column(dark_current)) / n
+                dc_err = np.sqrt(cell_sum(np.square(loom_set.column(f'{dark_current}_std')))) / n
+
+        return cls(
+            revolver_positions=rev_axis,
+            wavelengths=wl_axis,
+            pmt_positions=pmt_axis,
+            count=count,
+            current=current,
+            current_err=current_err,
+            dc=dc,
+            dc_err=dc_err,
+            current_sum=current_sum,
+            revolver_labels=dict(loom_set.revolver_labels),
+            combine=combine,
+            current_chi2=current_chi2,
+            dc_chi2=dc_chi2
+        )
+
+    @property
+    def shape(self) -> tuple:
+        return self.count.shape
+
+    @property
+    def signal(self) -> np.ndarray:
+        """Dark-current-subtracted mean current of each cell"""
+        return self.current - self.dc
+
+    @property
+    def signal_err(self) -> np.ndarray:
+        return np.hypot(self.current_err, self.dc_err)
+
+    def revolver_index(self, revolverpos: int) -> int:
+        """Returns the position of the given revolver position
+        along the first axis of the cube."""
+        matches = np.flatnonzero(self.revolver_positions == revolverpos)
+        if len(matches) == 0:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomCube.revolver_index()',
+                    reason=f"The revolver position {revolverpos} is not "
+                    f"in this LoomCube ({self.revolver_positions.tolist()})."
+                )
+            )
+        return int(matches[0])
+
+    def cell_index(self, loom_set: LoomSet) -> np.ndarray:
+        """Returns the flat index, within the (R, W, P) shape
+        of the cube, of the cell of each row of the given
+        LoomSet (or view), p.e. to resample the repeated
+        measurements of every cell. Rows whose revolver
+        position, wavelength or PMT position is not an axis
+        value of the cube get -1."""
+        cell = np.zeros(len(loom_set), dtype=np.int64)
+        inside = np.full(len(loom_set), 0 not in self.shape)
+        if not inside.any():
+            return np.full(len(loom_set), -1, dtype=np.int64)
+
+        for axis, column in (
+            (self.revolver_positions, 'revolverpos'),
+            (self.wavelengths, 'wavelength'),
+            (self.pmt_positions, 'pmtpos')
+        ):
+            values = loom_set.column(column)
+            index = np.minimum(np.searchsorted(axis, values), len(axis) - 1)
+            inside &= axis[index] == values
+            cell = cell * len(axis) + index
+
+        return np.where(inside, cell, -1)
+
+    def integrated_intensity(self, repeats: str = 'sum') -> np.ndarray:
+        """Returns the (R, W) array of currents integrated over
+        the PMT positions, adding every repeated measurement
+        if repeats is 'sum', or the combined current of each
+        cell once if it is 'mean'."""
+        if repeats == 'sum':
+            values = self.current_sum
+        elif repeats == 'mean':
+            values = np.nan_to_num(self.current, nan=0.)
+        else:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomCube.integrated_intensity()',
+                    reason=f"Unknown repeats mode '{repeats}'. It must "
+                    "be either 'sum' or 'mean'."
+                )
+            )
+
+        integrated = values.sum(axis=2)
+        integrated[self.count.sum(axis=2) == 0] = np.nan
+        return integrated
+
+    def ratio_to(self, values: np.ndarray, revolverpos: int) -> np.ndarray:
+        """Divides the given (R, W, ...) array by its slice for
+        the given reference revolver position, broadcasting
+        over every revolver. Divisions by 0 give NaN."""
+        reference = values[self.revolver_index(revolverpos)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(reference != 0, values / reference, np.nan)
+
+    def as_nested_dict(self, values: np.ndarray) -> Dict[int, Dict[float, float]]:
+        """Converts the given (R, W) array into the
+        {revpos: {wavelength: value}} format which is used by
+        the plotting helpers. NaN entries are skipped."""
+        nested = {}
+        for i, revpos in enumerate(self.revolver_positions.tolist()):
+            row = values[i]
+            valid = ~np.isnan(row)
+            if valid.any():
+                nested[revpos] = dict(zip(self.wavelengths[valid].tolist(), row[valid].tolist()))
+        return nested
+
+    def revolver_label(self, revolverpos: int) -> str:
+        return self.revolver_labels.get(revolverpos, 'Unknown')
+
+    def reduced_chi2(self, name: str = 'current') -> np.ndarray:
+        """Returns the chi-squared per degree of freedom of
+        the repeated measurements of each cell, for the given
+        quantity ('current' or 'dc'). Cells with less than two
+        measurements give NaN. Values well above 1 point to
+        repeats which scatter more than their quoted std."""
+        chi2 = getattr(self, f'{name}_chi2')
+        if chi2 is None:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomCube.reduced_chi2()',
+                    reason="The chi-squared is only available for "
+                    "LoomCubes built with combine='weighted'."
+                )
+            )
+        ndof = self.count - 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(ndof > 0, chi2 / ndof, np.nan)
+
+    def missing_cells(self) -> np.ndarray:
+        """Boolean (R, W, P) mask of the cells with no
+        measurement."""
+        return self.count == 0
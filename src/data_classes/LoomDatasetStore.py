@@ -0,0 +1,350 @@
+# LOOM/src/data_classes/LoomDatasetStore.py
+
+import os
+import json
+import fnmatch
+import hashlib
+import datetime
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import LOOM.src.exceptions as le
+from LOOM.src.data_classes.LoomSet import LoomSet
+from LOOM.src.data_classes.LoomRow import LOOM_ROW_FIELDS
+from LOOM.src.data_classes.LoomTxtReader import LoomTxtReader
+from LOOM.src.data_classes.LoomBinaryRun import LoomBinaryRun
+
+class LoomDatasetStore:
+    """Append-only store of many LOOM runs in a local folder,
+    which is meant to be converted once and then read by many
+    analyses, without parsing the .txt files again.
+
+    Each run is stored as one LOOM binary run file (see
+    LoomBinaryRun), which holds its metadata plus its rows in
+    blocks of column pages with zone maps, and the folder has
+    an 'index.json' file which lists the runs in the order
+    they were appended. Appending a run writes its file and
+    rewrites the index only, so that the existing runs are
+    never touched. Both files are first written to a temporary
+    name and then renamed, so that an interrupted append never
+    leaves a half-written run in the index. A run can only be
+    replaced explicitly (see append()), in which case its new
+    file is written next to the old one, and the index entry
+    is swapped before the old file is removed.
+
+    Reads are lazy: a subset of the runs (given by their ids,
+    or by glob patterns on them) and of the columns can be
+    requested, plus any LoomSet.select() criteria, and only
+    the matching blocks of the matching runs are read.
+
+    Example:
+        store = LoomDatasetStore("campaign")
+        store.append_txt("24072025_LimitScan.txt")
+        loom_set = store.read(runs=["2407*"], wavelength=(300, 400))
+    """
+
+    index_file_name = 'index.json'
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        index_path = self.path / self.index_file_name
+        if index_path.exists():
+            with open(index_path, 'r') as file:
+                self._index: List[dict] = json.load(file)['runs']
+        else:
+            self._index = []
+
+        self._runs: Dict[str, LoomBinaryRun] = {}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, run_id: str) -> bool:
+        return any(entry['run_id'] == run_id for entry in self._index)
+
+    @property
+    def entries(self) -> List[dict]:
+        """The index entry (run id, file name, number of rows,
+        fingerprint, revision and append time) of every run,
+        in the order they were appended."""
+        return [dict(entry) for entry in self._index]
+
+    def run_ids(self, runs: Optional[Sequence[str]] = None) -> List[str]:
+        """Returns the ids of the runs which match any of the
+        given ids or glob patterns (p.e. '2407*'), in the order
+        they were appended. An entry which is the exact id of a
+        run only selects that run, even if it holds glob
+        characters (p.e. '[' or '*'). If runs is None, every
+        run id is returned. Patterns which match no run raise
+        an exception, so that a typo is not taken as an empty
+        selection."""
+        all_ids = [entry['run_id'] for entry in self._index]
+        if runs is None:
+            return all_ids
+
+        selected = set()
+        for pattern in runs:
+            matches = [pattern] if pattern in all_ids else fnmatch.filter(all_ids, pattern)
+            if not matches:
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        1,
+                        'LoomDatasetStore.run_ids()',
+                        reason=f"No run of the store at '{self.path}' "
+                        f"matches '{pattern}'."
+                    )
+                )
+            selected.update(matches)
+
+        return [run_id for run_id in all_ids if run_id in selected]
+
+    def run(self, run_id: str) -> LoomBinaryRun:
+        """Returns the LoomBinaryRun of the given run, opening
+        it (which only reads its footer) on first access."""
+        if run_id not in self._runs:
+            entry = next((e for e in self._index if e['run_id'] == run_id), None)
+            if entry is None:
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        2,
+                        'LoomDatasetStore.run()',
+                        reason=f"'{run_id}' is not a run of the store at '{self.path}'."
+                    )
+                )
+            self._runs[run_id] = LoomBinaryRun(str(self.path / entry['file']))
+        return self._runs[run_id]
+
+    def fingerprint(self, run_id: str) -> str:
+        """The fingerprint which was given when the run
+        was appended. See append()."""
+        return next(e['fingerprint'] for e in self._index if e['run_id'] == run_id)
+
+    def append(
+        self,
+        run_id: str,
+        metadata: dict,
+        chunks: Iterable[Dict[str, np.ndarray]],
+        fingerprint: str = '',
+        replace: bool = False,
+        **kwargs
+    ) -> LoomBinaryRun:
+        """Appends one run to the store. Appending a run id
+        which is already in the store raises an exception,
+        unless replace is True.
+
+        Parameters
+        ----------
+        run_id: str
+            The id of the run, which is also the source name
+            of the LoomSets which are read from the store
+        metadata: dict
+            The metadata of the run
+        chunks: Iterable[Dict[str, np.ndarray]]
+            The rows of the run, in chunks which map every
+            LoomRow field to an array (see LoomBinaryRun.write())
+        fingerprint: str
+            A fingerprint of the input of the run (p.e. the
+            size and modification time of its .txt file)
+        replace: bool
+            Whether to replace the run, if it is already in
+            the store. Its new file is written under a new
+            name, and its index entry, which keeps its
+            position, is swapped atomically, so that the old
+            version is read until the new one is complete.
+        **kwargs
+            Given to LoomBinaryRun.write(), p.e. block_rows
+            or delta_time
+
+        Returns
+        ----------
+        LoomBinaryRun
+            The stored run
+        """
+        position = next((i for i, e in enumerate(self._index) if e['run_id'] == run_id), None)
+        if position is not None and not replace:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    3,
+                    'LoomDatasetStore.append()',
+                    reason=f"The run '{run_id}' is already in the store at "
+                    f"'{self.path}'. Give replace=True to replace it."
+                )
+            )
+
+        # Each version of a run gets its own file, so
+        # that the old one stays valid until the swap
+        revision = 0 if position is None else self._index[position].get('revision', 0) + 1
+        file_name = hashlib.sha1(run_id.encode()).hexdigest()[:16] \
+            + (f"_{revision}" if revision > 0 else '') + LoomBinaryRun.suffix
+        temporary = self.path / (file_name + '.tmp')
+        LoomBinaryRun.write(str(temporary), metadata, chunks, source=run_id, **kwargs)
+        os.replace(temporary, self.path / file_name)
+
+        run = LoomBinaryRun(str(self.path / file_name))
+        entry = {
+            'run_id': run_id,
+            'file': file_name,
+            'n_rows': run.n_rows,
+            'fingerprint': fingerprint,
+            'revision': revision,
+            'appended': datetime.datetime.now().isoformat(timespec='seconds')
+        }
+        if position is None:
+            self._index.append(entry)
+            self.__write_index()
+        else:
+            old_file = self._index[position]['file']
+            self._index[position] = entry
+            self.__write_index()
+            (self.path / old_file).unlink(missing_ok=True)
+
+        self._runs[run_id] = run
+        return run
+
+    def append_txt(
+        self,
+        txt_path: str,
+        run_id: Optional[str] = None,
+        replace: bool = False,
+        **kwargs
+    ) -> Optional[LoomBinaryRun]:
+        """Converts a LOOM .txt file into a run of the store,
+        streaming its rows. The run id defaults to the file
+        name. If the run is already in the store with the same
+        fingerprint (size and modification time of the file),
+        it is skipped and None is returned. If its fingerprint
+        changed, i.e. the file changed on disk since it was
+        appended, the run is converted again and replaced if
+        replace is True, and an exception is raised otherwise.
+        The keyword arguments are given to append()."""
+        run_id = os.path.basename(txt_path) if run_id is None else run_id
+        stat = os.stat(txt_path)
+        fingerprint = f"{stat.st_size}:{int(stat.st_mtime)}"
+
+        if run_id in self:
+            if self.fingerprint(run_id) == fingerprint:
+                return None
+            if not replace:
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        4,
+                        'LoomDatasetStore.append_txt()',
+                        reason=f"The run '{run_id}' of the store at '{self.path}' "
+                        f"changed on disk since it was appended (fingerprint "
+                        f"'{self.fingerprint(run_id)}', now '{fingerprint}'). "
+                        "Give replace=True to convert it again."
+                    )
+                )
+
+        reader = LoomTxtReader(txt_path)
+        replaced = run_id in self
+        run = self.append(
+            run_id,
+            reader.read_metadata(),
+            reader.iter_chunks(),
+            fingerprint,
+            replace=replace,
+            **kwargs
+        )
+        action = "Replaced" if replaced else "Appended"
+        preposition = "in" if replaced else "to"
+        print(f"✅ {action} '{run_id}' ({run.n_rows} rows) {preposition} the store at '{self.path}'.")
+        return run
+
+    def read_metadata(self, runs: Optional[Sequence[str]] = None) -> Dict[str, dict]:
+        """Returns the metadata of every selected run, keyed
+        by run id, without reading their rows. See run_ids()
+        for the format of runs."""
+        return {run_id: self.run(run_id).metadata for run_id in self.run_ids(runs)}
+
+    def iter_chunks(
+        self,
+        runs: Optional[Sequence[str]] = None,
+        columns: Optional[Sequence[str]] = None,
+        **criteria
+    ) -> Iterator[Tuple[str, Dict[str, np.ndarray]]]:
+        """Streams the selected runs, in order, yielding
+        (run_id, chunk) pairs, as LoomTxtMultiReader.iter_chunks()
+        does. See LoomBinaryRun.iter_chunks() for the columns
+        and the criteria."""
+        for run_id in self.run_ids(runs):
+            for chunk in self.run(run_id).iter_chunks(columns, **criteria):
+                yield run_id, chunk
+
+    def read_columns(
+        self,
+        runs: Optional[Sequence[str]] = None,
+        columns: Optional[Sequence[str]] = None,
+        **criteria
+    ) -> Tuple[Dict[str, np.ndarray], Dict[str, Tuple[int, int]]]:
+        """Reads the given columns of the rows of the selected
+        runs which match every one of the given criteria.
+
+        Returns
+        ----------
+        Tuple[Dict[str, np.ndarray], Dict[str, Tuple[int, int]]]
+            The concatenated columns, and the [start, stop)
+            range of the rows of each run within them
+        """
+        return self.__read_run_columns(self.run_ids(runs), columns, **criteria)
+
+    def __read_run_columns(
+        self,
+        run_ids: Sequence[str],
+        columns: Optional[Sequence[str]] = None,
+        **criteria
+    ) -> Tuple[Dict[str, np.ndarray], Dict[str, Tuple[int, int]]]:
+        """Same as read_columns(), for the given exact run
+        ids, which are not matched as patterns again."""
+        columns = tuple(LOOM_ROW_FIELDS if columns is None else columns)
+        arrays: Dict[str, List[np.ndarray]] = {name: [] for name in columns}
+        sources: Dict[str, Tuple[int, int]] = {}
+        n_rows = 0
+
+        for run_id in run_ids:
+            run_columns = self.run(run_id).read_columns(columns, **criteria)
+            for name in columns:
+                arrays[name].append(run_columns[name])
+            n_run = len(run_columns[columns[0]]) if columns \
+                else self.run(run_id).count_rows(**criteria)
+            sources[run_id] = (n_rows, n_rows + n_run)
+            n_rows += n_run
+
+        return {
+            name: np.concatenate(values) if values
+            else np.zeros(0, dtype=np.int64 if name == 'revolverpos' else np.float64)
+            for name, values in arrays.items()
+        }, sources
+
+    def read(
+        self,
+        runs: Optional[Sequence[str]] = None,
+        columns: Optional[Sequence[str]] = None,
+        **criteria
+    ) -> LoomSet:
+        """Reads the rows of the selected runs which match
+        every one of the given criteria into one columnar
+        LoomSet, whose metadata and sources are kept per run,
+        as the ones of LoomTxtMultiReader.read(). If columns
+        is given, only those fields are read now, and the rest
+        are read, for the same runs and rows, on first access."""
+        run_ids = self.run_ids(runs)
+        values, sources = self.__read_run_columns(run_ids, columns, **criteria)
+
+        print(f"✅ Read {len(sources)} run(s) from the store at '{self.path}'.")
+        return LoomSet.from_columns(
+            metadata={run_id: self.run(run_id).metadata for run_id in sources},
+            columns=values,
+            sources=sources,
+            loader=None if columns is None else lambda names: self.__read_run_columns(run_ids, names, **criteria)[0],
+            n_rows=max((stop for _, stop in sources.values()), default=0)
+        )
+
+    def __write_index(self) -> None:
+        temporary = self.path / (self.index_file_name + '.tmp')
+        with open(temporary, 'w') as file:
+            json.dump({'runs': self._index}, file, indent=2)
+        os.replace(temporary, self.path / self.index_file_name)
@@ -0,0 +1,177 @@
+# LOOM/src/data_classes/LoomFigureCache.py
+
+import os
+import json
+import hashlib
+import datetime
+import numpy as np
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+class LoomFigureCache:
+    """Cache of rendered figures in a local folder, keyed by
+    a hash of the arrays and style options which feed each one,
+    so that re-running an analysis only renders the figures
+    whose inputs changed, and reuses the image files of the
+    rest.
+
+    Each figure (or panel of a multi-panel figure) is stored
+    as one image file, named after it, and the folder has an
+    'index.json' file which maps every name to the key of its
+    inputs. A figure is rendered again if its key changed or
+    its file is missing. The index is first written to a
+    temporary name and then renamed, so that an interrupted
+    run never leaves a stale key for a figure.
+
+    Example:
+        cache = LoomFigureCache("output/figures")
+        path, rendered = cache.render("integrated", draw, wavelengths, intensities, scale='log')
+    """
+
+    index_file_name = 'index.json'
+    # Bumped whenever the hashing changes, so
+    # that older keys never match by chance
+    key_version = 1
+
+    def __init__(self, path: Union[str, Path], image_format: str = 'png', dpi: int = 100):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.image_format = image_format
+        self.dpi = dpi
+
+        index_path = self.path / self.index_file_name
+        if index_path.exists():
+            with open(index_path, 'r') as file:
+                self._index: Dict[str, dict] = json.load(file)
+        else:
+            self._index = {}
+
+        # Names of the figures rendered and reused by this
+        # instance, in order, for the summary of a run
+        self.rendered: List[str] = []
+        self.reused: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @staticmethod
+    def hash_inputs(*inputs: Any, **options: Any) -> str:
+        """Hash of the given inputs of a figure, which may be
+        numpy arrays, scalars, strings, None, or lists, tuples
+        and dictionaries of them (p.e. the nested
+        {revpos: {wavelength: value}} dictionaries of the
+        analyses). Arrays are hashed by their dtype, shape and
+        bytes, and the keyword options (p.e. the colour scale)
+        are hashed by name, so that the key changes whenever
+        anything which is drawn changes."""
+        digest = hashlib.sha1(f"LoomFigureCache:{LoomFigureCache.key_version}".encode())
+        LoomFigureCache.__update(digest, inputs)
+        LoomFigureCache.__update(digest, options)
+        return digest.hexdigest()
+
+    @staticmethod
+    def __update(digest, value: Any) -> None:
+        if isinstance(value, np.ndarray):
+            digest.update(f"ndarray:{value.dtype.str}:{value.shape}:".encode())
+            if value.dtype.hasobject:
+                LoomFigureCache.__update(digest, value.tolist())
+            else:
+                digest.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, dict):
+            digest.update(f"dict:{len(value)}:".encode())
+            # Keys of mixed types can not be sorted
+            # directly, so they are sorted by repr
+            for key in sorted(value, key=repr):
+                digest.update(repr(key).encode())
+                LoomFigureCache.__update(digest, value[key])
+        elif isinstance(value, (list, tuple)):
+            digest.update(f"{type(value).__name__}:{len(value)}:".encode())
+            for item in value:
+                LoomFigureCache.__update(digest, item)
+        elif isinstance(value, np.generic):
+            LoomFigureCache.__update(digest, value.item())
+        else:
+            digest.update(f"{type(value).__name__}:{value!r};".encode())
+
+    def file_path(self, name: str) -> Path:
+        """The path of the image file of the given figure.
+        Names may hold '/' to group panels in subfolders."""
+        return self.path / f"{name}.{self.image_format}"
+
+    def key(self, name: str) -> Optional[str]:
+        """The key of the stored image of the given figure,
+        or None if it was never stored. The keys of panels
+        serve as the inputs of the figures composed of them."""
+        entry = self._index.get(name)
+        return None if entry is None else entry['key']
+
+    def is_current(self, name: str, key: str) -> bool:
+        """Whether the stored image of the given figure was
+        rendered from inputs with the given key."""
+        entry = self._index.get(name)
+        return entry is not None and entry['key'] == key and self.file_path(name).exists()
+
+    def save(self, name: str, key: str, figure) -> Path:
+        """Saves the given matplotlib figure as the image of
+        the given name, with the given key, and returns its
+        path. The figure is not closed."""
+        path = self.file_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        figure.savefig(path, dpi=self.dpi)
+
+        self._index[name] = {
+            'key': key,
+            'file': str(path.relative_to(self.path)),
+            'rendered': datetime.datetime.now().isoformat(timespec='seconds')
+        }
+        self.__write_index()
+        return path
+
+    def render(
+        self,
+        name: str,
+        draw: Callable[[], Any],
+        *inputs: Any,
+        **options: Any
+    ) -> Tuple[Path, bool]:
+        """Returns the image of the given figure, rendering
+        it only if its inputs changed since it was stored.
+
+        Parameters
+        ----------
+        name: str
+            The name of the figure, p.e. 'integrated_intensity'
+            or 'intensity_vs_pmt/revolver_2'
+        draw: Callable[[], matplotlib.figure.Figure]
+            Function which draws the figure from the given
+            inputs and returns it. It is only called if the
+            figure is rendered. The figure is closed after
+            being saved.
+        *inputs, **options
+            Everything which the figure is drawn from, which
+            is hashed by hash_inputs()
+
+        Returns
+        ----------
+        Tuple[Path, bool]
+            The path of the image file, and whether it was
+            rendered (True) or reused (False)
+        """
+        key = self.hash_inputs(*inputs, **options)
+        if self.is_current(name, key):
+            self.reused.append(name)
+            return self.file_path(name), False
+
+        import matplotlib.pyplot as plt
+
+        figure = draw()
+        path = self.save(name, key, figure)
+        plt.close(figure)
+        self.rendered.append(name)
+        return path, True
+
+    def __write_index(self) -> None:
+        temporary = self.path / (self.index_file_name + '.tmp')
+        with open(temporary, 'w') as file:
+            json.dump(self._index, file, indent=2)
+        os.replace(temporary, self.path / self.index_file_name)
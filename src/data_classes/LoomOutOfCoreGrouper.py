@@ -0,0 +1,194 @@
+# LOOM/src/data_classes/LoomOutOfCoreGrouper.py
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+
+import LOOM.src.exceptions as le
+import LOOM.src.core.grouping as lcg
+
+class LoomOutOfCoreGrouper:
+    """Groups and reduces a stream of LOOM rows within a
+    bounded memory budget, so that the size of the dataset
+    is limited by the local disk rather than by the RAM.
+
+    Rows are given in chunks (p.e. the output of the
+    iter_chunks() method of the LOOM readers) through
+    add_chunk(). They are buffered until the buffer reaches
+    the memory budget. Then, the buffer is reduced into one
+    sorted table of partial moments per group, which is split
+    into hash partitions and spilled to disk, one run file
+    per partition. Finally, reduce() merges the runs of each
+    partition, one partition at a time, and returns the
+    per-group count, sum, variance, minimum and maximum of
+    each value column. The runs of a partition are merged
+    into a running table one run at a time, so that only one
+    of them is loaded at once, whatever their number.
+
+    Example:
+        grouper = LoomOutOfCoreGrouper(
+            ('revolverpos', 'wavelength'),
+            ('current',),
+            memory_budget_bytes=256 * 2**20
+        )
+        for _, chunk in LoomTxtMultiReader(paths).iter_chunks():
+            grouper.add_chunk(chunk)
+        table = grouper.reduce()
+        # table['current_sum'] is the integrated intensity
+        # of each (table['revolverpos'], table['wavelength'])
+    """
+
+    def __init__(
+        self,
+        key_columns: Sequence[str],
+        value_columns: Sequence[str],
+        memory_budget_bytes: int = 256 * 2**20,
+        spill_dir: Optional[str] = None,
+        n_partitions: int = 16
+    ):
+        if len(key_columns) == 0 or len(value_columns) == 0:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomOutOfCoreGrouper.__init__()',
+                    reason="At least one key column and one value "
+                    "column must be given."
+                )
+            )
+
+        if memory_budget_bytes <= 0 or n_partitions < 1:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    2,
+                    'LoomOutOfCoreGrouper.__init__()',
+                    reason="The memory budget must be positive, and "
+                    "the number of partitions must be >= 1."
+                )
+            )
+
+        self.key_columns = tuple(key_columns)
+        self.value_columns = tuple(value_columns)
+        self.memory_budget_bytes = memory_budget_bytes
+        self.n_partitions = n_partitions
+        self._spill_dir_parent = spill_dir
+
+        self._buffer: List[Dict[str, np.ndarray]] = []
+        self._buffered_bytes = 0
+        self._spill_dir: Optional[str] = None
+        self._runs: List[List[str]] = [[] for _ in range(n_partitions)]
+        self.n_rows = 0
+        self.n_spills = 0
+
+    def add_chunk(self, chunk: Dict[str, np.ndarray]) -> None:
+        """Buffers the key and value columns of the given chunk,
+        spilling the buffer to disk if it exceeds the memory
+        budget."""
+        kept = {name: np.asarray(chunk[name]) for name in self.key_columns + self.value_columns}
+        self._buffer.append(kept)
+        self._buffered_bytes += sum(a.nbytes for a in kept.values())
+        self.n_rows += len(kept[self.key_columns[0]])
+
+        if self._buffered_bytes >= self.memory_budget_bytes:
+            self._spill()
+
+    def reduce(self) -> Dict[str, np.ndarray]:
+        """Merges every spilled run, plus the rows which are
+        still buffered, and returns the reduced table. The
+        table maps each key column, 'count', and, for each
+        value column v, 'v_sum', 'v_mean', 'v_var' (the
+        unbiased variance), 'v_min' and 'v_max', to an array
+        with one entry per group. Groups are sorted by key.
+        The spill files are removed afterwards."""
+        buffered = self._reduce_buffer()
+
+        try:
+            results = []
+            for partition in range(self.n_partitions):
+                merged = None
+                if buffered is not None:
+                    in_partition = self._partition_of(buffered) == partition
+                    merged = {k: v[in_partition] for k, v in buffered.items()}
+                for path in self._runs[partition]:
+                    run = self._load_run(path)
+                    merged = run if merged is None else lcg.merge_moment_tables(
+                        [merged, run],
+                        self.key_columns,
+                        self.value_columns
+                    )
+                if merged is not None and len(merged['count']) > 0:
+                    results.append(merged)
+        finally:
+            self.cleanup()
+
+        if not results:
+            return lcg.finalize_moment_table(None, self.key_columns, self.value_columns)
+
+        # Every group lives in exactly one partition, so the
+        # final merge only needs to restore the global order
+        return lcg.finalize_moment_table(
+            lcg.merge_moment_tables(results, self.key_columns, self.value_columns),
+            self.key_columns,
+            self.value_columns
+        )
+
+    def cleanup(self) -> None:
+        """Removes the spill directory, if any."""
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+        self._runs = [[] for _ in range(self.n_partitions)]
+
+    def _reduce_buffer(self) -> Optional[Dict[str, np.ndarray]]:
+        if not self._buffer:
+            return None
+
+        columns = {
+            name: np.concatenate([chunk[name] for chunk in self._buffer])
+            for name in self.key_columns + self.value_columns
+        }
+        self._buffer = []
+        self._buffered_bytes = 0
+
+        return lcg.group_moment_table(columns, self.key_columns, self.value_columns)
+
+    def _spill(self) -> None:
+        table = self._reduce_buffer()
+        if table is None:
+            return
+
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(
+                prefix='loom_spill_',
+                dir=self._spill_dir_parent
+            )
+
+        partition = self._partition_of(table)
+        for p in np.unique(partition):
+            path = os.path.join(
+                self._spill_dir,
+                f"run_{self.n_spills:06d}_part_{p:03d}.npz"
+            )
+            selected = partition == p
+            np.savez(path, **{k: v[selected] for k, v in table.items()})
+            self._runs[p].append(path)
+
+        self.n_spills += 1
+
+    def _partition_of(self, table: Dict[str, np.ndarray]) -> np.ndarray:
+        """Hashes the key columns of each group into a partition
+        number, so that a group always lands in the same one."""
+        h = np.zeros(len(table['count']), dtype=np.uint64)
+        for name in self.key_columns:
+            values = np.ascontiguousarray(table[name], dtype=np.float64)
+            # Normalize -0.0, so that it hashes like 0.0
+            values = values + 0.0
+            bits = values.view(np.uint64)
+            h = (h * np.uint64(1000003)) ^ (bits ^ (bits >> np.uint64(29)))
+        return (h % np.uint64(self.n_partitions)).astype(np.intp)
+
+    @staticmethod
+    def _load_run(path: str) -> Dict[str, np.ndarray]:
+        with np.load(path) as run:
+            return {k: run[k] for k in run.files}
@@ -0,0 +1,314 @@
+# LOOM/src/data_classes/LoomReferenceLibrary.py
+
+import os
+import json
+import hashlib
+import datetime
+import contextlib
+import numpy as np
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where concurrent
+    # writers to the same library are not guarded
+    fcntl = None
+
+import LOOM.src.exceptions as le
+
+class LoomReferenceLibrary:
+    """Persistent library of reference spectra, p.e. the
+    integrated intensity by wavelength of the 'No sample'
+    revolver position, which allows normalizing runs which
+    do not measure their own reference.
+
+    Each entry is keyed by the date of the run which measured
+    it, the tag of the setup, a hash of its wavelength grid and
+    a hash of the processing options which it was computed with
+    (p.e. how the repeats were combined), since spectra computed
+    with different options are not comparable. Lookups only
+    consider the entries with the same options.
+    The library lives in a folder, with one .npz file per entry
+    plus an 'index.json' file, so that looking an entry up
+    never loads the spectra of the rest. Interpolations onto
+    a given wavelength grid are cached in memory, so that
+    repeated runs over the same grid reuse them.
+
+    Example:
+        library = LoomReferenceLibrary("references")
+        library.store("2025-07-23", "bench", wavelengths, spectrum)
+        reference = library.reference_for("bench", "2025-07-24", sample_wavelengths)
+    """
+
+    index_file_name = 'index.json'
+    lock_file_name = 'index.lock'
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self._index: Dict[str, dict] = {}
+        self.__read_index()
+
+        self._spectra: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        self._interpolations: Dict[Tuple[str, str], Dict[str, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def entries(self) -> List[dict]:
+        """The index entry (key, date, setup, grid hash, options
+        and file name) of every stored spectrum, sorted by key."""
+        return [dict(self._index[key], key=key) for key in sorted(self._index)]
+
+    @staticmethod
+    def options_hash(options: Optional[Dict[str, Any]]) -> str:
+        """Short hash which identifies the given processing
+        options, or an empty string if there are none, which
+        is also the one of the entries stored without them."""
+        if not options:
+            return ''
+        serialized = json.dumps(options, sort_keys=True, default=repr)
+        return hashlib.sha1(serialized.encode()).hexdigest()[:12]
+
+    @staticmethod
+    def grid_hash(wavelengths: np.ndarray) -> str:
+        """Short hash which identifies a wavelength grid, up
+        to a rounding of 1e-6 nm."""
+        grid = np.round(np.asarray(wavelengths, dtype=np.float64), 6)
+        return hashlib.sha1(grid.tobytes()).hexdigest()[:12]
+
+    def store(
+        self,
+        date: str,
+        setup: str,
+        wavelengths: np.ndarray,
+        spectrum: np.ndarray,
+        errors: Optional[np.ndarray] = None,
+        options: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """Stores the given reference spectrum, replacing the
+        entry with the same date, setup, wavelength grid and
+        options, if any, and returns its key. The index is
+        read again and updated under a file lock, and both
+        files are first written to a temporary name and then
+        renamed, so that concurrent writers (p.e. the points
+        of a parameter sweep) never lose each other's entries.
+
+        Parameters
+        ----------
+        date: str
+            The date of the run, preferably in ISO format
+            (YYYY-MM-DD), so that the closest one can be
+            looked up
+        setup: str
+            The tag of the setup
+        wavelengths: np.ndarray
+            The wavelength grid of the spectrum
+        spectrum: np.ndarray
+            The reference value at each wavelength
+        errors: None or np.ndarray
+            The uncertainty of each value. If None, it is
+            stored as NaN.
+        options: None or Dict[str, Any]
+            The processing options which the spectrum was
+            computed with, p.e. {'combine_repeats': 'mean'},
+            as JSON-serializable values
+
+        Returns
+        ----------
+        str
+            The key of the entry
+        """
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        spectrum = np.asarray(spectrum, dtype=np.float64)
+        errors = np.full_like(spectrum, np.nan) if errors is None \
+            else np.asarray(errors, dtype=np.float64)
+
+        if wavelengths.ndim != 1 or spectrum.shape != wavelengths.shape \
+            or errors.shape != wavelengths.shape:
+
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomReferenceLibrary.store()',
+                    reason="The wavelengths, spectrum and errors must be "
+                    "one-dimensional arrays of the same length."
+                )
+            )
+
+        order = np.argsort(wavelengths)
+        wavelengths, spectrum, errors = wavelengths[order], spectrum[order], errors[order]
+
+        grid_hash = LoomReferenceLibrary.grid_hash(wavelengths)
+        options_hash = LoomReferenceLibrary.options_hash(options)
+        key = f"{date}|{setup}|{grid_hash}"
+        if options_hash:
+            key += f"|{options_hash}"
+        file_name = hashlib.sha1(key.encode()).hexdigest()[:16] + '.npz'
+
+        with self.__index_lock():
+            temporary = self.path / (file_name + '.tmp')
+            with open(temporary, 'wb') as file:
+                np.savez(file, wavelengths=wavelengths, spectrum=spectrum, errors=errors)
+            os.replace(temporary, self.path / file_name)
+
+            # Other writers may have stored entries
+            # since this library was opened
+            self.__read_index()
+            self._index[key] = {
+                'date': date,
+                'setup': setup,
+                'grid_hash': grid_hash,
+                'options_hash': options_hash,
+                'options': options or {},
+                'file': file_name
+            }
+            self.__write_index()
+
+        self._spectra.pop(key, None)
+        self._interpolations = {k: v for k, v in self._interpolations.items() if k[0] != key}
+        return key
+
+    def lookup(
+        self,
+        setup: str,
+        date: Optional[str] = None,
+        wavelengths: Optional[np.ndarray] = None,
+        options: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
+        """Returns the key of the entry of the given setup and
+        processing options (see store()) which is the best match
+        for the given date and wavelength grid, or None if there
+        is no such entry. Entries with other options are never
+        returned. Entries with the same wavelength grid are
+        preferred, and, among them, the ones whose date is
+        closest to the given one. Dates which are not in ISO
+        format only match exactly."""
+        options_hash = LoomReferenceLibrary.options_hash(options)
+        candidates = [
+            key for key, entry in self._index.items()
+            if entry['setup'] == setup and entry.get('options_hash', '') == options_hash
+        ]
+        if not candidates:
+            return None
+
+        target_hash = None if wavelengths is None else LoomReferenceLibrary.grid_hash(np.sort(wavelengths))
+        target_date = LoomReferenceLibrary.__parse_date(date)
+
+        def rank(key: str) -> tuple:
+            entry = self._index[key]
+            entry_date = LoomReferenceLibrary.__parse_date(entry['date'])
+            if date is None:
+                distance = 0
+            elif target_date is not None and entry_date is not None:
+                distance = abs((entry_date - target_date).days)
+            else:
+                distance = 0 if entry['date'] == date else np.inf
+            return (entry['grid_hash'] != target_hash, distance)
+
+        # min() keeps the first of the tied candidates,
+        # so ties are broken by the latest entry
+        candidates.sort(key=lambda key: self._index[key]['date'], reverse=True)
+        return min(candidates, key=rank)
+
+    def spectrum(self, key: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the (wavelengths, spectrum, errors) arrays
+        of the given entry, loading them on first access."""
+        if key not in self._index:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    2,
+                    'LoomReferenceLibrary.spectrum()',
+                    reason=f"'{key}' is not an entry of the library at '{self.path}'."
+                )
+            )
+
+        if key not in self._spectra:
+            with np.load(self.path / self._index[key]['file']) as stored:
+                self._spectra[key] = (stored['wavelengths'], stored['spectrum'], stored['errors'])
+        return self._spectra[key]
+
+    def reference_for(
+        self,
+        setup: str,
+        date: Optional[str],
+        wavelengths: np.ndarray,
+        options: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, np.ndarray]]:
+        """Interpolates the best matching entry (see lookup())
+        linearly onto the given wavelengths. Wavelengths out of
+        the range of the entry get NaN, rather than being
+        extrapolated.
+
+        Parameters
+        ----------
+        setup: str
+            The tag of the setup
+        date: None or str
+            The date of the run to be normalized
+        wavelengths: np.ndarray
+            The wavelengths of the run to be normalized
+        options: None or Dict[str, Any]
+            The processing options of the run to be
+            normalized. See store().
+
+        Returns
+        ----------
+        None or Dict[str, np.ndarray]
+            None if the setup has no entry with the
+            given options. Otherwise, a
+            dictionary which maps 'key' to the key of the used
+            entry, and 'spectrum' and 'errors' to the
+            interpolated values at each given wavelength.
+        """
+        key = self.lookup(setup, date, wavelengths, options)
+        if key is None:
+            return None
+
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        cache_key = (key, LoomReferenceLibrary.grid_hash(wavelengths))
+        if cache_key not in self._interpolations:
+            grid, spectrum, errors = self.spectrum(key)
+            self._interpolations[cache_key] = {
+                'key': key,
+                'spectrum': np.interp(wavelengths, grid, spectrum, left=np.nan, right=np.nan),
+                'errors': np.interp(wavelengths, grid, errors, left=np.nan, right=np.nan)
+            }
+        return self._interpolations[cache_key]
+
+    @contextlib.contextmanager
+    def __index_lock(self):
+        """Exclusive lock of the index among processes."""
+        with open(self.path / self.lock_file_name, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __read_index(self) -> None:
+        index_path = self.path / self.index_file_name
+        if index_path.exists():
+            with open(index_path, 'r') as file:
+                self._index = json.load(file)
+
+    def __write_index(self) -> None:
+        temporary = self.path / (self.index_file_name + '.tmp')
+        with open(temporary, 'w') as file:
+            json.dump(self._index, file, indent=2, sort_keys=True)
+        os.replace(temporary, self.path / self.index_file_name)
+
+    @staticmethod
+    def __parse_date(date: Optional[str]) -> Optional[datetime.date]:
+        if date is None:
+            return None
+        try:
+            return datetime.date.fromisoformat(date.strip()[:10])
+        except ValueError:
+            return None
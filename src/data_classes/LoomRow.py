@@ -1,5 +1,29 @@
 # LOOM/src/data_classes/LoomRow.py
+
+# Names of the fields of a LoomRow, in the same order
+# as the columns of the data section of a LOOM .txt file
+LOOM_ROW_FIELDS = (
+    'unixtime',
+    'revolverpos',
+    'samplepos',
+    'pmtpos',
+    'wavelength',
+    'current',
+    'current_std',
+    'dc',
+    'dc_std',
+    'temperature',
+    'humidity'
+)
+
+# Fields which may be missing in the input file. They
+# are given as None by row-oriented accessors.
+LOOM_OPTIONAL_FIELDS = ('temperature', 'humidity')
+
 class LoomRow:
+    # Fixed layout: no per-instance __dict__
+    __slots__ = LOOM_ROW_FIELDS
+
     def __init__(
         self,
         unixtime: float,
@@ -25,3 +49,39 @@ class LoomRow:
         self.dc_std = dc_std
         self.temperature = temperature
         self.humidity = humidity
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in LOOM_ROW_FIELDS)
+        return f"{type(self).__name__}({values})"
+
+class LoomRowView:
+    """Flyweight, read-only view of one row of a columnar
+    LoomSet storage. It only holds a reference to the
+    shared columns and the index of the row within them,
+    while exposing the same attributes as a LoomRow, so
+    that row-oriented code keeps working unchanged."""
+
+    __slots__ = ('_columns', '_i')
+
+    def __init__(self, columns: dict, i: int):
+        self._columns = columns
+        self._i = i
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in LOOM_ROW_FIELDS)
+        return f"{type(self).__name__}({values})"
+
+def _make_view_property(name: str) -> property:
+    if name in LOOM_OPTIONAL_FIELDS:
+        def getter(self):
+            value = self._columns[name][self._i].item()
+            # Keep the reader convention for missing values
+            return None if value != value else value
+    else:
+        def getter(self):
+            return self._columns[name][self._i].item()
+    return property(getter, doc=f"The '{name}' field of the row")
+
+for _name in LOOM_ROW_FIELDS:
+    setattr(LoomRowView, _name, _make_view_property(_name))
+del _name
@@ -1,12 +1,189 @@
 # LOOM/src/data_classes/LoomSet.py
 
-from typing import List
-from .LoomRow import LoomRow
+import sys
+import numpy as np
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from .LoomRow import LoomRow, LoomRowView, LOOM_ROW_FIELDS
+
+import LOOM.src.exceptions as le
+import LOOM.src.core.grouping as lcg
+import LOOM.src.core.baseline as lcbl
 
 class LoomSet:
-    def __init__(self, metadata: dict, data: List[LoomRow]):
+    """Container for the metadata and the measurements of
+    one or several LOOM runs.
+
+    Apart from the row-oriented access given by the data
+    property, a LoomSet offers a columnar access through
+    the column() method. Columns are built once, on first
+    access, and are shared among a LoomSet and every view
+    derived from it via where() or select(). A view only
+    holds an array of row indices into the shared storage,
+    so that filtering never copies the rows themselves.
+
+    LoomSets which merge several files also carry a table
+    of sources, which maps each source file name to the
+    contiguous [start, stop) range of rows that it
+    contributed. The rows of one source can be extracted
+    as a view through source(), or iterated with
+    iter_sources(), without re-reading the files.
+    """
+
+    # Storage profiles accepted by compact(). Each one maps
+    # each LoomRow field to the dtype of its column, where
+    # 'int' stands for the smallest signed integer dtype
+    # which holds every value of the column.
+    storage_profiles = {
+        'full': {
+            name: (np.int64 if name == 'revolverpos' else np.float64)
+            for name in LOOM_ROW_FIELDS
+        },
+        'compact': {
+            name: (
+                'int' if name == 'revolverpos'
+                else np.float64 if name == 'unixtime'
+                else np.float32
+            )
+            for name in LOOM_ROW_FIELDS
+        }
+    }
+
+    # Columns which are not LoomRow fields, but are derived
+    # from them or set by the analyses. See column().
+    derived_columns = (
+        'label_code',
+        'rejected',
+        'dc_baseline',
+        'dc_baseline_std',
+        'current_env',
+        'current_env_std'
+    )
+
+    # Derived columns which the analyses write to, and which
+    # private_view() copies instead of sharing
+    analysis_columns = (
+        'rejected',
+        'dc_baseline',
+        'dc_baseline_std',
+        'current_env',
+        'current_env_std'
+    )
+
+    # Alternative names which are accepted by column()
+    # and select(), mapped to the actual LoomRow fields
+    column_aliases = {
+        'time': 'unixtime',
+        'revolver': 'revolverpos',
+        'pmt': 'pmtpos',
+        'sample': 'samplepos'
+    }
+
+    def __init__(
+        self,
+        metadata: dict,
+        data: List[LoomRow],
+        sources: Optional[Dict[str, Tuple[int, int]]] = None
+    ):
         self._metadata = metadata
+        # The rows are dropped (set to None) by compact(),
+        # after which the columns are the only storage
         self._data = data
+        self._n_rows = len(data)
+        self._sources = dict(sources) if sources is not None else {}
+        # Shared columnar storage, filled lazily by column()
+        self._columns = {}
+        # Optional function which decodes the given LoomRow
+        # fields from the input, for LoomSets whose columns
+        # are loaded on first access. See from_columns().
+        self._column_loader: Optional[Callable[[Sequence[str]], Dict[str, np.ndarray]]] = None
+        # The (dtypes, rtol) of the last compact() call, which
+        # are applied to the columns that are loaded afterwards
+        self._storage_profile: Optional[Tuple[Dict[str, Any], float]] = None
+        # Shared cache for quantities which are derived from
+        # the metadata, p.e. the revolver labels
+        self._cache = {}
+        # None means that this LoomSet spans every row
+        # in self._data. Otherwise, it is either a slice
+        # (for contiguous views) or an integer array with
+        # the indices of the rows seen by this view.
+        self._index: Optional[Union[slice, np.ndarray]] = None
+
+    @classmethod
+    def from_columns(
+        cls,
+        metadata: dict,
+        columns: Dict[str, np.ndarray],
+        sources: Optional[Dict[str, Tuple[int, int]]] = None,
+        loader: Optional[Callable[[Sequence[str]], Dict[str, np.ndarray]]] = None,
+        n_rows: Optional[int] = None
+    ) -> 'LoomSet':
+        """Builds a LoomSet whose only storage is the given
+        columns, one per LoomRow field, without creating any
+        LoomRow object. Its data property gives flyweight
+        LoomRowView objects.
+
+        If a loader is given, only some fields (or none) need
+        to be given: the rest are decoded by the loader, all
+        in one call, on first access to any of them, so that
+        they are never converted nor stored if none is used.
+
+        Parameters
+        ----------
+        metadata: dict
+            The metadata of the LoomSet
+        columns: Dict[str, np.ndarray]
+            Maps LoomRow fields to their values
+        sources: None or Dict[str, Tuple[int, int]]
+            See the sources property
+        loader: None or Callable
+            A function which takes a sequence of LoomRow fields
+            and returns a dictionary which maps each of them to
+            its values, for every row, in the same order as the
+            given columns. If None, every field must be given.
+            Both the columns and the output of the loader may
+            also hold a 'rejected' boolean array, whose rows
+            are rejected (see reject()), p.e. the rows which
+            the reader could not parse.
+        n_rows: None or int
+            The number of rows. It is only needed if no
+            column is given.
+
+        Returns
+        ----------
+        LoomSet
+        """
+        missing = [name for name in LOOM_ROW_FIELDS if name not in columns]
+        lengths = {len(columns[name]) for name in LOOM_ROW_FIELDS if name in columns}
+        if n_rows is not None:
+            lengths.add(n_rows)
+        if (missing and loader is None) or len(lengths) > 1 or not lengths:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomSet.from_columns()',
+                    reason="A column of the same length must be given for "
+                    "every LoomRow field, unless a loader is given. Missing "
+                    f"fields: {missing}. Found lengths: {sorted(lengths)}."
+                )
+            )
+
+        loom_set = cls(metadata, [], sources)
+        loom_set._data = None
+        loom_set._n_rows = lengths.pop()
+        loom_set._columns.update(
+            {name: np.asarray(columns[name]) for name in LOOM_ROW_FIELDS if name in columns}
+        )
+        if 'rejected' in columns:
+            loom_set._columns['rejected'] = np.array(columns['rejected'], dtype=bool)
+        loom_set._column_loader = loader
+        return loom_set
+
+    @property
+    def loaded_columns(self) -> Tuple[str, ...]:
+        """The LoomRow fields whose column is already built.
+        For a LoomSet whose columns are loaded on first access
+        (see from_columns()), the rest were never decoded."""
+        return tuple(name for name in LOOM_ROW_FIELDS if name in self._columns)
 
     @property
     def metadata(self) -> dict:
@@ -14,50 +191,919 @@ class LoomSet:
 
     @property
     def data(self) -> List[LoomRow]:
-        return self._data
+        """The rows of this LoomSet. If the LoomRow objects
+        were dropped (see compact() and from_columns()), these
+        are flyweight LoomRowView objects over the columns."""
+        if self._data is None:
+            return list(self.iter_rows())
+        if self._index is None:
+            return self._data
+        if isinstance(self._index, slice):
+            return self._data[self._index]
+        return [self._data[i] for i in self._index]
+
+    def iter_rows(self) -> Iterator[Union[LoomRow, LoomRowView]]:
+        """Iterates over the rows of this LoomSet. For a
+        columnar LoomSet, it yields flyweight LoomRowView
+        objects, which are only created as they are needed."""
+        if self._data is not None:
+            yield from self.data
+            return
+
+        for name in LOOM_ROW_FIELDS:
+            self._base_column(name)
+        for i in self.index.tolist():
+            yield LoomRowView(self._columns, i)
+
+    @property
+    def is_view(self) -> bool:
+        return self._index is not None
+
+    @property
+    def index(self) -> np.ndarray:
+        """Indices of the rows of this LoomSet within the
+        storage which it shares with its parent set."""
+        if self._index is None:
+            return np.arange(self._n_rows)
+        if isinstance(self._index, slice):
+            return np.arange(self._index.start, self._index.stop)
+        return self._index
+
+    def __len__(self) -> int:
+        if self._index is None:
+            return self._n_rows
+        if isinstance(self._index, slice):
+            return self._index.stop - self._index.start
+        return len(self._index)
+
+    @property
+    def sources(self) -> Dict[str, Tuple[int, int]]:
+        """Maps each source file name to the [start, stop)
+        range of rows which it contributed to the storage
+        of this LoomSet."""
+        return self._sources
+
+    def source(self, name: str) -> 'LoomSet':
+        """Returns a view with the rows of this LoomSet which
+        come from the given source file. For a LoomSet which
+        is not a view, this is an O(1) operation, and the
+        columns of the returned view are numpy views (not
+        copies) of the shared storage.
+
+        Parameters
+        ----------
+        name: str
+            The name of the source file, as it appears in
+            the sources property
+
+        Returns
+        ----------
+        LoomSet
+        """
+        try:
+            start, stop = self._sources[name]
+        except KeyError:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomSet.source()',
+                    reason=f"'{name}' is not a source of this LoomSet. "
+                    f"The available ones are {list(self._sources)}."
+                )
+            )
+
+        if self._index is None:
+            return self._view(slice(start, stop))
+
+        if isinstance(self._index, slice):
+            start = max(start, self._index.start)
+            stop = max(start, min(stop, self._index.stop))
+            return self._view(slice(start, stop))
+
+        return self._view(
+            self._index[(self._index >= start) & (self._index < stop)]
+        )
+
+    def iter_sources(self) -> Iterator[Tuple[str, 'LoomSet']]:
+        """Yields a (name, view) pair for each source file
+        of this LoomSet, in the order in which they were
+        read. Sources with no rows in this LoomSet are
+        skipped."""
+        for name in self._sources:
+            view = self.source(name)
+            if len(view) > 0:
+                yield name, view
+
+    def source_metadata(self, name: str) -> dict:
+        """Returns the metadata of the given source file. For
+        merged LoomSets, this is the metadata dictionary which
+        is stored under the file name. For single-file LoomSets,
+        it is the metadata of the LoomSet itself."""
+        file_metadata = self._metadata.get(name)
+        if isinstance(file_metadata, dict):
+            return file_metadata
+        return self._metadata
+
+    @staticmethod
+    def parse_revolver_labels(metadata: dict) -> Dict[int, str]:
+        """Returns a dictionary mapping each revolver position
+        to its label, as given by the 'ScanInfo' entry of the
+        given (single-file) metadata. If multiple labels exist
+        for the same revolver position, only the first one is
+        kept."""
+        labels = {}
+
+        for entry in metadata.get("ScanInfo", []):
+            if not isinstance(entry, dict):
+                continue
+            revpos = entry.get("Rev.Pos")
+            label = entry.get("Label")
+            if revpos is not None and label is not None:
+                revpos_int = int(revpos)
+                if revpos_int not in labels:
+                    labels[revpos_int] = label.strip()
+
+        return labels
+
+    @property
+    def source_revolver_labels(self) -> Dict[Optional[str], Dict[int, str]]:
+        """Maps each source file name to the revolver labels
+        given by its own ScanInfo. For a LoomSet without a
+        sources table, the only key is None. It is computed
+        once and shared with every view of this LoomSet."""
+        if 'source_revolver_labels' not in self._cache:
+            if self._sources:
+                self._cache['source_revolver_labels'] = {
+                    name: LoomSet.parse_revolver_labels(
+                        self.source_metadata(name)
+                    )
+                    for name in self._sources
+                }
+            else:
+                self._cache['source_revolver_labels'] = {
+                    None: LoomSet.parse_revolver_labels(self._metadata)
+                }
+        return self._cache['source_revolver_labels']
+
+    @property
+    def revolver_labels(self) -> Dict[int, str]:
+        """Maps each revolver position to its label. For merged
+        LoomSets, the first label found for each position, in
+        the order in which the files were read, is kept."""
+        if 'revolver_labels' not in self._cache:
+            labels = {}
+            for file_labels in self.source_revolver_labels.values():
+                for revpos, label in file_labels.items():
+                    labels.setdefault(revpos, label)
+            self._cache['revolver_labels'] = labels
+        return self._cache['revolver_labels']
+
+    @property
+    def label_categories(self) -> List[str]:
+        """Lookup table of the categorical label column:
+        the label of the rows whose code is i is
+        label_categories[i]. Rows with no label have
+        code -1."""
+        self._base_label_codes()
+        return self._cache['label_categories']
+
+    @property
+    def label_codes(self) -> np.ndarray:
+        """Integer label code of each row of this LoomSet.
+        See label_categories."""
+        return self.column('label_code')
+
+    def label_codes_matching(self, pattern: str) -> np.ndarray:
+        """Returns the label codes whose label contains the
+        given pattern, case-insensitively. P.e. the rows
+        with no sample can be selected with
+
+            loomset.select(label_code=loomset.label_codes_matching("no sample"))
+        """
+        pattern = pattern.lower()
+        return np.array(
+            [
+                code for code, label in enumerate(self.label_categories)
+                if pattern in label.lower()
+            ],
+            dtype=np.int64
+        )
+
+    def _base_label_codes(self) -> np.ndarray:
+        if 'label_code' in self._columns:
+            return self._columns['label_code']
+
+        categories: Dict[str, int] = {}
+        for file_labels in self.source_revolver_labels.values():
+            for label in file_labels.values():
+                categories.setdefault(label, len(categories))
+
+        revolverpos = self._base_column('revolverpos')
+        codes = np.full(len(revolverpos), -1, dtype=np.int64)
+
+        if self._sources:
+            ranges = [
+                (self._sources[name], file_labels)
+                for name, file_labels in self.source_revolver_labels.items()
+            ]
+        else:
+            ranges = [((0, len(revolverpos)), self.source_revolver_labels[None])]
+
+        for (start, stop), file_labels in ranges:
+            if not file_labels:
+                continue
+            # Translate revolver positions into codes through
+            # a sorted lookup table, for the whole range at once
+            keys = np.array(sorted(file_labels), dtype=np.int64)
+            values = np.array(
+                [categories[file_labels[k]] for k in keys],
+                dtype=np.int64
+            )
+            chunk = revolverpos[start:stop]
+            pos = np.clip(np.searchsorted(keys, chunk), 0, len(keys) - 1)
+            codes[start:stop] = np.where(keys[pos] == chunk, values[pos], -1)
+
+        self._cache['label_categories'] = list(categories)
+        self._columns['label_code'] = codes
+        return codes
+
+    def column(self, name: str) -> np.ndarray:
+        """Returns the values of the given field for the rows
+        of this LoomSet, as a numpy array. Missing values
+        (None) are returned as NaN.
+
+        Parameters
+        ----------
+        name: str
+            The name of a LoomRow field, p.e. 'wavelength',
+            or one of the aliases in LoomSet.column_aliases
+
+        Returns
+        ----------
+        np.ndarray
+        """
+        base = self._base_column(name)
+        if self._index is None:
+            return base
+        return base[self._index]
+
+    def masked_column(self, name: str) -> np.ma.MaskedArray:
+        """Same as column(), but missing values are masked
+        instead of being given as NaN. This is meant for the
+        optional fields, p.e. 'temperature' and 'humidity'."""
+        values = self.column(name)
+        return np.ma.masked_invalid(values.astype(np.float64, copy=False))
+
+    def _base_column(self, name: str) -> np.ndarray:
+        name = self.column_aliases.get(name, name)
+        if name == 'label_code':
+            return self._base_label_codes()
+        if name == 'rejected':
+            # Rows with malformed deferred fields are only found
+            # out, and rejected, when those fields are loaded
+            if self._column_loader is not None:
+                self.__load_deferred_columns()
+            if name not in self._columns:
+                self._columns[name] = np.zeros(self._n_rows, dtype=bool)
+            return self._columns[name]
+        if name in ('dc_baseline', 'dc_baseline_std', 'current_env', 'current_env_std'):
+            # NaN until set by correct_dark_current()
+            # or correct_environment()
+            if name not in self._columns:
+                self._columns[name] = np.full(self._n_rows, np.nan)
+            return self._columns[name]
+        if name not in LOOM_ROW_FIELDS:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomSet.column()',
+                    reason=f"'{name}' is not a LoomRow field. The "
+                    f"available ones are {LOOM_ROW_FIELDS}, plus "
+                    f"the derived columns {LoomSet.derived_columns}."
+                )
+            )
+
+        if name not in self._columns and self._column_loader is not None:
+            self.__load_deferred_columns()
+        elif name not in self._columns:
+            if name == 'revolverpos':
+                self._columns[name] = np.fromiter(
+                    (row.revolverpos for row in self._data),
+                    dtype=np.int64,
+                    count=self._n_rows
+                )
+            else:
+                self._columns[name] = np.fromiter(
+                    (
+                        np.nan if getattr(row, name) is None
+                        else getattr(row, name)
+                        for row in self._data
+                    ),
+                    dtype=np.float64,
+                    count=self._n_rows
+                )
+        return self._columns[name]
+
+    def __load_deferred_columns(self) -> None:
+        # Every deferred field is loaded at once, since the
+        # loader may need a whole pass over its input (p.e.
+        # tokenizing a .txt file) whatever the fields
+        deferred = [field for field in LOOM_ROW_FIELDS if field not in self._columns]
+        if not deferred:
+            return
+        loaded = self._column_loader(deferred)
+        for field in deferred:
+            column = np.asarray(loaded[field])
+            if len(column) != self._n_rows:
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        2,
+                        'LoomSet.column()',
+                        reason=f"The loader gave {len(column)} values for "
+                        f"'{field}', but this LoomSet has {self._n_rows} rows."
+                    )
+                )
+            self._columns[field] = column
+            if self._storage_profile is not None:
+                self.__compact_column(field, *self._storage_profile)
+        if 'rejected' in loaded:
+            self._base_column('rejected')[np.asarray(loaded['rejected'], dtype=bool)] = True
+
+    def compact(
+        self,
+        profile: Union[str, Dict[str, Any]] = 'compact',
+        rtol: float = 1e-7,
+        drop_rows: bool = True
+    ) -> Dict[str, Any]:
+        """Converts the storage of this LoomSet into columns
+        with the dtypes given by the storage profile, and,
+        optionally, drops the LoomRow objects, which take
+        roughly an order of magnitude more memory. The data
+        property keeps working afterwards, giving flyweight
+        LoomRowView objects over the columns.
+
+        Every downcast is checked beforehand: a column is kept
+        at its current dtype if the conversion would change any
+        value by more than rtol, relatively, or would turn any
+        finite value into an infinite one (overflow) or a
+        missing one. Integer columns are only downcast to
+        dtypes which hold every value exactly.
+
+        Since the storage is shared, this affects every view
+        of this LoomSet. Views which were created before the
+        call keep a reference to the rows, though.
+
+        For a LoomSet whose columns are loaded on first access
+        (see from_columns()), only the loaded columns are
+        converted here, and the rest are converted as they are
+        loaded. The report only covers the former.
+
+        Parameters
+        ----------
+        profile: str or dict
+            Either the name of one of the profiles in
+            LoomSet.storage_profiles, or a dictionary which
+            overrides the dtype of some fields of the 'compact'
+            profile, p.e. {'pmtpos': np.float64}
+        rtol: float
+            The maximum relative error allowed for a float
+            downcast. The default value is above the rounding
+            error of float32 (~6e-8), so that only overflows,
+            underflows and similar losses are refused.
+        drop_rows: bool
+            Whether to drop the LoomRow objects
+
+        Returns
+        ----------
+        report: dict
+            A dictionary with the following keys:
+                - 'columns': maps each field to a dictionary
+                with its 'dtype', 'bytes_before', 'bytes_after'
+                and 'refused' (whether a lossy downcast was
+                refused) entries
+                - 'rows_bytes_freed': approximate memory taken
+                by the dropped LoomRow objects
+                - 'bytes_saved': total approximate memory saved
+        """
+        if isinstance(profile, str):
+            if profile not in LoomSet.storage_profiles:
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        1,
+                        'LoomSet.compact()',
+                        reason=f"Unknown storage profile '{profile}'. The "
+                        f"available ones are {list(LoomSet.storage_profiles)}."
+                    )
+                )
+            dtypes = LoomSet.storage_profiles[profile]
+        else:
+            dtypes = {**LoomSet.storage_profiles['compact'], **profile}
+
+        report = {'columns': {}, 'rows_bytes_freed': 0, 'bytes_saved': 0}
+
+        for name in LOOM_ROW_FIELDS:
+            if self._data is None and name not in self._columns:
+                # Not loaded yet: it is converted on load
+                continue
+            column = self._base_column(name)
+            refused = self.__compact_column(name, dtypes, rtol)
+
+            report['columns'][name] = {
+                'dtype': str(self._columns[name].dtype),
+                'bytes_before': column.nbytes,
+                'bytes_after': self._columns[name].nbytes,
+                'refused': refused
+            }
+            report['bytes_saved'] += column.nbytes - self._columns[name].nbytes
+
+        if self._column_loader is not None:
+            self._storage_profile = (dtypes, rtol)
+
+        if drop_rows and self._data is not None:
+            report['rows_bytes_freed'] = LoomSet.__approximate_rows_size(self._data)
+            report['bytes_saved'] += report['rows_bytes_freed']
+            self._data = None
+
+        return report
+
+    def __compact_column(self, name: str, dtypes: Dict[str, Any], rtol: float) -> bool:
+        """Converts the stored column of the given field to
+        its dtype in the given profile, unless it is lossy.
+        Returns whether the conversion was refused."""
+        column = self._columns[name]
+        target = LoomSet.__target_dtype(column, dtypes[name])
+
+        if target != column.dtype:
+            with np.errstate(over='ignore', under='ignore'):
+                converted = column.astype(target)
+            if not LoomSet.__is_lossless(column, converted, rtol):
+                return True
+            self._columns[name] = converted
+        return False
+
+    @staticmethod
+    def __target_dtype(column: np.ndarray, dtype: Any) -> np.dtype:
+        if dtype != 'int':
+            return np.dtype(dtype)
+
+        low = int(column.min()) if len(column) > 0 else 0
+        high = int(column.max()) if len(column) > 0 else 0
+        for candidate in (np.int8, np.int16, np.int32, np.int64):
+            info = np.iinfo(candidate)
+            if info.min <= low and high <= info.max:
+                return np.dtype(candidate)
+
+    @staticmethod
+    def __is_lossless(original: np.ndarray, converted: np.ndarray, rtol: float) -> bool:
+        back = converted.astype(original.dtype)
+
+        if np.issubdtype(original.dtype, np.integer) or \
+            np.issubdtype(converted.dtype, np.integer):
+            return np.array_equal(original, back)
+
+        finite = np.isfinite(original)
+        if not np.array_equal(finite, np.isfinite(back)):
+            return False
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            error = np.abs(back[finite] - original[finite])
+            allowed = rtol * np.abs(original[finite])
+        return bool(np.all(error <= allowed))
+
+    @staticmethod
+    def __approximate_rows_size(rows: List[LoomRow]) -> int:
+        if len(rows) == 0:
+            return sys.getsizeof(rows)
+        sample = rows[0]
+        per_row = sys.getsizeof(sample) + sum(
+            sys.getsizeof(getattr(sample, name)) for name in LOOM_ROW_FIELDS
+        )
+        if hasattr(sample, '__dict__'):
+            per_row += sys.getsizeof(sample.__dict__)
+        return sys.getsizeof(rows) + per_row * len(rows)
+
+    @property
+    def rejected(self) -> np.ndarray:
+        """Boolean rejection mask of the rows of this LoomSet.
+        It is stored alongside the shared storage, so that a
+        rejection made through any view is seen by every other
+        view, except for the ones given by private_view().
+        Plots and reductions should honour it, p.e. by working
+        on accepted()."""
+        return self.column('rejected')
+
+    def accepted(self) -> 'LoomSet':
+        """Returns a view with the rows of this LoomSet which
+        are not rejected."""
+        return self.where(~self.rejected)
+
+    def reject(self, mask) -> None:
+        """Marks the rows of this LoomSet which are selected by
+        the given boolean mask as rejected. Previous rejections
+        are kept."""
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (len(self),):
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomSet.reject()',
+                    reason=f"The boolean mask has shape {mask.shape}, "
+                    f"but this LoomSet has {len(self)} rows."
+                )
+            )
+        self._base_column('rejected')[self.index[mask]] = True
+
+    def clear_rejections(self) -> None:
+        """Accepts every row of this LoomSet again."""
+        self._base_column('rejected')[self.index] = False
+
+    def reject_outliers(
+        self,
+        column: str = 'current',
+        group_by: Tuple[str, ...] = ('revolverpos', 'wavelength', 'pmtpos'),
+        method: str = 'mad',
+        nsigma: float = 3.5,
+        max_iters: int = 5,
+        min_count: int = 5
+    ) -> int:
+        """Runs an iterative outlier rejection on the given
+        column, within each group of rows which share the values
+        of the group_by columns, for every group at once. By
+        default, groups are the scan points, so that spikes are
+        rejected among the repeated measurements of each point.
+        The rejected rows are added to the rejection mask (see
+        the rejected property). Rows which were already rejected
+        are not taken into account.
+
+        Parameters
+        ----------
+        column: str
+            The column whose values are clipped
+        group_by: Tuple[str, ...]
+            The columns which define the groups
+        method, nsigma, max_iters, min_count:
+            See LOOM.src.core.grouping.clip_outliers()
+
+        Returns
+        ----------
+        int
+            The number of newly rejected rows
+        """
+        candidates = self.accepted()
+        _, codes = lcg.factorize([candidates.column(name) for name in group_by])
+        n_groups = int(codes.max()) + 1 if len(codes) > 0 else 0
+
+        outliers = lcg.clip_outliers(
+            codes,
+            n_groups,
+            candidates.column(column),
+            method=method,
+            nsigma=nsigma,
+            max_iters=max_iters,
+            min_count=min_count
+        )
+        candidates.reject(outliers)
+        return int(outliers.sum())
+
+    def correct_dark_current(
+        self,
+        window: float = 60.,
+        method: str = 'median'
+    ) -> Dict[Optional[str], Dict[str, np.ndarray]]:
+        """Builds a smoothed dark-current baseline as a function
+        of unixtime, and evaluates it at every row of this
+        LoomSet, so that the noisy dark current of each row can
+        be replaced by the baseline (p.e. through the
+        dark_current argument of LoomCube.from_loomset()). The
+        baseline of each source file is built separately, out
+        of its accepted rows (see the rejected property), since
+        the dark current of different runs need not be
+        continuous. The result is stored in the 'dc_baseline'
+        and 'dc_baseline_std' derived columns, which are shared
+        by every view, as the rejection mask is. Analyses which
+        must not affect other users of the same storage should
+        work on a private_view().
+
+        Parameters
+        ----------
+        window, method:
+            See LOOM.src.core.baseline.binned_baseline()
+
+        Returns
+        ----------
+        Dict[Optional[str], Dict[str, np.ndarray]]
+            The baseline knots of each source file. The key is
+            None for LoomSets with no table of sources.
+        """
+        parts = list(self.iter_sources()) if self._sources else [(None, self)]
+        baseline = self._base_column('dc_baseline')
+        baseline_std = self._base_column('dc_baseline_std')
+
+        knots_by_source = {}
+        for name, part in parts:
+            fit_rows = part.accepted()
+            knots = lcbl.binned_baseline(
+                fit_rows.column('unixtime'),
+                fit_rows.column('dc'),
+                fit_rows.column('dc_std'),
+                window=window,
+                method=method
+            )
+            interpolated = lcbl.interpolate_baseline(part.column('unixtime'), knots)
+            baseline[part.index] = interpolated['value']
+            baseline_std[part.index] = interpolated['err']
+            knots_by_source[name] = knots
+
+        return knots_by_source
+
+    def fit_environmental_response(
+        self,
+        regressors: Tuple[str, ...] = ('temperature', 'humidity'),
+        group_by: Tuple[str, ...] = ('revolverpos', 'wavelength'),
+        column: str = 'current'
+    ) -> Dict[str, Any]:
+        """Fits the relative response of the given column to
+        the given environmental regressors, within each group of
+        rows which share the values of the group_by columns, for
+        every group at once (see
+        LOOM.src.core.grouping.grouped_linear_fit()).
+
+        Since the column varies with the scan point (p.e. with
+        the PMT position), each value is first normalized to the
+        mean of its scan point, given by the revolverpos,
+        wavelength and pmtpos columns. Then, the fitted model
+        of each group is
+
+            value / point_mean - 1 = c + sum_k b_k * (x_k - <x_k>)
+
+        where <x_k> is the mean of the regressor x_k within the
+        group. Missing regressor values are masked out of the
+        fit. Rejected rows (see the rejected property) are not
+        taken into account.
+
+        Parameters
+        ----------
+        regressors: Tuple[str, ...]
+            The columns which the response is fitted against
+        group_by: Tuple[str, ...]
+            The columns which define the groups
+        column: str
+            The column whose response is fitted
+
+        Returns
+        ----------
+        Dict[str, Any]
+            A dictionary which maps 'regressors' and 'group_by'
+            to the given names, 'keys' to the values of the
+            group_by columns of each group, 'slopes' to the
+            (n_groups, k) array of b_k, 'slopes_err' to their
+            uncertainties, 'ndof' to the number of degrees of
+            freedom of each fit, and 'reference' to the mean of
+            each regressor over every row, which is the
+            condition that correct_environment() corrects to.
+        """
+        rows = self.accepted()
+        values = rows.column(column).astype(np.float64, copy=False)
+
+        _, point_codes = lcg.factorize(
+            [rows.column(name) for name in ('revolverpos', 'wavelength', 'pmtpos')]
+        )
+        n_points = int(point_codes.max()) + 1 if len(point_codes) > 0 else 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            point_mean = lcg.group_moments(point_codes, n_points, values)
+            point_mean = (point_mean['sum'] / point_mean['count'])[point_codes]
+            response = values / point_mean - 1.
+            response_err = rows.column(f'{column}_std') / np.abs(point_mean)
+
+        keys, codes = lcg.factorize([rows.column(name) for name in group_by])
+        n_groups = len(keys[0])
+
+        masked = [rows.masked_column(name) for name in regressors]
+        centered = []
+        for x in masked:
+            valid = ~np.ma.getmaskarray(x)
+            group_mean = np.bincount(codes[valid], weights=x.compressed(), minlength=n_groups) \
+                / np.maximum(np.bincount(codes[valid], minlength=n_groups), 1)
+            centered.append(x - group_mean[codes])
+
+        # Intercept first
+        X = np.ma.column_stack([np.ma.ones(len(rows))] + centered)
+        fit = lcg.grouped_linear_fit(codes, n_groups, response, X, response_err)
+
+        return {
+            'regressors': tuple(regressors),
+            'group_by': tuple(group_by),
+            'keys': keys,
+            'slopes': fit['coefficients'][:, 1:],
+            'slopes_err': np.sqrt(np.diagonal(fit['covariance'], axis1=1, axis2=2))[:, 1:],
+            'ndof': fit['ndof'],
+            'reference': np.array([x.mean() if x.count() > 0 else np.nan for x in masked])
+        }
+
+    def correct_environment(self, response: Dict[str, Any]) -> None:
+        """Divides the current of every row of this LoomSet
+        by its fitted environmental response, as returned by
+        fit_environmental_response(), so that every row is
+        referred to the reference conditions of the fit. The
+        result, and its scaled std, are stored in the
+        'current_env' and 'current_env_std' derived columns,
+        which are shared by every view, but not by a
+        private_view() of them. Rows whose group was
+        not fitted, or whose regressors are missing, are left
+        uncorrected in the missing terms.
+
+        Parameters
+        ----------
+        response: Dict[str, Any]
+            The output of fit_environmental_response(), for
+            the 'current' column
+        """
+        group_keys = [self.column(name) for name in response['group_by']]
+        # Locate the group of each row, even if it was not fitted
+        all_keys, codes = lcg.factorize(
+            [np.concatenate((k, np.asarray(f, dtype=k.dtype))) for k, f in zip(group_keys, response['keys'])]
+        )
+        n = len(self)
+        fitted_codes = codes[n:]
+        slope_of_code = np.zeros((len(all_keys[0]), len(response['regressors'])))
+        slope_of_code[fitted_codes] = np.nan_to_num(response['slopes'], nan=0.)
+        slopes = slope_of_code[codes[:n]]
+
+        factor = np.ones(n)
+        for k, name in enumerate(response['regressors']):
+            deviation = self.masked_column(name) - response['reference'][k]
+            factor += slopes[:, k] * deviation.filled(0.)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self._base_column('current_env')[self.index] = self.column('current') / factor
+            self._base_column('current_env_std')[self.index] = self.column('current_std') / np.abs(factor)
+
+    def where(self, mask) -> 'LoomSet':
+        """Returns a view of this LoomSet which only contains
+        the rows selected by the given mask. The view shares
+        the metadata and the storage of this LoomSet, and it
+        can be further filtered by chaining where() or select()
+        calls on it.
+
+        Parameters
+        ----------
+        mask: array-like
+            Either a boolean array whose length matches len(self),
+            or an array of integer positions within this LoomSet
+
+        Returns
+        ----------
+        LoomSet
+        """
+        mask = np.asarray(mask)
+
+        if mask.dtype == bool:
+            if mask.shape != (len(self),):
+                raise le.IncompatibleInput(
+                    le.GenerateExceptionMessage(
+                        1,
+                        'LoomSet.where()',
+                        reason=f"The boolean mask has shape {mask.shape}, "
+                        f"but this LoomSet has {len(self)} rows."
+                    )
+                )
+            positions = np.flatnonzero(mask)
+        elif mask.size == 0 or np.issubdtype(mask.dtype, np.integer):
+            positions = mask.astype(np.intp, copy=False).ravel()
+        else:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    2,
+                    'LoomSet.where()',
+                    reason="The given mask must be either a boolean "
+                    f"or an integer array, but its dtype is {mask.dtype}."
+                )
+            )
+
+        if self._index is None:
+            new_index = positions
+        else:
+            new_index = self.index[positions]
+
+        return self._view(new_index)
+
+    def select(self, **criteria) -> 'LoomSet':
+        """Returns a view of this LoomSet which only contains
+        the rows that match every one of the given criteria.
+        Each keyword is the name of a LoomRow field (or an
+        alias, p.e. time=...), and its value can be:
+
+            - a (lo, hi) tuple, which selects lo <= x <= hi.
+            Any of the two bounds may be None.
+            - a list, set or array of values, which selects
+            the rows whose value is any of them.
+            - a scalar, which selects the rows whose value
+            matches it exactly.
+            - None, in which case the criterion is ignored.
+
+        Example:
+            loomset.select(revolverpos=2, wavelength=(300, 400))
+
+        Returns
+        ----------
+        LoomSet
+        """
+        mask = np.ones(len(self), dtype=bool)
+
+        for name, value in criteria.items():
+            if value is None:
+                continue
+
+            values = self.column(name)
+
+            if isinstance(value, tuple):
+                if len(value) != 2:
+                    raise le.IncompatibleInput(
+                        le.GenerateExceptionMessage(
+                            1,
+                            'LoomSet.select()',
+                            reason=f"The range given for '{name}' must be "
+                            f"a (lo, hi) tuple, but got {value}."
+                        )
+                    )
+                lo, hi = value
+                if lo is not None:
+                    mask &= values >= lo
+                if hi is not None:
+                    mask &= values <= hi
+            elif isinstance(value, (list, set, frozenset, np.ndarray)):
+                mask &= np.isin(values, list(value))
+            else:
+                mask &= values == value
+
+        return self.where(mask)
+
+    def private_view(self) -> 'LoomSet':
+        """Returns a view of the rows of this LoomSet which
+        shares its LoomRow field columns, but holds private
+        copies of the analysis columns (see analysis_columns),
+        i.e. the rejection mask and the columns set by
+        correct_dark_current() and correct_environment(). The
+        rejections and corrections made through the returned
+        view, or through the views derived from it, are not
+        seen by this LoomSet, and vice versa, so that several
+        analyses can run on the same input, p.e. the points of
+        a parameter sweep, without affecting each other.
+        Previous rejections, p.e. the rows which the reader
+        could not parse, are kept."""
+        view = self._view(self._index)
+        view._columns = dict(self._columns)
+        for name in self.analysis_columns:
+            if name in view._columns:
+                view._columns[name] = view._columns[name].copy()
+        return view
+
+    def _view(self, index: Union[slice, np.ndarray]) -> 'LoomSet':
+        view = object.__new__(type(self))
+        view.__dict__.update(self.__dict__)
+        view._index = index
+        return view
 
     @property
     def currents(self) -> List[float]:
-        return [row.current for row in self._data]
+        return [row.current for row in self.data]
 
     @property
     def currents_std(self) -> List[float]:
-        return [row.current_std for row in self._data]
-    
+        return [row.current_std for row in self.data]
+
     @property
     def dcs(self) -> List[float]:
-        return [row.dc for row in self._data]
+        return [row.dc for row in self.data]
 
     @property
     def dcs_std(self) -> List[float]:
-        return [row.dc_std for row in self._data]
+        return [row.dc_std for row in self.data]
 
     @property
     def wavelengths(self) -> List[float]:
-        return [row.wavelength for row in self._data]
+        return [row.wavelength for row in self.data]
 
     @property
     def temperatures(self) -> List[float]:
-        return [row.temperature for row in self._data]
+        return [row.temperature for row in self.data]
 
     @property
     def humidities(self) -> List[float]:
-        return [row.humidity for row in self._data]
+        return [row.humidity for row in self.data]
 
     @property
     def times(self) -> List[float]:
-        return [row.unixtime for row in self._data]
+        return [row.unixtime for row in self.data]
 
     @property
     def sample_positions(self) -> List[float]:
-        return [row.samplepos for row in self._data]
+        return [row.samplepos for row in self.data]
 
     @property
     def pmt_positions(self) -> List[float]:
-        return [row.pmtpos for row in self._data]
+        return [row.pmtpos for row in self.data]
 
     @property
     def revolver_positions(self) -> List[int]:
-        return [row.revolverpos for row in self._data]
-
-    
\ No newline at end of file
+        return [row.revolverpos for row in self.data]
@@ -0,0 +1,92 @@
+# LOOM/src/data_classes/LoomStreamingAggregator.py
+
+import numpy as np
+from typing import Dict, Sequence
+
+import LOOM.src.exceptions as le
+import LOOM.src.core.grouping as lcg
+
+class LoomStreamingAggregator:
+    """Aggregates a stream of LOOM rows in a single pass, with
+    one set of online accumulators per group, so that its
+    memory is proportional to the number of groups rather than
+    to the number of rows.
+
+    Rows are given in chunks (p.e. the output of the
+    iter_chunks() method of the LOOM readers) through
+    add_chunk(). Each chunk is reduced into per-group moments
+    as soon as it arrives, and merged into the running
+    accumulators (count, sum, sum of squared deviations, min
+    and max) with the pairwise update by Chan et al., which is
+    the batched form of Welford's algorithm. The chunk itself
+    is not kept. Unlike LoomOutOfCoreGrouper, nothing is ever
+    spilled to disk, so it is meant for streams whose number
+    of groups (p.e. scan points) fits in memory, whatever
+    their number of rows.
+
+    Example:
+        aggregator = LoomStreamingAggregator(
+            ('revolverpos', 'wavelength', 'pmtpos'),
+            ('current',)
+        )
+        for _, chunk in LoomTxtMultiReader(paths).iter_chunks():
+            aggregator.add_chunk(chunk)
+        table = aggregator.result()
+    """
+
+    def __init__(
+        self,
+        key_columns: Sequence[str],
+        value_columns: Sequence[str]
+    ):
+        if len(key_columns) == 0 or len(value_columns) == 0:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomStreamingAggregator.__init__()',
+                    reason="At least one key column and one value "
+                    "column must be given."
+                )
+            )
+
+        self.key_columns = tuple(key_columns)
+        self.value_columns = tuple(value_columns)
+        self.n_rows = 0
+        self.n_chunks = 0
+        # Running per-group accumulators, sorted by key.
+        # None until the first chunk arrives.
+        self._table = None
+
+    @property
+    def n_groups(self) -> int:
+        return 0 if self._table is None else len(self._table['count'])
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the accumulators, in bytes"""
+        return 0 if self._table is None else sum(a.nbytes for a in self._table.values())
+
+    def add_chunk(self, chunk: Dict[str, np.ndarray]) -> None:
+        """Reduces the given chunk and merges it into the
+        running accumulators."""
+        keys = [np.asarray(chunk[name]) for name in self.key_columns]
+        if len(keys[0]) == 0:
+            return
+
+        partial = lcg.group_moment_table(chunk, self.key_columns, self.value_columns)
+
+        self.n_rows += len(keys[0])
+        self.n_chunks += 1
+        self._table = partial if self._table is None else lcg.merge_moment_tables(
+            (self._table, partial),
+            self.key_columns,
+            self.value_columns
+        )
+
+    def result(self) -> Dict[str, np.ndarray]:
+        """Returns the aggregated table, in the same format as
+        LoomOutOfCoreGrouper.reduce() (see
+        LOOM.src.core.grouping.finalize_moment_table()). The
+        accumulators are kept, so that more chunks can be
+        added afterwards."""
+        return lcg.finalize_moment_table(self._table, self.key_columns, self.value_columns)
@@ -0,0 +1,220 @@
+# LOOM/src/data_classes/LoomTrendMatrix.py
+
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import LOOM.src.exceptions as le
+
+class LoomTrendMatrix:
+    """Runs x wavelengths matrix of one quantity (p.e. the
+    integrated intensity, or the reflectivity, of a reference
+    sample), which is meant to track its drift across many
+    runs. Runs are kept sorted by time, and they can be added
+    incrementally, as new files arrive, without reducing the
+    previous ones again. The wavelength grid is the union of
+    the grids of every run, and the entries of a run which did
+    not measure a given wavelength are NaN.
+
+    Attributes
+    ----------
+    run_ids: List[str]
+        The identifier of each run, p.e. the path of its file
+    fingerprints: List[str]
+        A fingerprint of the input of each run (p.e. its size
+        and modification time), which tells whether a run
+        must be reduced again
+    times: np.ndarray
+        The (N,) start time of each run, in unixtime
+    wavelengths: np.ndarray
+        The (W,) sorted wavelength grid
+    values: np.ndarray
+        The (N, W) matrix
+    options_hash: str
+        A hash of the processing options which every run was
+        reduced with (see LoomReferenceLibrary.options_hash()),
+        so that runs reduced with other options, whose values
+        are not comparable, are never mixed
+    """
+
+    # Decimals to which wavelengths are rounded before
+    # being matched against the grid
+    wavelength_decimals = 6
+
+    def __init__(self, options_hash: str = ''):
+        self.options_hash = options_hash
+        self.run_ids: List[str] = []
+        self.fingerprints: List[str] = []
+        self.times = np.zeros(0)
+        self.wavelengths = np.zeros(0)
+        self.values = np.zeros((0, 0))
+
+    def __len__(self) -> int:
+        return len(self.run_ids)
+
+    def has_run(self, run_id: str, fingerprint: Optional[str] = None) -> bool:
+        """Whether the given run is already in the matrix. If
+        a fingerprint is given, it must also match."""
+        if run_id not in self.run_ids:
+            return False
+        return fingerprint is None or \
+            self.fingerprints[self.run_ids.index(run_id)] == fingerprint
+
+    def add_run(
+        self,
+        run_id: str,
+        time: float,
+        wavelengths: np.ndarray,
+        values: np.ndarray,
+        fingerprint: str = ''
+    ) -> None:
+        """Adds one run to the matrix, or replaces it if its
+        run_id is already there. The wavelength grid is
+        extended if the run measured new wavelengths.
+
+        Parameters
+        ----------
+        run_id: str
+            The identifier of the run
+        time: float
+            The start time of the run, in unixtime
+        wavelengths: np.ndarray
+            The wavelengths measured by the run
+        values: np.ndarray
+            The value of the run at each wavelength
+        fingerprint: str
+            See the fingerprints attribute
+        """
+        wavelengths = np.round(np.asarray(wavelengths, dtype=np.float64), self.wavelength_decimals)
+        values = np.asarray(values, dtype=np.float64)
+
+        if wavelengths.shape != values.shape:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomTrendMatrix.add_run()',
+                    reason=f"Got {len(wavelengths)} wavelengths but "
+                    f"{len(values)} values for run '{run_id}'."
+                )
+            )
+
+        if run_id in self.run_ids:
+            self.remove_run(run_id)
+
+        grid = np.union1d(self.wavelengths, wavelengths)
+        if len(grid) != len(self.wavelengths):
+            extended = np.full((len(self), len(grid)), np.nan)
+            extended[:, np.searchsorted(grid, self.wavelengths)] = self.values
+            self.wavelengths, self.values = grid, extended
+
+        row = np.full(len(self.wavelengths), np.nan)
+        row[np.searchsorted(self.wavelengths, wavelengths)] = values
+
+        # Keep the runs sorted by time
+        position = int(np.searchsorted(self.times, time, side='right'))
+        self.run_ids.insert(position, run_id)
+        self.fingerprints.insert(position, fingerprint)
+        self.times = np.insert(self.times, position, time)
+        self.values = np.insert(self.values, position, row, axis=0)
+
+    def remove_run(self, run_id: str) -> None:
+        position = self.run_ids.index(run_id)
+        del self.run_ids[position]
+        del self.fingerprints[position]
+        self.times = np.delete(self.times, position)
+        self.values = np.delete(self.values, position, axis=0)
+
+    def rolling_statistics(self, window: int = 5) -> Dict[str, np.ndarray]:
+        """Computes drift statistics over the whole matrix at
+        once, through cumulative sums along the runs axis.
+        Missing entries are left out of every statistic.
+
+        Parameters
+        ----------
+        window: int
+            The number of runs of the rolling window
+
+        Returns
+        ----------
+        Dict[str, np.ndarray]
+            A dictionary with the following keys:
+                - 'mean', 'std': the (N, W) mean and standard
+                deviation over the window of runs which ends
+                at (and includes) each run
+                - 'drift': the (N, W) relative deviation of each
+                run from the mean of the window of runs which
+                precede it. NaN for the first run.
+                - 'slope_per_day': the (W,) relative slope of a
+                straight line fitted to each wavelength against
+                time, in units of 1/day, p.e. -0.001 for a loss
+                of 0.1% per day
+        """
+        if window < 1:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    2,
+                    'LoomTrendMatrix.rolling_statistics()',
+                    reason=f"The window must be >= 1, but got {window}."
+                )
+            )
+
+        valid = ~np.isnan(self.values)
+        filled = np.where(valid, self.values, 0.)
+
+        def trailing_sum(a: np.ndarray, include_current: bool) -> np.ndarray:
+            cumulative = np.concatenate((np.zeros((1,) + a.shape[1:]), np.cumsum(a, axis=0)))
+            stop = np.arange(len(a)) + (1 if include_current else 0)
+            start = np.maximum(stop - window, 0)
+            return cumulative[stop] - cumulative[start]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            count = trailing_sum(valid.astype(np.float64), True)
+            mean = trailing_sum(filled, True) / count
+            variance = trailing_sum(filled ** 2, True) / count - mean ** 2
+            std = np.sqrt(np.maximum(variance, 0.) * count / (count - 1))
+            std[count < 2] = np.nan
+
+            previous_mean = trailing_sum(filled, False) / trailing_sum(valid.astype(np.float64), False)
+            drift = self.values / previous_mean - 1.
+
+            first_time = self.times.min() if len(self.times) > 0 else 0.
+            days = np.where(valid, (self.times[:, np.newaxis] - first_time) / 86400., 0.)
+            n = valid.sum(axis=0)
+            mean_day = days.sum(axis=0) / n
+            mean_value = filled.sum(axis=0) / n
+            day_deviation = np.where(valid, days - mean_day, 0.)
+            slope = (day_deviation * (filled - mean_value)).sum(axis=0) / (day_deviation ** 2).sum(axis=0)
+            slope_per_day = slope / mean_value
+
+        return {'mean': mean, 'std': std, 'drift': drift, 'slope_per_day': slope_per_day}
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Saves the matrix to the given .npz file."""
+        np.savez(
+            path,
+            run_ids=np.array(self.run_ids, dtype=str),
+            fingerprints=np.array(self.fingerprints, dtype=str),
+            times=self.times,
+            wavelengths=self.wavelengths,
+            values=self.values,
+            options_hash=np.array(self.options_hash)
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'LoomTrendMatrix':
+        """Loads a matrix which was saved by save(). If the
+        file does not exist, an empty matrix is returned."""
+        trend = cls()
+        if not Path(path).exists():
+            return trend
+
+        with np.load(path) as stored:
+            trend.run_ids = stored['run_ids'].tolist()
+            trend.fingerprints = stored['fingerprints'].tolist()
+            trend.times = stored['times']
+            trend.wavelengths = stored['wavelengths']
+            trend.values = stored['values'].reshape(len(trend.run_ids), len(trend.wavelengths))
+            # Files saved before the options were hashed
+            # never match any options
+            trend.options_hash = str(stored['options_hash']) if 'options_hash' in stored.files else ''
+        return trend
@@ -1,27 +1,154 @@
 # src/readers/MultiTxtLoomReader.py
 
-from typing import List, Dict
+import numpy as np
+from typing import Any, Iterator, List, Dict, Optional, Sequence, Tuple
 from LOOM.src.data_classes.LoomSet import LoomSet
-from LOOM.src.data_classes.LoomRow import LoomRow
+from LOOM.src.data_classes.LoomRow import LoomRow, LOOM_ROW_FIELDS
 from LOOM.src.data_classes.LoomTxtReader import LoomTxtReader
 import os
 
 class LoomTxtMultiReader:
 
-    def __init__(self, paths: List[str]):
+    def __init__(
+        self,
+        paths: List[str],
+        flyweight_rows: bool = False,
+        processes: int = 1,
+        columns: Optional[Sequence[str]] = None,
+        validation: str = 'lenient'
+    ):
         self.paths = paths
+        # See LoomTxtReader.__init__()
+        self.flyweight_rows = flyweight_rows
+        # Each file is parsed in parallel byte ranges, one
+        # file after the other. See LoomTxtReader.__init__()
+        self.processes = processes
+        # See LoomTxtReader.__init__()
+        self.columns = None if columns is None else tuple(columns)
+        # See LoomTxtReader.validation_modes
+        self.validation = validation
+
+        # One reader per file, kept so that the malformed
+        # lines found by every pass (p.e. the lazy decoding
+        # of further columns) add up in its validation report
+        self._readers: Dict[str, LoomTxtReader] = {}
+
+    @property
+    def validation_reports(self) -> Dict[str, Dict[str, Any]]:
+        """The validation report of every file which was
+        read so far, keyed by filename. See
+        LoomTxtReader.validation_report."""
+        return {
+            os.path.basename(path): reader.validation_report
+            for path, reader in self._readers.items()
+        }
 
     def read(self) -> LoomSet:
+        if self.flyweight_rows or self.columns is not None:
+            return self.__read_columnar()
+
         combined_rows: List[LoomRow] = []
         combined_metadata: Dict[str, dict] = {}
+        # Maps each filename to the [start, stop) range
+        # of its rows within combined_rows
+        sources: Dict[str, Tuple[int, int]] = {}
+        # Rejections of the rows with unparsable values
+        rejected: List[np.ndarray] = []
 
         for path in self.paths:
-            reader = LoomTxtReader(path)
-            loom_set = reader.read()
+            loom_set = self.__reader(path).read()
 
             filename = os.path.basename(path)
             combined_metadata[filename] = loom_set.metadata
+
+            start = len(combined_rows)
             combined_rows.extend(loom_set.data)
+            sources[filename] = (start, len(combined_rows))
+            rejected.append(loom_set.rejected)
 
         print(f"✅ Merged {len(self.paths)} files into one LoomSet (metadata kept per file).")
-        return LoomSet(metadata=combined_metadata, data=combined_rows)
+        combined = LoomSet(metadata=combined_metadata, data=combined_rows, sources=sources)
+        if rejected and np.concatenate(rejected).any():
+            combined.reject(np.concatenate(rejected))
+        return combined
+
+    def __read_columnar(self) -> LoomSet:
+        # Fields which are decoded now. The rest, if any,
+        # are decoded by read_columns() on first access.
+        decoded = LOOM_ROW_FIELDS if self.columns is None else self.columns
+        combined_columns: Dict[str, List[np.ndarray]] = {name: [] for name in decoded}
+        combined_metadata: Dict[str, dict] = {}
+        sources: Dict[str, Tuple[int, int]] = {}
+        rejected: List[np.ndarray] = []
+        n_rows = 0
+
+        for path in self.paths:
+            reader = self.__reader(path)
+            columns = reader.read_columns(decoded, mark_invalid=True)
+
+            filename = os.path.basename(path)
+            combined_metadata[filename] = reader.read_metadata()
+
+            for name in decoded:
+                combined_columns[name].append(columns[name])
+            rejected.append(columns['rejected'])
+            n_file = len(columns['rejected'])
+            sources[filename] = (n_rows, n_rows + n_file)
+            n_rows += n_file
+
+        print(f"✅ Merged {len(self.paths)} files into one LoomSet (metadata kept per file).")
+        combined_columns = {name: np.concatenate(arrays) for name, arrays in combined_columns.items()}
+        combined_columns['rejected'] = np.concatenate(rejected)
+        return LoomSet.from_columns(
+            metadata=combined_metadata,
+            columns=combined_columns,
+            sources=sources,
+            loader=None if self.columns is None
+            else lambda names: self.read_columns(names, mark_invalid=True),
+            n_rows=n_rows
+        )
+
+    def read_columns(
+        self,
+        columns: Optional[Sequence[str]] = None,
+        mark_invalid: bool = False
+    ) -> Dict[str, np.ndarray]:
+        """Reads the given LoomRow fields (every one, if None)
+        of every file, concatenated in order. See
+        LoomTxtReader.read_columns() for mark_invalid."""
+        columns = LOOM_ROW_FIELDS if columns is None else tuple(columns)
+        parts = [
+            self.__reader(path).read_columns(columns, mark_invalid)
+            for path in self.paths
+        ]
+        if mark_invalid:
+            columns = columns + ('rejected',)
+        return {name: np.concatenate([part[name] for part in parts]) for name in columns}
+
+    def read_metadata(self) -> Dict[str, dict]:
+        """Returns the metadata of every file, keyed by
+        filename, without reading their data sections."""
+        return {
+            os.path.basename(path): LoomTxtReader(path).read_metadata()
+            for path in self.paths
+        }
+
+    def iter_chunks(
+        self,
+        chunk_size: int = 100_000,
+        columns: Optional[Sequence[str]] = None
+    ) -> Iterator[Tuple[str, Dict[str, np.ndarray]]]:
+        """Streams the data sections of every file, in order,
+        yielding (filename, chunk) pairs. See
+        LoomTxtReader.iter_chunks() for the chunk format."""
+        for path in self.paths:
+            filename = os.path.basename(path)
+            for chunk in self.__reader(path).iter_chunks(chunk_size, columns):
+                yield filename, chunk
+
+    def __reader(self, path: str) -> LoomTxtReader:
+        if path not in self._readers:
+            self._readers[path] = LoomTxtReader(
+                path, processes=self.processes, validation=self.validation
+            )
+        return self._readers[path]
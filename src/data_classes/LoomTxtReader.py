@@ -1,46 +1,91 @@
 # src/readers/TxtLoomReader.py
 
-from typing import List
+import os
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 from LOOM.src.data_classes.LoomSet import LoomSet
-from LOOM.src.data_classes.LoomRow import LoomRow
+from LOOM.src.data_classes.LoomRow import LoomRow, LOOM_ROW_FIELDS, LOOM_OPTIONAL_FIELDS
+import LOOM.src.exceptions as le
+
+# Unparsable tokens which are taken as a missing value.
+# They are only valid for the optional fields. Note that
+# 'nan' is parsed, as a float, by every field.
+MISSING_TOKENS = ('', 'None', 'none', 'NA', 'N/A')
 
 class LoomTxtReader:
 
-    def __init__(self, path: str):
+    # Validation modes. In 'lenient' mode, malformed lines are
+    # quarantined (see validation_report) and parsing goes on,
+    # while in 'strict' mode they raise an exception.
+    validation_modes = ('lenient', 'strict')
+
+    # Maximum number of quarantined lines whose text is kept
+    # in the validation report. The counts are always exact.
+    quarantine_limit = 10_000
+
+    def __init__(
+        self,
+        path: str,
+        flyweight_rows: bool = False,
+        processes: int = 1,
+        columns: Optional[Sequence[str]] = None,
+        validation: str = 'lenient'
+    ):
+        # If flyweight_rows is True, read() stores the data
+        # as columns only, and the rows of the returned
+        # LoomSet are flyweight LoomRowView objects.
+        # If processes is greater than 1, read_columns()
+        # (and so read(), with flyweight_rows) parses the
+        # data section in parallel. See read_columns().
+        # If columns is given, read() only decodes those
+        # LoomRow fields (which may be none), and the rest
+        # are decoded from the file, in one more pass, on
+        # first access to any of them. It implies
+        # flyweight_rows.
+        # See validation_modes and validation_report for
+        # the handling of malformed lines.
+        if validation not in self.validation_modes:
+            raise le.IncompatibleInput(
+                le.GenerateExceptionMessage(
+                    1,
+                    'LoomTxtReader.__init__()',
+                    reason=f"Unknown validation mode '{validation}'. It "
+                    f"must be one of {self.validation_modes}."
+                )
+            )
+
         self.path = path
+        self.flyweight_rows = flyweight_rows
+        self.processes = processes
+        self.columns = None if columns is None else tuple(columns)
+        self.validation = validation
+
+        # Validation state, filled as the data section is
+        # parsed. Every pass over the file sees the same
+        # lines, so the per-line counts are overwritten by
+        # each pass, while the per-field counts are only
+        # updated for the fields which each pass decodes.
+        self._n_lines = 0
+        self._n_short = 0
+        self._invalid_by_field: Dict[str, int] = {}
+        self._missing_by_field: Dict[str, int] = {}
+        # Maps the line number of each quarantined
+        # line to its {'line', 'reason', 'text'} entry
+        self._quarantine: Dict[int, Dict[str, Any]] = {}
+        # Line numbers of the rows with unparsable values
+        self._invalid_lines = set()
 
     def parse_float_or_none(value):
         try:
             return float(value)
         except ValueError:
             return None
-    
-    def read(self) -> LoomSet:
-        metadata = {}
-        data_rows: List[LoomRow] = []
-
-        with open(self.path, "r") as f:
-            lines = f.readlines()
-
-        # Separate sections
-        header_lines = []
-        data_lines = []
-        in_data = False
-
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith("UNIXTime"):
-                header = line
-                in_data = True
-                continue
-            if in_data:
-                data_lines.append(line)
-            else:
-                header_lines.append(line)
 
-        # Processing metadata
+    @staticmethod
+    def parse_metadata(header_lines: List[str]) -> dict:
+        metadata = {}
         scan_info = []
         for line in header_lines:
             line = line.strip()
@@ -61,26 +106,564 @@ class LoomTxtReader:
         if scan_info:
             metadata["ScanInfo"] = scan_info
 
-        # Processing data rows
-        for line in data_lines:
-            tokens = line.split(",")
-            if len(tokens) < 11:
-                continue  
-
-            row = LoomRow(
-                unixtime=float(tokens[0]),
-                revolverpos=int(tokens[1]),
-                samplepos=float(tokens[2]),
-                pmtpos=float(tokens[3]),
-                wavelength=float(tokens[4]),
-                current=float(tokens[5]),
-                current_std=float(tokens[6]),
-                dc=float(tokens[6]),
-                dc_std=float(tokens[7]),
-                temperature=LoomTxtReader.parse_float_or_none(tokens[9]),
-                humidity=LoomTxtReader.parse_float_or_none(tokens[10])
-            )
-            data_rows.append(row)
+        return metadata
+
+    @staticmethod
+    def parse_row(tokens: List[str]) -> Optional[tuple]:
+        """Returns the values of the LoomRow fields, in the
+        order given by LOOM_ROW_FIELDS, for the given tokens
+        of a data line, or None if the line is too short."""
+        if len(tokens) < 11:
+            return None
+
+        return (
+            float(tokens[0]),
+            int(tokens[1]),
+            float(tokens[2]),
+            float(tokens[3]),
+            float(tokens[4]),
+            float(tokens[5]),
+            float(tokens[6]),
+            float(tokens[7]),
+            float(tokens[8]),
+            LoomTxtReader.parse_float_or_none(tokens[9]),
+            LoomTxtReader.parse_float_or_none(tokens[10])
+        )
+
+    def read(self) -> LoomSet:
+        """Reads the whole file into a LoomSet. Rows whose
+        values could not be parsed are kept, with NaN (or -1
+        for revolverpos) in place of those values, and they
+        are rejected (see LoomSet.reject()), so that they
+        stay out of the analyses while keeping every column
+        aligned. Lines with too few fields are dropped. Both
+        are listed in the validation_report."""
+        if self.columns is not None:
+            return self.__read_lazily()
+
+        columns = self.read_columns(mark_invalid=True)
+        rejected = columns.pop('rejected')
+        metadata = self.read_metadata()
+        sources = {os.path.basename(self.path): (0, len(rejected))}
+
+        if self.flyweight_rows:
+            loom_set = LoomSet.from_columns(metadata=metadata, columns=columns, sources=sources)
+        else:
+            values = {name: columns[name].tolist() for name in LOOM_ROW_FIELDS}
+            for name in LOOM_OPTIONAL_FIELDS:
+                # Keep the reader convention for missing values
+                values[name] = [None if v != v else v for v in values[name]]
+            data_rows = [
+                LoomRow(*row) for row in zip(*(values[name] for name in LOOM_ROW_FIELDS))
+            ]
+            loom_set = LoomSet(metadata=metadata, data=data_rows, sources=sources)
+
+        if rejected.any():
+            loom_set.reject(rejected)
+        self.__warn_about_quarantine()
 
         print("✅ LoomSet object created.")
-        return LoomSet(metadata=metadata, data=data_rows)
\ No newline at end of file
+        return loom_set
+
+    def __read_lazily(self) -> LoomSet:
+        columns = self.read_columns(self.columns, mark_invalid=True)
+        n_rows = len(columns['rejected'])
+        self.__warn_about_quarantine()
+
+        print(f"✅ LoomSet object created (decoded columns: {list(self.columns)}).")
+        return LoomSet.from_columns(
+            metadata=self.read_metadata(),
+            columns=columns,
+            sources={os.path.basename(self.path): (0, n_rows)},
+            loader=lambda names: self.read_columns(names, mark_invalid=True),
+            n_rows=n_rows
+        )
+
+    @property
+    def validation_report(self) -> Dict[str, Any]:
+        """Statistics of the malformed lines which were found
+        so far, as a dictionary with the following keys:
+            - 'file': the file name
+            - 'mode': the validation mode
+            - 'n_lines': the number of non-empty data lines
+            - 'n_rows': the number of rows, i.e. the lines
+            with enough fields
+            - 'n_short': the number of lines with too few
+            fields, which are dropped
+            - 'n_invalid': the number of rows with a value
+            of a non-optional field which could not be parsed
+            - 'invalid_by_field': the number of unparsable
+            values of each decoded non-optional field
+            - 'missing_by_field': the number of missing or
+            unparsable values of each decoded optional field,
+            which are given as NaN and are not errors
+            - 'quarantine': the list of the malformed lines,
+            each one as a {'line', 'reason', 'text'} entry,
+            sorted by line number, where 'line' is 1-based.
+            At most quarantine_limit entries are kept.
+        Fields which are never decoded are never validated."""
+        return {
+            'file': os.path.basename(self.path),
+            'mode': self.validation,
+            'n_lines': self._n_lines,
+            'n_rows': self._n_lines - self._n_short,
+            'n_short': self._n_short,
+            'n_invalid': len(self._invalid_lines),
+            'invalid_by_field': dict(self._invalid_by_field),
+            'missing_by_field': dict(self._missing_by_field),
+            'quarantine': [self._quarantine[line] for line in sorted(self._quarantine)]
+        }
+
+    def __warn_about_quarantine(self) -> None:
+        report = self.validation_report
+        if report['n_short'] or report['n_invalid']:
+            print(
+                f"Warning: Quarantined {report['n_short'] + report['n_invalid']} malformed "
+                f"line(s) of '{report['file']}' ({report['n_short']} with too few fields, "
+                f"{report['n_invalid']} with unparsable values)."
+            )
+
+    def count_rows(self) -> int:
+        """Counts the rows of the data section, without
+        decoding any of their values."""
+        n_rows = 0
+        in_data = False
+
+        with open(self.path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if not in_data:
+                    in_data = line.startswith("UNIXTime")
+                    continue
+                # Same condition as parse_row()
+                if line.count(",") >= len(LOOM_ROW_FIELDS) - 1:
+                    n_rows += 1
+
+        return n_rows
+
+    def read_metadata(self) -> dict:
+        """Parses the header of the file, stopping at the
+        'UNIXTime' line, and returns its metadata without
+        reading the data section."""
+        header_lines = []
+
+        with open(self.path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("UNIXTime"):
+                    break
+                if line:
+                    header_lines.append(line)
+
+        return LoomTxtReader.parse_metadata(header_lines)
+
+    def read_columns(
+        self,
+        columns: Optional[Sequence[str]] = None,
+        mark_invalid: bool = False
+    ) -> Dict[str, np.ndarray]:
+        """Reads the whole data section into one numpy
+        array per LoomRow field, without creating any
+        LoomRow object. If columns is given, only those
+        fields are decoded, and the tokens of the rest are
+        never converted.
+
+        Malformed lines are validated in bulk, within the
+        parsing of each chunk, and accounted for in the
+        validation_report. In 'strict' mode, they raise an
+        IllFormedDataFile exception, which gives the file
+        and the first malformed lines. In 'lenient' mode,
+        lines with too few fields are dropped, and rows with
+        an unparsable value of a decoded non-optional field
+        are either dropped or, if mark_invalid is True, kept,
+        with NaN (or -1 for revolverpos) in place of that
+        value, and flagged by the 'rejected' boolean array
+        of the output. The latter
+        keeps the rows of separate calls for different fields
+        aligned.
+
+        If the processes attribute is greater than 1, the
+        data section is split into as many byte ranges, whose
+        boundaries are moved forward to the next newline, so
+        that every line belongs to exactly one range. The
+        ranges are parsed by a pool of worker processes, and
+        their columns are concatenated in order, so that the
+        output is identical to the serial one."""
+        columns = LOOM_ROW_FIELDS if columns is None else tuple(columns)
+
+        parsed = None
+        if self.processes > 1:
+            ranges = self.split_data_section(self.processes)
+            if len(ranges) > 1:
+                parsed = self.__parse_in_parallel(ranges, columns)
+        if parsed is None:
+            parsed = list(self.__parse_chunks(columns))
+
+        output = {
+            name: np.concatenate([chunk['columns'][name] for chunk in parsed]) if parsed
+            else np.zeros(0, dtype=np.int64 if name == 'revolverpos' else np.float64)
+            for name in columns
+        }
+        invalid = np.concatenate([chunk['invalid'] for chunk in parsed]) if parsed \
+            else np.zeros(0, dtype=bool)
+
+        if mark_invalid:
+            output['rejected'] = invalid
+        elif invalid.any():
+            output = {name: values[~invalid] for name, values in output.items()}
+        return output
+
+    def split_data_section(self, n_ranges: int) -> List[Tuple[int, int]]:
+        """Splits the data section of the file, which starts
+        after the 'UNIXTime' line, into at most n_ranges
+        [start, stop) byte ranges of similar size. Every range
+        starts at the beginning of a line, and ends right after
+        a newline (or at the end of the file)."""
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip().startswith(b"UNIXTime"):
+                    break
+            data_start = f.tell()
+            size = os.fstat(f.fileno()).st_size
+
+            boundaries = [data_start]
+            for i in range(1, n_ranges):
+                target = data_start + (size - data_start) * i // n_ranges
+                if target <= boundaries[-1]:
+                    continue
+                f.seek(target - 1)
+                # Move forward to the start of the next line,
+                # unless target is already one
+                f.readline()
+                boundary = f.tell()
+                if boundaries[-1] < boundary < size:
+                    boundaries.append(boundary)
+            boundaries.append(size)
+
+        return [(start, stop) for start, stop in zip(boundaries[:-1], boundaries[1:]) if stop > start]
+
+    def __parse_in_parallel(
+        self,
+        ranges: List[Tuple[int, int]],
+        columns: Sequence[str]
+    ) -> List[Dict[str, Any]]:
+        context = multiprocessing.get_context(
+            'fork' if 'fork' in multiprocessing.get_all_start_methods()
+            else None
+        )
+        with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as executor:
+            parts = list(
+                executor.map(
+                    _parse_byte_range,
+                    [self.path] * len(ranges),
+                    [start for start, _ in ranges],
+                    [stop for _, stop in ranges],
+                    [columns] * len(ranges)
+                )
+            )
+
+        # The workers number the lines of their range from
+        # 1, so they are shifted by the lines which precede it
+        first_line = self.__count_header_lines()
+        self.__start_pass(columns)
+        chunks = []
+        for part in parts:
+            for chunk in part['chunks']:
+                for entry in chunk['quarantine']:
+                    entry['line'] += first_line
+                self.__account(chunk)
+                chunks.append(chunk)
+            first_line += part['n_lines']
+        return chunks
+
+    def __count_header_lines(self) -> int:
+        """Number of lines up to, and including, the
+        'UNIXTime' line, as split by split_data_section()."""
+        n_lines = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                n_lines += 1
+                if line.strip().startswith(b"UNIXTime"):
+                    break
+        return n_lines
+
+    def __parse_chunks(
+        self,
+        columns: Sequence[str],
+        chunk_size: int = 100_000
+    ) -> Iterator[Dict[str, Any]]:
+        """Parses the data section serially, yielding the
+        output of _parse_lines() for each chunk of, at most,
+        chunk_size lines, after accounting for it."""
+        self.__start_pass(columns)
+        lines: List[Tuple[int, str]] = []
+        in_data = False
+
+        with open(self.path, "r") as f:
+            for number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                if not in_data:
+                    in_data = line.startswith("UNIXTime")
+                    continue
+
+                lines.append((number, line))
+                if len(lines) == chunk_size:
+                    chunk = _parse_lines(lines, columns)
+                    self.__account(chunk)
+                    yield chunk
+                    lines = []
+
+        if lines:
+            chunk = _parse_lines(lines, columns)
+            self.__account(chunk)
+            yield chunk
+
+    def __start_pass(self, columns: Sequence[str]) -> None:
+        self._n_lines = 0
+        self._n_short = 0
+        for name in columns:
+            counts = self._missing_by_field if name in LOOM_OPTIONAL_FIELDS \
+                else self._invalid_by_field
+            counts[name] = 0
+
+    def __account(self, chunk: Dict[str, Any]) -> None:
+        """Adds the validation results of the given chunk
+        to the state of this reader, and enforces the
+        'strict' mode."""
+        self._n_lines += chunk['n_lines']
+        self._n_short += chunk['n_short']
+        for name, count in chunk['invalid_by_field'].items():
+            self._invalid_by_field[name] += count
+        for name, count in chunk['missing_by_field'].items():
+            self._missing_by_field[name] += count
+
+        self._invalid_lines.update(chunk['invalid_lines'])
+
+        for entry in chunk['quarantine']:
+            known = self._quarantine.get(entry['line'])
+            if known is None:
+                if len(self._quarantine) < self.quarantine_limit:
+                    self._quarantine[entry['line']] = entry
+            elif entry['reason'] not in known['reason']:
+                # Found again by a later pass,
+                # which decodes other fields
+                known['reason'] += '; ' + entry['reason']
+
+        if self.validation == 'strict' and chunk['quarantine']:
+            first = chunk['quarantine'][:5]
+            raise le.IllFormedDataFile(
+                le.GenerateExceptionMessage(
+                    2,
+                    'LoomTxtReader.read_columns()',
+                    reason=f"Found {len(chunk['quarantine'])} malformed line(s) in "
+                    f"'{self.path}', in 'strict' validation mode. The first "
+                    "ones are: " + "; ".join(
+                        f"line {entry['line']} ({entry['reason']}): '{entry['text']}'"
+                        for entry in first
+                    )
+                )
+            )
+
+    def iter_chunks(
+        self,
+        chunk_size: int = 100_000,
+        columns: Optional[Sequence[str]] = None
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """Streams the data section of the file, yielding it
+        in chunks of, at most, chunk_size rows. Each chunk
+        is a dictionary which maps each requested LoomRow
+        field to a numpy array. Missing values are given as
+        NaN. Only one chunk is held in memory at a time.
+        The tokens of the fields which are not requested
+        are never converted.
+
+        Parameters
+        ----------
+        chunk_size: int
+            The maximum number of rows per chunk
+        columns: None or Sequence[str]
+            The LoomRow fields to be yielded. If None,
+            every field is yielded.
+
+        Returns
+        ----------
+        Iterator[Dict[str, np.ndarray]]
+        """
+        if columns is None:
+            columns = LOOM_ROW_FIELDS
+
+        # Streamed rows can not be rejected, so the ones
+        # with unparsable values are dropped
+        for chunk in self.__parse_chunks(columns, chunk_size):
+            valid = ~chunk['invalid']
+            yield chunk['columns'] if valid.all() else \
+                {name: values[valid] for name, values in chunk['columns'].items()}
+        self.__warn_about_quarantine()
+
+def _convert_tokens(tokens: List[str], name: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Converts the tokens of one LoomRow field into a numpy
+    array, at once. Returns the values, plus the masks of the
+    missing tokens (see MISSING_TOKENS) and of the unparsable
+    ones, which are given as NaN (or -1 for revolverpos).
+
+    If the bulk conversion fails, the offending tokens are
+    located by bisection, i.e. by converting halves of the
+    failing ranges, so that k bad tokens take O(k log n) bulk
+    conversions rather than one Python call per token."""
+    dtype = np.int64 if name == 'revolverpos' else np.float64
+    fill = -1 if name == 'revolverpos' else np.nan
+    n = len(tokens)
+    missing = np.zeros(n, dtype=bool)
+
+    try:
+        return np.array(tokens, dtype=dtype), missing, np.zeros(n, dtype=bool)
+    except (ValueError, OverflowError):
+        pass
+
+    strings = np.char.strip(np.array(tokens, dtype=str))
+    missing = np.isin(strings, MISSING_TOKENS)
+    values = np.full(n, fill, dtype=dtype)
+    bad = missing.copy()
+
+    pending = [(0, n)]
+    while pending:
+        start, stop = pending.pop()
+        piece = np.where(missing[start:stop], '0', strings[start:stop])
+        try:
+            values[start:stop] = np.array(piece, dtype=dtype)
+        except (ValueError, OverflowError):
+            if stop - start == 1:
+                bad[start] = True
+                continue
+            middle = (start + stop) // 2
+            pending.extend(((middle, stop), (start, middle)))
+
+    values[bad] = fill
+    return values, missing, bad & ~missing
+
+def _parse_lines(lines: List[Tuple[int, str]], columns: Sequence[str]) -> Dict[str, Any]:
+    """Parses the given (line number, stripped text) data
+    lines, converting only the requested LoomRow fields, one
+    bulk conversion per field, with the same values as
+    LoomTxtReader.parse_row(). Lines with too few fields are
+    dropped. Missing or unparsable values of the optional
+    fields become NaN, while unparsable values of the rest
+    mark their row as invalid.
+
+    Returns
+    ----------
+    Dict[str, Any]
+        A dictionary with the 'columns' of the rows, their
+        'invalid' mask, the 'invalid_lines' numbers, the
+        'quarantine' entries of the malformed lines, and the
+        counts 'n_lines', 'n_short', 'invalid_by_field' and
+        'missing_by_field'
+    """
+    rows: List[List[str]] = []
+    numbers: List[int] = []
+    quarantine: List[Dict[str, Any]] = []
+
+    for number, line in lines:
+        tokens = line.split(",")
+        # Same condition as parse_row()
+        if len(tokens) < len(LOOM_ROW_FIELDS):
+            quarantine.append({
+                'line': number,
+                'reason': f"too few fields ({len(tokens)} < {len(LOOM_ROW_FIELDS)})",
+                'text': line
+            })
+            continue
+        rows.append(tokens)
+        numbers.append(number)
+
+    chunk_columns = {}
+    invalid = np.zeros(len(rows), dtype=bool)
+    bad_fields: Dict[int, List[str]] = {}
+    invalid_by_field, missing_by_field = {}, {}
+
+    for name in columns:
+        pos = LOOM_ROW_FIELDS.index(name)
+        values, missing, bad = _convert_tokens([r[pos] for r in rows], name)
+        chunk_columns[name] = values
+
+        if name in LOOM_OPTIONAL_FIELDS:
+            # The reader convention takes any
+            # unparsable value as missing
+            missing_by_field[name] = int((missing | bad).sum())
+        else:
+            bad |= missing
+            invalid |= bad
+            invalid_by_field[name] = int(bad.sum())
+            for i in np.flatnonzero(bad).tolist():
+                bad_fields.setdefault(i, []).append(name)
+
+    for i, names in sorted(bad_fields.items()):
+        quarantine.append({
+            'line': numbers[i],
+            'reason': "unparsable " + ", ".join(names),
+            'text': ",".join(rows[i])
+        })
+    quarantine.sort(key=lambda entry: entry['line'])
+
+    return {
+        'columns': chunk_columns,
+        'invalid': invalid,
+        'invalid_lines': [numbers[i] for i in sorted(bad_fields)],
+        'quarantine': quarantine,
+        'n_lines': len(lines),
+        'n_short': len(lines) - len(rows),
+        'invalid_by_field': invalid_by_field,
+        'missing_by_field': missing_by_field
+    }
+
+def _parse_byte_range(
+    path: str,
+    start: int,
+    stop: int,
+    columns: Sequence[str] = LOOM_ROW_FIELDS,
+    block_size: int = 2**24
+) -> Dict[str, Any]:
+    """Parses the lines of the given byte range of the data
+    section of a LOOM .txt file, as split by
+    LoomTxtReader.split_data_section(), into the output of
+    _parse_lines() for each block. Lines are numbered from 1
+    within the range, and 'n_lines' gives the number of lines
+    of the range, including the empty ones. It runs in the
+    worker processes of read_columns(). The range is read in
+    blocks of whole lines, of about block_size bytes, to bound
+    the memory of each worker."""
+    chunks = []
+    n_lines = 0
+    position = start
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        while position < stop:
+            block = f.read(min(block_size, stop - position))
+            if not block:
+                break
+            if not block.endswith(b"\n") and position + len(block) < stop:
+                # Complete the last line of the block
+                block += f.readline()
+            position += len(block)
+
+            # Same as the universal newlines of the
+            # text mode which is used by iter_chunks()
+            text = block.decode().replace("\r\n", "\n").replace("\r", "\n")
+            pieces = text.split("\n")
+            if text.endswith("\n"):
+                pieces.pop()
+
+            lines = []
+            for i, line in enumerate(pieces, start=n_lines + 1):
+                line = line.strip()
+                if line:
+                    lines.append((i, line))
+            n_lines += len(pieces)
+            chunks.append(_parse_lines(lines, columns))
+
+    return {'chunks': chunks, 'n_lines': n_lines}
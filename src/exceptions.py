@@ -67,6 +67,13 @@ class NoDataInFile(LoomBaseException):
     """
     pass
 
+class IllFormedDataFile(LoomBaseException):
+    """
+    Raised when the data section of an input file holds malformed lines
+    (e.g., too few fields or unparsable values) which are not tolerated.
+    """
+    pass
+
 class IllFormedAnalysisFolder(LoomBaseException):
     """
     Raised when the analysis folder does not contain the required structure,
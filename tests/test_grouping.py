@@ -0,0 +1,36 @@
+# tests/test_grouping.py
+
+import numpy as np
+import pytest
+
+import LOOM.src.core.grouping as lcg
+
+@pytest.mark.parametrize('method', ['sigma', 'mad'])
+@pytest.mark.parametrize('group_size', [3, 4, 5])
+def test_clip_outliers_keeps_clean_gaussian_groups(method, group_size):
+    rng = np.random.default_rng(group_size)
+    n_groups = 10_000
+    codes = np.repeat(np.arange(n_groups), group_size)
+    values = rng.standard_normal(n_groups * group_size)
+
+    rejected = lcg.clip_outliers(codes, n_groups, values, method=method, nsigma=3.5)
+
+    # The two-sided normal tail beyond 3.5 sigma is 4.7e-4
+    assert rejected.mean() < 2e-3
+
+def test_clip_outliers_rejects_spikes():
+    rng = np.random.default_rng(0)
+    n_groups, group_size = 1_000, 5
+    codes = np.repeat(np.arange(n_groups), group_size)
+    values = rng.standard_normal(n_groups * group_size)
+    values[::group_size] += 100.
+
+    rejected = lcg.clip_outliers(codes, n_groups, values, method='sigma', nsigma=3.5)
+
+    assert rejected[::group_size].all()
+
+def test_student_t_critical():
+    # Two-sided 95% quantiles of Student's t distribution
+    critical = lcg.student_t_critical(1.959964, np.array([1, 3, 10]))
+    np.testing.assert_allclose(critical, [12.7062, 3.1824, 2.2281], rtol=1e-4)
+    assert lcg.student_t_critical(3.5, np.array([100_000]))[0] == pytest.approx(3.5, rel=1e-3)